@@ -1,29 +1,117 @@
+import gzip
+import hashlib
 import logging
 import os
+import re
 import signal
 import threading
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from types import FrameType
+from urllib.parse import urlsplit
 
 import httpx
 import yaml
+from cache import CacheIndex
+from server import ArtifactServer, Download, Downloads
 
 LISTEN_ADDR = os.environ.get("LISTEN_ADDR", "0.0.0.0")  # noqa S104: running inside container
 LISTEN_PORT = int(os.environ.get("LISTEN_PORT", 8000))
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", 32))
 ARTIFACTS_FILE = Path(os.environ.get("ARTIFACTS_FILE", "/artifacts_srv/artifacts.yaml"))
 ARTIFACTS_DIR = Path(os.environ.get("ARTIFACTS_DIR", "artifacts"))
 ARTIFACTS_DIR.mkdir(exist_ok=True)
+FEEDS_DIR = ARTIFACTS_DIR / "feeds"
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 4))
+CHUNK_SIZE = 1 << 20
+# bytes the artifacts may take up before the least recently used ones are evicted, 0 for no limit
+CACHE_BUDGET = int(os.environ.get("CACHE_BUDGET", 0))
+# files are served while they are being downloaded
+DOWNLOADS = Downloads(ARTIFACTS_DIR)
 
 
-def download_file(url: str, dest: Path) -> None:
-    """Downloads a file from a URL to a specified destination."""
-    with httpx.stream("GET", url) as response:
-        response.raise_for_status()
-        with open(dest, "wb") as f:
-            for chunk in response.iter_bytes():
-                f.write(chunk)
+class ChecksumError(Exception):
+    pass
+
+
+def download_file(url: str, dest: Path, sha256: str | None = None, download: Download | None = None) -> None:
+    """Downloads a file from a URL to a specified destination.
+
+    The data is written to a `.part` file first, which is renamed to the destination once the download is complete
+    and matches the SHA-256 checksum, if given. Downloads which have been interrupted are resumed from the `.part`
+    file if the server supports range requests. A download which does not match the checksum is deleted and
+    downloaded once more from the start, as the `.part` file it was resumed from may not have been valid. The
+    progress is reported to `download`, if given.
+    """
+    download = download or Download(dest)
+    try:
+        try:
+            _download_file(url, dest, sha256, download)
+        except ChecksumError as e:
+            print(f"{e}, downloading it again")
+            _download_file(url, dest, sha256, download)
+    except BaseException as e:
+        download.finish(e)
+        raise
+    download.finish()
     print(f"Downloaded {url} to {dest}")
+    if CACHE is not None:
+        CACHE.add(dest)
+        for name in CACHE.evict(keep=[dest]):
+            print(f"Evicted {name}")
+
+
+def _download_file(url: str, dest: Path, sha256: str | None, download: Download) -> None:
+    part = download.part
+    digest = hashlib.sha256()
+    offset = part.stat().st_size if part.exists() else 0
+    if offset:
+        with open(part, "rb") as f:
+            hashlib.file_digest(f, lambda: digest)
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with httpx.stream("GET", url, headers=headers, follow_redirects=True) as response:
+        if response.status_code == httpx.codes.REQUESTED_RANGE_NOT_SATISFIABLE:
+            # the part is complete already
+            download.start(offset, offset)
+        else:
+            response.raise_for_status()
+            if response.status_code != httpx.codes.PARTIAL_CONTENT:
+                # the server sends the whole file
+                offset = 0
+                digest = hashlib.sha256()
+            elif offset:
+                print(f"Resuming download of {url} at {offset} bytes")
+            length = response.headers.get("Content-Length")
+            with open(part, "r+b" if offset else "wb") as f:
+                f.seek(offset)
+                download.start(offset, offset + int(length) if length is not None else None)
+                for chunk in response.iter_bytes():
+                    f.write(chunk)
+                    # followers read the data from the file
+                    f.flush()
+                    digest.update(chunk)
+                    offset += len(chunk)
+                    download.progress(offset)
+    if sha256 is not None and digest.hexdigest() != sha256.lower():
+        part.unlink()
+        raise ChecksumError(f"{url} has SHA-256 {digest.hexdigest()} instead of {sha256}")
+    os.replace(part, dest)
+
+
+def download_files(downloads: list[tuple[str, Path, str | None]]) -> None:
+    """Downloads files concurrently with up to DOWNLOAD_WORKERS at a time, raising the first error once all
+    downloads have finished."""
+    with ThreadPoolExecutor(DOWNLOAD_WORKERS) as executor:
+        futures = [
+            executor.submit(download_file, url, dest, sha256, DOWNLOADS.register(dest))
+            for url, dest, sha256 in downloads
+        ]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    for error in errors:
+        print(f"Download failed: {error}")
+    if errors:
+        raise errors[0]  # type: ignore[misc]
 
 
 def load_artifacts(file_path: Path) -> list[dict[str, str]]:
@@ -33,20 +121,201 @@ def load_artifacts(file_path: Path) -> list[dict[str, str]]:
     return data.get("artifacts", [])
 
 
-def download_artifacts(artifacts: list[dict[str, str]]) -> None:
-    """Downloads all artifacts defined in the YAML file."""
+def artifact_downloads(artifacts: list[dict[str, str]]) -> list[tuple[str, Path, str | None]]:
+    """Returns the artifacts defined in the YAML file which have to be downloaded, registering them so that they
+    can be served while they are being downloaded."""
+    downloads: list[tuple[str, Path, str | None]] = []
     for artifact in artifacts:
         url = artifact["url"]
         filename = url.split("/")[-1]
         dest_path = ARTIFACTS_DIR / filename
         if not dest_path.exists():
             print(f"Downloading {filename}...")
-            download_file(url, dest_path)
+            downloads.append((url, dest_path, artifact.get("sha256")))
+            DOWNLOADS.register(dest_path)
         else:
             print(f"{filename} already exists, skipping download.")
+    return downloads
 
 
-httpd: HTTPServer | None = None
+def decompressed_path(artifact: dict) -> Path | None:
+    """Returns where the decompressed image of an artifact with `decompress` enabled is stored: block devices can
+    only be read on demand from images which are not compressed."""
+    if not artifact.get("decompress"):
+        return None
+    return ARTIFACTS_DIR / artifact["url"].split("/")[-1].removesuffix(".gz")
+
+
+def artifact_decompressions(artifacts: list[dict]) -> list[tuple[Path, Path]]:
+    """Returns the compressed artifacts and their decompressed paths which have to be decompressed, registering
+    them so that they can be served while they are being decompressed."""
+    decompressions = []
+    for artifact in artifacts:
+        dest_path = decompressed_path(artifact)
+        if dest_path is not None and not dest_path.exists():
+            decompressions.append((ARTIFACTS_DIR / artifact["url"].split("/")[-1], dest_path))
+            DOWNLOADS.register(dest_path)
+    return decompressions
+
+
+def decompress_file(src: Path, dest: Path, download: Download) -> None:
+    """Decompresses a gzip file like gunzip does, which ignores data trailing the gzip stream: OpenWrt appends
+    metadata to its images."""
+    try:
+        decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        with open(src, "rb") as f, open(download.part, "wb") as output:
+            download.start(0, None)
+            written = 0
+            while not decompressor.eof and (data := f.read(CHUNK_SIZE)):
+                while data and not decompressor.eof:
+                    chunk = decompressor.decompress(data, CHUNK_SIZE)
+                    output.write(chunk)
+                    output.flush()
+                    written += len(chunk)
+                    download.progress(written)
+                    data = decompressor.unconsumed_tail
+        if not decompressor.eof:
+            raise zlib.error(f"{src} is truncated")
+        os.replace(download.part, dest)
+    except BaseException as e:
+        download.part.unlink(missing_ok=True)
+        download.finish(e)
+        raise
+    download.finish()
+    print(f"Decompressed {src} to {dest}")
+    if CACHE is not None:
+        CACHE.add(dest)
+        for name in CACHE.evict(keep=[src, dest]):
+            print(f"Evicted {name}")
+
+
+def download_in_background(
+    downloads: list[tuple[str, Path, str | None]], decompressions: list[tuple[Path, Path]], feeds: list[dict]
+) -> None:
+    """Downloads the artifacts and mirrors the feeds while they are served already. Failed downloads are reported
+    by their /_ready endpoint."""
+    try:
+        download_files(downloads)
+    except Exception as e:
+        print(f"Downloading artifacts failed: {e}")
+    for src, dest in decompressions:
+        try:
+            decompress_file(src, dest, DOWNLOADS.register(dest))
+        except Exception as e:
+            print(f"Decompressing {src} failed: {e}")
+    try:
+        mirror_feeds(feeds)
+    except Exception as e:
+        print(f"Mirroring feeds failed: {e}")
+
+
+def load_feeds(file_path: Path) -> list[dict]:
+    """Loads the opkg feeds to mirror from a YAML file."""
+    with open(file_path) as f:
+        data = yaml.safe_load(f)
+    return data.get("feeds", [])
+
+
+def feed_path(url: str) -> Path:
+    """Returns where a feed is mirrored: the path of its URL below FEEDS_DIR, so that only the host of the feed
+    URLs in distfeeds.conf has to be replaced to use the mirror."""
+    return FEEDS_DIR / urlsplit(url).path.strip("/")
+
+
+def parse_packages_index(text: str) -> dict[str, dict[str, str]]:
+    """Parses an opkg Packages index into its stanzas, indexed by package name and the names they provide."""
+    packages: dict[str, dict[str, str]] = {}
+    for stanza in re.split(r"\n\s*\n", text):
+        fields = dict(re.findall(r"^([\w-]+): ?(.*)$", stanza, re.MULTILINE))
+        if "Package" not in fields:
+            continue
+        for name in [fields["Package"], *re.split(r",\s*", fields.get("Provides", ""))]:
+            if name:
+                packages.setdefault(name.split()[0], fields)
+    return packages
+
+
+def dependencies(fields: dict[str, str]) -> list[str]:
+    """Returns the package names from a Depends field, e.g. `libc, libopenssl3 (>= 3.0), a | b`"""
+    names = []
+    for dependency in re.split(r",\s*", fields.get("Depends", "")):
+        # of alternatives, the first one is mirrored
+        name = dependency.split("|")[0].split("(")[0].strip()
+        if name:
+            names.append(name)
+    return names
+
+
+def mirror_feed_index(url: str) -> dict[str, dict[str, str]]:
+    dest_dir = feed_path(url)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    index_path = dest_dir / "Packages.gz"
+    if not index_path.exists():
+        download_file(f"{url}/Packages.gz", index_path)
+        # opkg verifies the index with its signature if check_signature is enabled
+        try:
+            download_file(f"{url}/Packages.sig", dest_dir / "Packages.sig")
+        except httpx.HTTPStatusError:
+            print(f"{url} has no signature")
+    with gzip.open(index_path, "rt", encoding="utf-8") as f:
+        return parse_packages_index(f.read())
+
+
+def mirror_feeds(feeds: list[dict]) -> None:
+    """Mirrors the indexes of the declared opkg feeds along with the declared packages and their dependencies."""
+    downloads: list[tuple[str, Path, str | None]] = []
+    for feed in feeds:
+        indexes = {url: mirror_feed_index(url) for url in feed["urls"]}
+        pending = list(feed.get("packages", []))
+        mirrored: set[str] = set()
+        while pending:
+            name = pending.pop()
+            found = next(((url, index[name]) for url, index in indexes.items() if name in index), None)
+            if found is None:
+                print(f"{name} is not in the feeds of {feed['name']}, skipping.")
+                continue
+            url, fields = found
+            if fields["Package"] in mirrored:
+                continue
+            mirrored.add(fields["Package"])
+            pending.extend(dependencies(fields))
+            dest_path = feed_path(url) / fields["Filename"]
+            if not dest_path.exists():
+                print(f"Downloading {fields['Filename']}...")
+                downloads.append((f"{url}/{fields['Filename']}", dest_path, fields.get("SHA256sum")))
+        print(f"Mirroring {len(mirrored)} packages of {feed['name']}.")
+    download_files(downloads)
+
+
+def pinned_names(artifacts: list[dict], feeds: list[dict]) -> list[str]:
+    """Returns the names of the declared artifacts, including their decompressed images, and the directories of the
+    feeds which are declared as `pinned`. Only artifacts which are no longer declared and feeds which are not pinned
+    are evicted."""
+    names = [artifact["url"].split("/")[-1] for artifact in artifacts]
+    names += [
+        path.relative_to(ARTIFACTS_DIR).as_posix()
+        for artifact in artifacts
+        if (path := decompressed_path(artifact)) is not None
+    ]
+    names += [
+        feed_path(url).relative_to(ARTIFACTS_DIR).as_posix()
+        for feed in feeds
+        if feed.get("pinned")
+        for url in feed["urls"]
+    ]
+    return names
+
+
+def feed_units(feeds: list[dict]) -> list[str]:
+    """Returns the directories of the declared feeds and of the ones mirrored before, which are evicted as a whole:
+    an index without the packages it refers to makes opkg fail."""
+    directories = {feed_path(url) for feed in feeds for url in feed["urls"]}
+    directories.update(index.parent for index in FEEDS_DIR.rglob("Packages.gz"))
+    return [directory.relative_to(ARTIFACTS_DIR).as_posix() for directory in directories]
+
+
+CACHE: CacheIndex | None = None
+httpd: ArtifactServer | None = None
 
 
 def shutdown_server(signum: int, frame: FrameType) -> None:
@@ -57,23 +326,34 @@ def shutdown_server(signum: int, frame: FrameType) -> None:
 
 
 def main() -> None:
-    global httpd
+    global CACHE, httpd
 
     artifacts = load_artifacts(ARTIFACTS_FILE)
-    download_artifacts(artifacts)
+    feeds = load_feeds(ARTIFACTS_FILE)
+    CACHE = CacheIndex(
+        ARTIFACTS_DIR, CACHE_BUDGET, pinned_names(artifacts, feeds), feed_units(feeds), in_progress=DOWNLOADS.pending
+    )
+    for name in CACHE.evict():
+        print(f"Evicted {name}")
+    downloads = artifact_downloads(artifacts)
+    decompressions = artifact_decompressions(artifacts)
 
     # Set up signal handlers for TERM and INT signals
     signal.signal(signal.SIGTERM, shutdown_server)
     signal.signal(signal.SIGINT, shutdown_server)
 
-    os.chdir(ARTIFACTS_DIR)
     print(f"Serving files from {ARTIFACTS_DIR} on port {LISTEN_ADDR}:{LISTEN_PORT}")
-    httpd = HTTPServer((LISTEN_ADDR, LISTEN_PORT), SimpleHTTPRequestHandler)
+    httpd = ArtifactServer(
+        (LISTEN_ADDR, LISTEN_PORT), ARTIFACTS_DIR, max_connections=MAX_CONNECTIONS, downloads=DOWNLOADS, cache=CACHE
+    )
 
     # Start the HTTP server in a separate thread
     server_thread = threading.Thread(target=httpd.serve_forever, daemon=True)
     server_thread.start()
 
+    # artifacts which are cached already can be fetched right away, the others while they are downloaded
+    threading.Thread(target=download_in_background, args=(downloads, decompressions, feeds), daemon=True).start()
+
     # Keep the main thread alive to handle server shutdown
     try:
         server_thread.join()
@@ -0,0 +1,194 @@
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+INDEX_NAME = ".cache-index.json"
+TEMP_PREFIX = ".tmp"
+
+
+@dataclass
+class Entry:
+    size: int
+    last_access: float
+
+
+def _is_below(name: str, directory: str) -> bool:
+    return name == directory or name.startswith(f"{directory}/")
+
+
+class CacheIndex:
+    """Tracks the size and last access of the files in a directory and evicts the least recently used ones when
+    they exceed a budget of `budget` bytes (0 for no limit).
+
+    Pinned files, or all files below pinned directories, are never evicted. The files below one of the `units`
+    directories are evicted together, e.g. an opkg feed whose index refers to its packages, and were last accessed
+    when the most recent of them was. Files which are being read, see :meth:`reading`, and files below directories
+    returned by `in_progress`, e.g. the ones being downloaded, are not evicted either.
+
+    The index is kept in a file inside the directory, so that the access order survives restarts; partially
+    downloaded `.part` files are not part of the cache.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        budget: int = 0,
+        pinned: Iterable[str] = (),
+        units: Iterable[str] = (),
+        in_progress: Callable[[], Iterable[str]] = tuple,
+    ) -> None:
+        self.directory = directory
+        self.budget = budget
+        self.pinned = set(pinned)
+        self.units = set(units)
+        self.in_progress = in_progress
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self._lock = threading.Lock()
+        self._entries: dict[str, Entry] = {}
+        self._readers: Counter[str] = Counter()
+        self._load()
+        self.scan()
+
+    @property
+    def index_path(self) -> Path:
+        return self.directory / INDEX_NAME
+
+    def _load(self) -> None:
+        try:
+            entries = json.loads(self.index_path.read_text())
+            self._entries = {name: Entry(**entry) for name, entry in entries.items()}
+        except (OSError, ValueError, TypeError):
+            self._entries = {}
+
+    def _store(self) -> None:
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=self.directory, prefix=TEMP_PREFIX, delete=False) as f:
+                json.dump({name: asdict(entry) for name, entry in self._entries.items()}, f)
+            os.replace(f.name, self.index_path)
+        except OSError:
+            pass  # the access order is lost on restart only
+
+    def _name(self, path: Path) -> str:
+        return path.relative_to(self.directory).as_posix()
+
+    def scan(self) -> None:
+        """Adds files which are not in the index yet and drops entries of files which are gone"""
+        found: dict[str, int] = {}
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                path = Path(root) / filename
+                if filename.endswith(".part") or path == self.index_path or filename.startswith(TEMP_PREFIX):
+                    continue
+                found[self._name(path)] = path.stat().st_size
+        with self._lock:
+            self._entries = {
+                name: Entry(size, self._entries[name].last_access if name in self._entries else time.time())
+                for name, size in found.items()
+            }
+            self._store()
+
+    def add(self, path: Path) -> None:
+        with self._lock:
+            self._entries[self._name(path)] = Entry(path.stat().st_size, time.time())
+            self._store()
+
+    def hit(self, name: str) -> None:
+        """Records that a file has been served; files which are not part of the cache are not counted"""
+        with self._lock:
+            entry = self._entries.get(name.strip("/"))
+            if entry is None:
+                return
+            self.hits += 1
+            entry.last_access = time.time()
+            self._store()
+
+    def miss(self) -> None:
+        with self._lock:
+            self.misses += 1
+
+    @contextlib.contextmanager
+    def reading(self, name: str) -> Iterator[None]:
+        """Keeps a file from being evicted while it is read"""
+        name = name.strip("/")
+        with self._lock:
+            self._readers[name] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._readers[name] -= 1
+                if not self._readers[name]:
+                    del self._readers[name]
+
+    def is_pinned(self, name: str) -> bool:
+        return any(_is_below(name, pinned) for pinned in self.pinned)
+
+    def _unit(self, name: str) -> str:
+        return max((unit for unit in self.units if _is_below(name, unit)), key=len, default=name)
+
+    @property
+    def size(self) -> int:
+        return sum(entry.size for entry in self._entries.values())
+
+    def evict(self, keep: Iterable[Path] = ()) -> list[str]:
+        """Removes the least recently used files or units which are not pinned or in use until the cache fits into
+        the budget and returns their names. The files in `keep`, e.g. the ones just downloaded, are not evicted
+        either."""
+        if not self.budget:
+            return []
+        busy = [self._name(path) for path in keep] + [name.strip("/") for name in self.in_progress()]
+        evicted = []
+        with self._lock:
+            busy += self._readers
+            size = self.size
+            units: dict[str, list[str]] = {}
+            for name in self._entries:
+                units.setdefault(self._unit(name), []).append(name)
+            candidates = sorted(
+                (
+                    (unit, names)
+                    for unit, names in units.items()
+                    if not any(self.is_pinned(name) for name in names)
+                    and not any(_is_below(name, unit) for name in busy)
+                ),
+                key=lambda item: max(self._entries[name].last_access for name in item[1]),
+            )
+            for unit, names in candidates:
+                if size <= self.budget:
+                    break
+                for name in names:
+                    (self.directory / name).unlink(missing_ok=True)
+                    entry = self._entries.pop(name)
+                    size -= entry.size
+                    self.evicted_bytes += entry.size
+                if unit in self.units:
+                    with contextlib.suppress(OSError):
+                        (self.directory / unit).rmdir()
+                self.evictions += 1
+                evicted.append(unit)
+            if evicted:
+                self._store()
+        return evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size": self.size,
+                "budget": self.budget,
+                "pinned": sorted(self.pinned),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+            }
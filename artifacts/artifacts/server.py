@@ -0,0 +1,378 @@
+import contextlib
+import email.utils
+import json
+import os
+import re
+import socket
+import threading
+import urllib.parse
+from functools import partial
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import BinaryIO
+
+from cache import CacheIndex
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+READY_PREFIX = "/_ready"
+STATS_PATH = "/_stats"
+# seconds a request for a file waits for its download to start, e.g. behind other downloads, before it is answered
+# with 503 and a Retry-After of RETRY_AFTER seconds
+DOWNLOAD_START_TIMEOUT = 10.0
+RETRY_AFTER = 2
+
+
+class Download:
+    """Progress of a file which is being downloaded to `<path>.part` and renamed to `path` once complete"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.part = path.with_name(f"{path.name}.part")
+        self.size: int | None = None
+        self.written = 0
+        self.started = False
+        # incremented whenever the download starts over, which invalidates the data read by followers
+        self.attempt = 0
+        self.done = False
+        self.error: BaseException | None = None
+        self._condition = threading.Condition()
+
+    def start(self, written: int, size: int | None) -> None:
+        """Called once the part file has been opened, `written` bytes of it being valid data already"""
+        with self._condition:
+            self.written = written
+            self.size = size
+            self.started = True
+            self.attempt += 1
+            self._condition.notify_all()
+
+    def progress(self, written: int) -> None:
+        with self._condition:
+            self.written = written
+            self._condition.notify_all()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        with self._condition:
+            self.done = True
+            self.error = error
+            self._condition.notify_all()
+
+    def wait(self, written: int, timeout: float | None = None) -> None:
+        """Waits until more than `written` bytes are available or the download has finished"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.done or (self.started and self.written > written), timeout)
+
+    @property
+    def ready(self) -> bool:
+        return self.done and self.error is None
+
+
+class Downloads:
+    """The files which are downloaded while they are being served, by their path relative to the served directory"""
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self._downloads: dict[str, Download] = {}
+        self._lock = threading.Lock()
+
+    def register(self, path: Path) -> Download:
+        name = path.relative_to(self.directory).as_posix()
+        with self._lock:
+            if name not in self._downloads:
+                self._downloads[name] = Download(path)
+            return self._downloads[name]
+
+    def get(self, name: str) -> Download | None:
+        with self._lock:
+            return self._downloads.get(name.strip("/"))
+
+    def pending(self) -> list[str]:
+        with self._lock:
+            return [name for name, download in self._downloads.items() if not download.done]
+
+
+def make_etag(stat: os.stat_result) -> str:
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """Parses a Range header with a single byte range into the offset and length of the range.
+
+    Returns None if the header should be ignored, i.e. the whole file is served, and raises ValueError if the range
+    cannot be satisfied.
+    """
+    m = RANGE_PATTERN.fullmatch(header.strip())
+    if m is None:
+        # multiple ranges are not supported, serving the whole file is allowed then
+        return None
+    first, last = m.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # the last n bytes
+        length = min(int(last), size)
+        if length == 0:
+            raise ValueError(header)
+        return size - length, length
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end - start + 1
+
+
+class ArtifactRequestHandler(SimpleHTTPRequestHandler):
+    """Serves files with support for byte ranges and conditional requests, sending their data with sendfile()"""
+
+    protocol_version = "HTTP/1.1"
+    # set by the server, if files are served while they are being downloaded
+    downloads: Downloads | None = None
+    # set by the server, if the served directory is a cache with a size budget
+    cache: CacheIndex | None = None
+
+    def send_file_head(self) -> tuple[BinaryIO, int, int] | None:
+        """Sends the headers for a file and returns the opened file with the offset and length of the data to
+        send, or None if there is no body to send."""
+        try:
+            f = open(self.translate_path(self.path), "rb")  # noqa: SIM115
+        except OSError:
+            if self.cache is not None:
+                self.cache.miss()
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        try:
+            return self._send_file_head(f)
+        except BaseException:
+            f.close()
+            raise
+
+    def _send_file_head(self, f: BinaryIO) -> tuple[BinaryIO, int, int] | None:
+        stat = os.fstat(f.fileno())
+        etag = make_etag(stat)
+        if self._not_modified(stat, etag):
+            f.close()
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return None
+
+        size = stat.st_size
+        offset, length = 0, size
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header and (if_range is None or if_range == etag):
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                f.close()
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            if byte_range is not None:
+                offset, length = byte_range
+
+        if length != size:
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header("Content-Range", f"bytes {offset}-{offset + length - 1}/{size}")
+        else:
+            self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", self.guess_type(f.name))
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.date_time_string(int(stat.st_mtime)))
+        self.end_headers()
+        return f, offset, length
+
+    def _not_modified(self, stat: os.stat_result, etag: str) -> bool:
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return int(stat.st_mtime) <= since.timestamp()
+        return False
+
+    def send_file_body(self, f: BinaryIO, offset: int, length: int) -> None:
+        self.wfile.flush()
+        # sendfile() copies the data in the kernel, without passing it through Python buffers
+        self.connection.sendfile(f, offset, length)
+
+    def _url_path(self) -> str:
+        return urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+
+    def _reading(self) -> contextlib.AbstractContextManager:
+        """Keeps the requested file from being evicted from the cache while it is served"""
+        return self.cache.reading(self._url_path()) if self.cache is not None else contextlib.nullcontext()
+
+    def _download_in_progress(self) -> Download | None:
+        """Returns the download of the requested file if it is in progress, after waiting a while for it to start"""
+        if self.downloads is None:
+            return None
+        download = self.downloads.get(self._url_path())
+        if download is None or download.done:
+            return None
+        download.wait(0, DOWNLOAD_START_TIMEOUT)
+        if download.done:
+            # the download failed or completed in the meantime
+            return None
+        return download
+
+    def send_ready(self) -> None:
+        """Reports whether the artifact after /_ready/ is available completely, or all artifacts for /_ready"""
+        name = self._url_path().removeprefix(READY_PREFIX).strip("/")
+        if not name:
+            pending = self.downloads.pending() if self.downloads else []
+            status = HTTPStatus.SERVICE_UNAVAILABLE if pending else HTTPStatus.OK
+            body = "".join(f"{name}\n" for name in pending) or "ready\n"
+        else:
+            download = self.downloads.get(name) if self.downloads else None
+            path = Path(self.translate_path(f"/{name}"))
+            if download is not None and download.error is not None:
+                status, body = HTTPStatus.INTERNAL_SERVER_ERROR, f"{download.error}\n"
+            elif download is not None and not download.done:
+                status, body = HTTPStatus.SERVICE_UNAVAILABLE, f"{download.written}/{download.size or '?'}\n"
+            elif path.is_file():
+                status, body = HTTPStatus.OK, "ready\n"
+            else:
+                status, body = HTTPStatus.NOT_FOUND, "unknown\n"
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def send_stats(self) -> None:
+        data = json.dumps(self.cache.stats() if self.cache else {}).encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def send_download_head(self, download: Download) -> tuple[BinaryIO, int] | None:
+        """Sends the headers for a file which is still being downloaded and returns its part file along with the
+        attempt of the download it belongs to, or None if the download has not started yet"""
+        if self.cache is not None:
+            self.cache.miss()
+        if not download.started:
+            self.send_response(HTTPStatus.SERVICE_UNAVAILABLE)
+            self.send_header("Retry-After", str(RETRY_AFTER))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        attempt = download.attempt
+        f = open(download.part, "rb")  # noqa: SIM115
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", self.guess_type(str(download.path)))
+        if download.size is not None:
+            self.send_header("Content-Length", str(download.size))
+        else:
+            self.close_connection = True
+        self.end_headers()
+        return f, attempt
+
+    def send_download_body(self, f: BinaryIO, attempt: int, download: Download) -> None:
+        """Sends the data of a file as it is downloaded. The part file stays readable when it is renamed after the
+        download, a failed download or one which starts over closes the connection before the data is complete."""
+        sent = 0
+        while True:
+            download.wait(sent)
+            if download.error is not None or download.attempt != attempt:
+                self.close_connection = True
+                return
+            written = download.written
+            if written > sent:
+                self.send_file_body(f, sent, written - sent)
+                sent = written
+            elif download.done:
+                return
+
+    def _is_directory(self) -> bool:
+        path = self.translate_path(self.path)
+        return os.path.isdir(path) or path.endswith("/")
+
+    def do_GET(self) -> None:
+        if self._url_path().startswith(READY_PREFIX):
+            self.send_ready()
+            return
+        if self._url_path() == STATS_PATH:
+            self.send_stats()
+            return
+        if (download := self._download_in_progress()) is not None:
+            if (head := self.send_download_head(download)) is not None:
+                f, attempt = head
+                with f:
+                    self.send_download_body(f, attempt, download)
+            return
+        if self._is_directory():
+            # directory listings are served by SimpleHTTPRequestHandler
+            super().do_GET()
+            return
+        with self._reading():
+            head = self.send_file_head()
+            if head is not None:
+                f, offset, length = head
+                with f:
+                    self.send_file_body(f, offset, length)
+                # only files whose data has been sent count as hits, not the ones which have not been modified
+                if self.cache is not None:
+                    self.cache.hit(self._url_path())
+
+    def do_HEAD(self) -> None:
+        if self._url_path().startswith(READY_PREFIX):
+            self.send_ready()
+            return
+        if self._url_path() == STATS_PATH:
+            self.send_stats()
+            return
+        if (download := self._download_in_progress()) is not None:
+            if (head := self.send_download_head(download)) is not None:
+                head[0].close()
+            return
+        if self._is_directory():
+            super().do_HEAD()
+            return
+        head = self.send_file_head()
+        if head is not None:
+            head[0].close()
+
+
+class ArtifactServer(ThreadingHTTPServer):
+    """Serves each connection in its own thread, with at most `max_connections` of them being served at a time.
+    Further connections are accepted but wait for a free slot.
+
+    Files which are registered in `downloads` are served while they are being downloaded, following the data as
+    it is written; requests for a download which has not started are answered with 503 and Retry-After.
+    /_ready/<path> tells whether a file has been downloaded completely. With a `cache`, the accesses of files are
+    recorded for its LRU eviction and /_stats reports its statistics.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        directory: Path,
+        max_connections: int = 32,
+        downloads: Downloads | None = None,
+        cache: CacheIndex | None = None,
+    ) -> None:
+        self._slots = threading.BoundedSemaphore(max_connections)
+        handler = type("Handler", (ArtifactRequestHandler,), {"downloads": downloads, "cache": cache})
+        super().__init__(address, partial(handler, directory=str(directory)))
+
+    def process_request_thread(self, request: socket.socket, client_address: tuple[str, int]) -> None:
+        with self._slots:
+            super().process_request_thread(request, client_address)
@@ -0,0 +1,83 @@
+"""Measures the download throughput of the artifacts server with concurrent clients.
+
+Compares the ArtifactServer with the single-threaded HTTPServer and SimpleHTTPRequestHandler it replaced, e.g.:
+
+    python artifacts/benchmark.py --clients 8 --size 64 --rate 50
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).parent / "artifacts"))
+from server import ArtifactServer  # noqa: E402
+
+
+def download(url: str, rate: float) -> int:
+    """Downloads a file, reading at most `rate` MiB/s like a client behind a slower network link would"""
+    size = 0
+    with httpx.stream("GET", url, timeout=60) as response:
+        response.raise_for_status()
+        start = time.monotonic()
+        for chunk in response.iter_bytes(1 << 20):
+            size += len(chunk)
+            if rate:
+                time.sleep(max(0.0, size / (rate * (1 << 20)) - (time.monotonic() - start)))
+    return size
+
+
+def measure(
+    create_server: Callable[[Path], HTTPServer], directory: Path, clients: int, requests: int, rate: float
+) -> float:
+    httpd = create_server(directory)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{httpd.server_address[1]}/image.img"
+    try:
+        start = time.monotonic()
+        with ProcessPoolExecutor(clients) as executor:
+            size = sum(executor.map(download, [url] * requests, [rate] * requests))
+        return size / (time.monotonic() - start)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=16, help="number of downloads")
+    parser.add_argument("--size", type=int, default=64, help="size of the served file in MiB")
+    parser.add_argument("--rate", type=float, default=50, help="download rate of each client in MiB/s, 0 for unlimited")
+    args = parser.parse_args()
+
+    # the access log would only measure the terminal
+    SimpleHTTPRequestHandler.log_message = lambda *_: None  # type: ignore[method-assign]
+
+    servers: dict[str, Callable[[Path], HTTPServer]] = {
+        "HTTPServer": lambda directory: HTTPServer(
+            ("127.0.0.1", 0), partial(SimpleHTTPRequestHandler, directory=str(directory))
+        ),
+        "ArtifactServer": lambda directory: ArtifactServer(("127.0.0.1", 0), directory, max_connections=args.clients),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        with open(directory / "image.img", "wb") as f:
+            for _ in range(args.size):
+                f.write(os.urandom(1 << 20))
+        for name, create_server in servers.items():
+            throughput = measure(create_server, directory, args.clients, args.requests, args.rate)
+            print(f"{name}: {throughput / (1 << 20):.0f} MiB/s")
+
+
+if __name__ == "__main__":
+    main()
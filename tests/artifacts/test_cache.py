@@ -0,0 +1,95 @@
+import json
+from pathlib import Path
+
+import pytest
+from cache import INDEX_NAME, CacheIndex
+
+FILES = {
+    "old.img": 1,
+    "new.img": 4,
+    "pinned.img": 0,
+    "feeds/base/Packages.gz": 5,
+    "feeds/base/libc.ipk": 2,
+}
+
+
+@pytest.fixture
+def directory(tmp_path: Path) -> Path:
+    """A cache of files with 100 bytes each, last accessed at the times in FILES"""
+    for name in FILES:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"\0" * 100)
+    index = {name: {"size": 100, "last_access": last_access} for name, last_access in FILES.items()}
+    (tmp_path / INDEX_NAME).write_text(json.dumps(index))
+    return tmp_path
+
+
+def test_evict_least_recently_used(directory: Path) -> None:
+    cache = CacheIndex(directory, budget=400, pinned=["pinned.img"])
+    assert cache.size == 500
+    assert cache.evict() == ["old.img"]
+    assert not (directory / "old.img").exists()
+    assert cache.evict() == []
+
+    cache.budget = 200
+    assert cache.evict() == ["feeds/base/libc.ipk", "new.img"]
+    assert cache.size == 200
+    assert {path.name for path in directory.rglob("*.*") if path.name != INDEX_NAME} == {"pinned.img", "Packages.gz"}
+
+    # the index is kept for the next start
+    assert CacheIndex(directory).size == 200
+
+
+def test_evict_pinned(directory: Path) -> None:
+    cache = CacheIndex(directory, budget=1, pinned=["pinned.img", "feeds/base"])
+    assert cache.evict(keep=[directory / "old.img"]) == ["new.img"]
+    # the cache stays above its budget rather than evicting pinned or kept files
+    assert cache.size == 400
+
+
+def test_evict_unit(directory: Path) -> None:
+    cache = CacheIndex(directory, budget=300, pinned=["pinned.img"], units=["feeds/base"])
+    # the feed counts as accessed when its index was, after the other files
+    assert cache.evict() == ["old.img", "new.img"]
+    cache.budget = 100
+    assert cache.evict() == ["feeds/base"]
+    assert not (directory / "feeds" / "base").exists()
+    assert cache.stats()["evictions"] == 3
+    assert cache.stats()["evicted_bytes"] == 400
+
+
+def test_evict_in_use(directory: Path) -> None:
+    downloads = ["feeds/base/openvpn.ipk"]
+    cache = CacheIndex(directory, budget=1, pinned=["pinned.img"], units=["feeds/base"], in_progress=lambda: downloads)
+    with cache.reading("/old.img"):
+        assert cache.evict() == ["new.img"]
+    downloads.clear()
+    assert cache.evict() == ["old.img", "feeds/base"]
+
+
+def test_no_budget(directory: Path) -> None:
+    cache = CacheIndex(directory)
+    assert cache.evict() == []
+    assert cache.size == 500
+
+
+def test_stats(directory: Path) -> None:
+    cache = CacheIndex(directory, budget=1000, pinned=["pinned.img"])
+    cache.hit("/old.img")
+    # files which are not part of the cache are no hits
+    cache.hit(f"/{INDEX_NAME}")
+    cache.miss()
+    assert cache.stats() == {
+        "entries": 5,
+        "size": 500,
+        "budget": 1000,
+        "pinned": ["pinned.img"],
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+        "evicted_bytes": 0,
+    }
+    # the hit makes the file the most recently used one
+    cache.budget = 400
+    assert cache.evict() == ["feeds/base/libc.ipk"]
@@ -0,0 +1,131 @@
+import hashlib
+import importlib.util
+import threading
+from collections.abc import Iterator
+from dataclasses import dataclass
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import ModuleType
+
+import pytest
+from server import ArtifactRequestHandler, Download
+
+ARTIFACTS_SRV = Path(__file__).parents[2] / "artifacts" / "artifacts"
+DATA = bytes(range(256)) * 64
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+class RecordingHandler(ArtifactRequestHandler):
+    """Records the Range header of each request"""
+
+    ranges: list[str | None]
+
+    def do_GET(self) -> None:
+        self.ranges.append(self.headers.get("Range"))
+        super().do_GET()
+
+    def log_message(self, *_: object) -> None:
+        pass
+
+
+class RangeIgnoringHandler(SimpleHTTPRequestHandler):
+    """Always sends the whole file, like servers without range support"""
+
+    ranges: list[str | None]
+
+    def do_GET(self) -> None:
+        self.ranges.append(self.headers.get("Range"))
+        super().do_GET()
+
+    def log_message(self, *_: object) -> None:
+        pass
+
+
+@dataclass
+class Upstream:
+    url: str
+    ranges: list[str | None]
+    supports_range: bool
+
+
+@pytest.fixture
+def artifacts_main(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> ModuleType:
+    """The artifacts service, which is run as a directory and thus loaded from its __main__ module"""
+    monkeypatch.setenv("ARTIFACTS_DIR", str(tmp_path / "artifacts"))
+    spec = importlib.util.spec_from_file_location("artifacts_main", ARTIFACTS_SRV / "__main__.py")
+    assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(params=[RecordingHandler, RangeIgnoringHandler])
+def upstream(request: pytest.FixtureRequest, tmp_path: Path) -> Iterator[Upstream]:
+    """Serves DATA and records the Range headers requested"""
+    directory = tmp_path / "upstream"
+    directory.mkdir()
+    (directory / "image.bin").write_bytes(DATA)
+    ranges: list[str | None] = []
+    handler = type("Handler", (request.param,), {"ranges": ranges})
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), partial(handler, directory=str(directory)))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield Upstream(f"http://127.0.0.1:{httpd.server_address[1]}/image.bin", ranges, request.param is RecordingHandler)
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download(artifacts_main: ModuleType, upstream: Upstream, tmp_path: Path) -> None:
+    dest = tmp_path / "image.bin"
+    download = Download(dest)
+    artifacts_main.download_file(upstream.url, dest, SHA256, download)
+    assert dest.read_bytes() == DATA
+    assert not download.part.exists()
+    assert download.ready
+    assert upstream.ranges == [None]
+
+
+def test_download_resume(artifacts_main: ModuleType, upstream: Upstream, tmp_path: Path) -> None:
+    dest = tmp_path / "image.bin"
+    download = Download(dest)
+    download.part.write_bytes(DATA[:1000])
+    artifacts_main.download_file(upstream.url, dest, SHA256, download)
+    # servers which ignore the range send the whole file, which replaces the part
+    assert dest.read_bytes() == DATA
+    assert upstream.ranges == ["bytes=1000-"]
+
+
+def test_download_part_complete(artifacts_main: ModuleType, upstream: Upstream, tmp_path: Path) -> None:
+    dest = tmp_path / "image.bin"
+    download = Download(dest)
+    download.part.write_bytes(DATA)
+    artifacts_main.download_file(upstream.url, dest, SHA256, download)
+    assert dest.read_bytes() == DATA
+    assert not download.part.exists()
+
+
+def test_download_invalid_part(artifacts_main: ModuleType, upstream: Upstream, tmp_path: Path) -> None:
+    dest = tmp_path / "image.bin"
+    download = Download(dest)
+    download.part.write_bytes(b"\0" * 1000)
+    artifacts_main.download_file(upstream.url, dest, SHA256, download)
+    assert dest.read_bytes() == DATA
+    if upstream.supports_range:
+        # the data resumed from the part does not match, so it is deleted and downloaded from the start
+        assert upstream.ranges == ["bytes=1000-", None]
+        assert download.attempt == 2
+    else:
+        # the whole file replaces the part
+        assert upstream.ranges == ["bytes=1000-"]
+
+
+def test_download_checksum_mismatch(artifacts_main: ModuleType, upstream: Upstream, tmp_path: Path) -> None:
+    dest = tmp_path / "image.bin"
+    download = Download(dest)
+    with pytest.raises(artifacts_main.ChecksumError):
+        artifacts_main.download_file(upstream.url, dest, hashlib.sha256(b"other").hexdigest(), download)
+    # the download is retried once from the start
+    assert upstream.ranges == [None, None]
+    assert not dest.exists()
+    assert not download.part.exists()
+    assert isinstance(download.error, artifacts_main.ChecksumError)
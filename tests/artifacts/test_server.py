@@ -0,0 +1,223 @@
+import email.utils
+import os
+import threading
+from collections.abc import Iterator
+from pathlib import Path
+
+import httpx
+import pytest
+import server
+from cache import CacheIndex
+from server import ArtifactServer, Download, Downloads, parse_range
+
+DATA = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def downloads(tmp_path: Path) -> Downloads:
+    return Downloads(tmp_path)
+
+
+@pytest.fixture
+def cache(tmp_path: Path) -> CacheIndex:
+    (tmp_path / "image.bin").write_bytes(DATA)
+    return CacheIndex(tmp_path)
+
+
+@pytest.fixture
+def artifacts(tmp_path: Path, downloads: Downloads, cache: CacheIndex) -> Iterator[httpx.Client]:
+    httpd = ArtifactServer(("127.0.0.1", 0), tmp_path, max_connections=2, downloads=downloads, cache=cache)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    with httpx.Client(base_url=f"http://127.0.0.1:{httpd.server_address[1]}") as client:
+        yield client
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.mark.parametrize(
+    "header,byte_range",
+    [
+        ("bytes=0-0", (0, 1)),
+        ("bytes=0-", (0, 1024)),
+        ("bytes=1000-", (1000, 24)),
+        ("bytes=1000-2000", (1000, 24)),
+        ("bytes=-24", (1000, 24)),
+        # a suffix longer than the file selects all of it
+        ("bytes=-2000", (0, 1024)),
+        # multiple ranges and other units are ignored
+        ("bytes=0-1,4-5", None),
+        ("bytes=-", None),
+        ("items=0-1", None),
+    ],
+)
+def test_parse_range(header: str, byte_range: tuple[int, int] | None) -> None:
+    assert parse_range(header, 1024) == byte_range
+
+
+@pytest.mark.parametrize("header", ["bytes=1024-", "bytes=2000-3000", "bytes=-0", "bytes=10-9"])
+def test_parse_range_unsatisfiable(header: str) -> None:
+    with pytest.raises(ValueError):
+        parse_range(header, 1024)
+
+
+def test_get(artifacts: httpx.Client) -> None:
+    response = artifacts.get("/image.bin")
+    assert response.status_code == 200
+    assert response.content == DATA
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["ETag"]
+
+    response = artifacts.head("/image.bin")
+    assert response.status_code == 200
+    assert response.headers["Content-Length"] == str(len(DATA))
+    assert response.content == b""
+
+    assert artifacts.get("/missing.bin").status_code == 404
+
+
+def test_get_range(artifacts: httpx.Client) -> None:
+    response = artifacts.get("/image.bin", headers={"Range": "bytes=0-0"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 0-0/1024"
+    assert response.content == DATA[:1]
+
+    response = artifacts.get("/image.bin", headers={"Range": "bytes=-16"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 1008-1023/1024"
+    assert response.content == DATA[-16:]
+
+    response = artifacts.get("/image.bin", headers={"Range": "bytes=1024-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */1024"
+
+    # the connection is kept alive across all of these responses
+    assert artifacts.get("/image.bin").content == DATA
+
+
+def test_if_range(artifacts: httpx.Client) -> None:
+    etag = artifacts.head("/image.bin").headers["ETag"]
+    response = artifacts.get("/image.bin", headers={"Range": "bytes=512-", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.content == DATA[512:]
+
+    # the file has changed, so all of it is sent
+    response = artifacts.get("/image.bin", headers={"Range": "bytes=512-", "If-Range": '"changed"'})
+    assert response.status_code == 200
+    assert response.content == DATA
+
+
+def test_if_none_match(artifacts: httpx.Client) -> None:
+    etag = artifacts.head("/image.bin").headers["ETag"]
+    response = artifacts.get("/image.bin", headers={"If-None-Match": f'"other", {etag}'})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert artifacts.get("/image.bin", headers={"If-None-Match": "*"}).status_code == 304
+    assert artifacts.get("/image.bin", headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_if_modified_since(artifacts: httpx.Client) -> None:
+    last_modified = artifacts.head("/image.bin").headers["Last-Modified"]
+    assert artifacts.get("/image.bin", headers={"If-Modified-Since": last_modified}).status_code == 304
+
+    earlier = email.utils.format_datetime(email.utils.parsedate_to_datetime(last_modified).replace(year=2000))
+    assert artifacts.get("/image.bin", headers={"If-Modified-Since": earlier}).status_code == 200
+    assert artifacts.get("/image.bin", headers={"If-Modified-Since": "yesterday"}).status_code == 200
+
+    # If-None-Match takes precedence
+    headers = {"If-Modified-Since": last_modified, "If-None-Match": '"other"'}
+    assert artifacts.get("/image.bin", headers=headers).status_code == 200
+
+
+def complete(download: Download) -> None:
+    with open(download.part, "ab") as f:
+        f.write(DATA[download.written :])
+    download.progress(len(DATA))
+    os.replace(download.part, download.path)
+    download.finish()
+
+
+def test_serve_while_downloading(artifacts: httpx.Client, downloads: Downloads, tmp_path: Path) -> None:
+    download = downloads.register(tmp_path / "pending.bin")
+    download.part.write_bytes(DATA[:512])
+    download.start(512, len(DATA))
+    response = artifacts.get("/_ready/pending.bin")
+    assert (response.status_code, response.text) == (503, "512/1024\n")
+    assert artifacts.get("/_ready").text == "pending.bin\n"
+
+    threading.Timer(0.2, complete, args=(download,)).start()
+    response = artifacts.get("/pending.bin")
+    assert response.status_code == 200
+    assert response.content == DATA
+    assert (response := artifacts.get("/_ready/pending.bin")).status_code == 200
+    assert response.text == "ready\n"
+    assert artifacts.get("/_ready").status_code == 200
+
+    # the complete file supports ranges
+    assert artifacts.get("/pending.bin", headers={"Range": "bytes=-1"}).content == DATA[-1:]
+
+
+def test_serve_failed_download(artifacts: httpx.Client, downloads: Downloads, tmp_path: Path) -> None:
+    download = downloads.register(tmp_path / "pending.bin")
+    download.part.write_bytes(DATA[:512])
+    download.start(512, len(DATA))
+    threading.Timer(0.2, download.finish, args=(OSError("connection reset"),)).start()
+    # the connection is closed before all of the announced data has been sent
+    with pytest.raises(httpx.RemoteProtocolError):
+        artifacts.get("/pending.bin")
+    response = artifacts.get("/_ready/pending.bin")
+    assert (response.status_code, response.text) == (500, "connection reset\n")
+    assert artifacts.get("/pending.bin").status_code == 404
+
+
+def test_serve_restarted_download(artifacts: httpx.Client, downloads: Downloads, tmp_path: Path) -> None:
+    download = downloads.register(tmp_path / "pending.bin")
+    download.part.write_bytes(DATA[:512])
+    download.start(512, len(DATA))
+
+    def restart() -> None:
+        download.part.write_bytes(DATA[:768])
+        download.start(768, len(DATA))
+
+    threading.Timer(0.2, restart).start()
+    # the data sent already may not match the new attempt
+    with pytest.raises(httpx.RemoteProtocolError):
+        artifacts.get("/pending.bin")
+
+
+def test_serve_download_not_started(
+    artifacts: httpx.Client, downloads: Downloads, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(server, "DOWNLOAD_START_TIMEOUT", 0.1)
+    download = downloads.register(tmp_path / "pending.bin")
+    response = artifacts.get("/pending.bin")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(server.RETRY_AFTER)
+    assert artifacts.head("/pending.bin").status_code == 503
+    assert artifacts.get("/_ready/pending.bin").text == "0/?\n"
+
+    # a download which starts while the request waits is followed
+    monkeypatch.setattr(server, "DOWNLOAD_START_TIMEOUT", 5.0)
+    download.part.touch()
+    threading.Timer(0.2, download.start, args=(0, len(DATA))).start()
+    threading.Timer(0.4, complete, args=(download,)).start()
+    assert artifacts.get("/pending.bin").content == DATA
+
+
+def test_ready(artifacts: httpx.Client) -> None:
+    response = artifacts.get("/_ready")
+    assert (response.status_code, response.text) == (200, "ready\n")
+    assert artifacts.get("/_ready/image.bin").status_code == 200
+    assert artifacts.head("/_ready/image.bin").status_code == 200
+    assert artifacts.get("/_ready/missing.bin").status_code == 404
+
+
+def test_stats(artifacts: httpx.Client) -> None:
+    artifacts.get("/image.bin")
+    artifacts.get("/image.bin", headers={"Range": "bytes=0-0"})
+    # neither responses without data nor files which are not part of the cache are hits
+    etag = artifacts.head("/image.bin").headers["ETag"]
+    artifacts.get("/image.bin", headers={"If-None-Match": etag})
+    artifacts.get("/.cache-index.json")
+    artifacts.get("/missing.bin")
+    stats = artifacts.get("/_stats").json()
+    assert (stats["entries"], stats["hits"], stats["misses"]) == (1, 2, 1)
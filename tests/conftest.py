@@ -1,5 +1,10 @@
+import contextlib
+import json
+import socket
+import threading
 from collections.abc import Iterator
 from ipaddress import IPv4Address
+from pathlib import Path
 
 import pytest
 from docker import ComposeEnv, ComposeEnvFactory
@@ -44,3 +49,77 @@ def compose_env_factory() -> Iterator[ComposeEnvFactory]:
         compose_env.rm(force=True, stop=True)
         compose_env.kill()
         compose_env.cleanup()
+
+
+class FakeQMPServer:
+    def __init__(self, path: Path | None = None) -> None:
+        if path is None:
+            self._server = socket.create_server(("127.0.0.1", 0))
+        else:
+            self._server = socket.create_server(str(path), family=socket.AF_UNIX)
+        self.address: tuple[str, int] | str = self._server.getsockname()
+        self.connections = 0
+        self.commands: list[str] = []
+        self.hmp_responses: dict[str, str] = {}
+        self._clients: list[socket.socket] = []
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self) -> None:
+        while True:
+            try:
+                client, _ = self._server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            self._clients.append(client)
+            threading.Thread(target=self._handle, args=(client,), daemon=True).start()
+
+    def _handle(self, client: socket.socket) -> None:
+        # clients dropped by drop_clients() or the "drop" command make the reads and writes fail
+        with contextlib.suppress(OSError, ValueError), client:
+            self._answer(client)
+
+    def _answer(self, client: socket.socket) -> None:
+        with client.makefile("r") as lines, client.makefile("w") as stream:
+            stream.write(json.dumps({"QMP": {"version": {}, "capabilities": []}}) + "\n")
+            stream.flush()
+            for line in lines:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                command = request["execute"]
+                self.commands.append(command)
+                if command == "drop":
+                    # the connection breaks after the command has been received, but before it is answered
+                    client.shutdown(socket.SHUT_RDWR)
+                    return
+                if command in ("fail", "malformed"):
+                    answer = {"error": {"class": "GenericError", "desc": "failed"}}
+                elif command == "human-monitor-command":
+                    command_line = request["arguments"]["command-line"]
+                    answer = {"return": self.hmp_responses.get(command_line, "")}
+                else:
+                    answer = {"return": {"command": command, "arguments": request.get("arguments", {})}}
+                if "id" in request and command != "malformed":
+                    answer["id"] = request["id"]
+                if command != "qmp_capabilities":
+                    stream.write(json.dumps({"event": "STOP", "data": {}}) + "\n")
+                if command == "system_reset":
+                    stream.write(json.dumps({"event": "RESET", "data": {"guest": False}}) + "\n")
+                stream.write(json.dumps(answer) + "\n")
+                stream.flush()
+
+    def drop_clients(self) -> None:
+        for client in self._clients:
+            client.shutdown(socket.SHUT_RDWR)
+        self._clients.clear()
+
+    def close(self) -> None:
+        self._server.close()
+
+
+@pytest.fixture
+def qmp_server() -> Iterator[FakeQMPServer]:
+    server = FakeQMPServer()
+    yield server
+    server.close()
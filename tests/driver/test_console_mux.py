@@ -0,0 +1,101 @@
+import socket
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+from driver.base_qemudriver import Endpoint, connect
+from driver.console_mux import ConsoleMux, ConsoleReader
+from labgrid.util import get_free_port
+
+
+@pytest.fixture
+def console_mux(tmp_path: Path) -> Iterator[tuple[ConsoleMux, socket.socket]]:
+    mux = ConsoleMux(tmp_path / "serial.sock", tmp_path / "console.sock")
+    upstream = connect(tmp_path / "serial.sock")
+    mux.start(timeout=5)
+    yield mux, upstream
+    upstream.close()
+    mux.close()
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+def test_console_mux_fan_out(console_mux: tuple[ConsoleMux, socket.socket]) -> None:
+    mux, upstream = console_mux
+    reader = mux.reader()
+    clients = [connect(Path(mux.address), timeout=5) for _ in range(2)]
+    try:
+        # the input of each client reaching upstream proves that the client has been attached
+        for n, client in enumerate(clients):
+            client.sendall(f"input {n}\n".encode())
+            assert recv_exactly(upstream, 8) == f"input {n}\n".encode()
+
+        upstream.sendall(b"root@OpenWrt:~# ")
+        assert reader.read(timeout=5) == b"root@OpenWrt:~# "
+        for client in clients:
+            assert recv_exactly(client, 16) == b"root@OpenWrt:~# "
+    finally:
+        for client in clients:
+            client.close()
+
+
+def test_console_mux_upstream_closed(console_mux: tuple[ConsoleMux, socket.socket]) -> None:
+    mux, upstream = console_mux
+    reader = mux.reader()
+    upstream.sendall(b"bye")
+    upstream.close()
+    assert reader.read(timeout=5) == b"bye"
+    assert reader.read(timeout=5) == b""
+
+
+def test_console_mux_start_timeout() -> None:
+    mux = ConsoleMux(Endpoint("localhost", get_free_port()), Endpoint("localhost", get_free_port()))
+    try:
+        with pytest.raises(ConnectionError):
+            mux.start(timeout=5, alive=lambda: False)
+    finally:
+        mux.close()
+
+
+def test_console_reader_drops_oldest_data() -> None:
+    reader = ConsoleReader(max_size=4)
+    reader.feed(b"abc")
+    reader.feed(b"def")
+    assert reader.dropped == 2
+    assert reader.read(timeout=0) == b"cdef"
+    with pytest.raises(TimeoutError):
+        reader.read(timeout=0)
+
+
+def test_console_mux_pattern_waker(console_mux: tuple[ConsoleMux, socket.socket]) -> None:
+    mux, upstream = console_mux
+    with mux.pattern_waker(rb"login:") as waker:
+        upstream.sendall(b"OpenWrt log")
+        upstream.sendall(b"in: ")
+        assert waker.wait(timeout=5)
+    assert not mux._watches
+
+
+def test_console_mux_upstream_not_reading(console_mux: tuple[ConsoleMux, socket.socket]) -> None:
+    mux, upstream = console_mux
+    reader = mux.reader()
+    client = connect(Path(mux.address), timeout=5)
+    try:
+        # far more input than the socket buffers hold, while the upstream end does not read
+        data = bytes(range(256)) * (1 << 14)
+        client.sendall(data)
+        # console output still reaches the readers
+        upstream.sendall(b"root@OpenWrt:~# ")
+        assert reader.read(timeout=5) == b"root@OpenWrt:~# "
+        assert len(reader) == 0
+
+        assert recv_exactly(upstream, len(data)) == data
+    finally:
+        client.close()
@@ -0,0 +1,68 @@
+import base64
+import json
+import socket
+import threading
+from collections.abc import Iterator
+
+import pytest
+from driver.base_qemudriver import Endpoint
+from driver.guestagent import GuestAgentClient, GuestAgentError, guest_exec
+
+
+class FakeGuestAgent:
+    def __init__(self) -> None:
+        self._server = socket.create_server(("127.0.0.1", 0))
+        self.endpoint = Endpoint(*self._server.getsockname())
+        self.status_queries = 0
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self) -> None:
+        try:
+            client, _ = self._server.accept()
+        except OSError:
+            return
+        with client, client.makefile("rb") as requests:
+            # a stale answer to a previous client, which has to be skipped
+            client.sendall(b'{"return": {}}\n')
+            for line in requests:
+                request = json.loads(line.lstrip(b"\xff"))
+                delimiter = b"\xff" if request["execute"] == "guest-sync-delimited" else b""
+                client.sendall(delimiter + json.dumps(self._answer(request)).encode() + b"\n")
+
+    def _answer(self, request: dict) -> dict:
+        command = request["execute"]
+        if command == "guest-sync-delimited":
+            return {"return": request["arguments"]["id"]}
+        if command == "guest-exec":
+            return {"return": {"pid": 42}}
+        if command == "guest-exec-status":
+            self.status_queries += 1
+            if self.status_queries < 3:
+                return {"return": {"exited": False}}
+            out = base64.b64encode(b"line 1\nline 2\n").decode()
+            return {"return": {"exited": True, "exitcode": 1, "out-data": out}}
+        return {"error": {"class": "CommandNotFound", "desc": f"The command {command} has not been found"}}
+
+    def close(self) -> None:
+        self._server.close()
+
+
+@pytest.fixture
+def guest_agent() -> Iterator[FakeGuestAgent]:
+    agent = FakeGuestAgent()
+    yield agent
+    agent.close()
+
+
+def test_guest_exec(guest_agent: FakeGuestAgent) -> None:
+    client = GuestAgentClient(guest_agent.endpoint, timeout=5)
+    try:
+        result = guest_exec(client, "false", timeout=5)
+        assert result.stdout == b"line 1\nline 2\n"
+        assert result.stderr == b""
+        assert result.exitcode == 1
+        assert guest_agent.status_queries == 3
+        with pytest.raises(GuestAgentError):
+            client.execute("guest-unknown")
+    finally:
+        client.close()
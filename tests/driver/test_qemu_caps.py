@@ -0,0 +1,52 @@
+from pathlib import Path
+
+import pytest
+from driver import qemu_caps
+from driver.qemu_caps import qemu_capabilities
+
+FAKE_QEMU = """#!/bin/sh
+echo "$@" >> "$(dirname "$0")/calls"
+case "$1" in
+-version) echo "QEMU emulator version 8.2.2 (Debian 1:8.2.2+ds-0ubuntu1)" ;;
+-machine) printf 'Supported machines are:\\npc                   Standard PC (alias of pc-i440fx-8.2)\\nq35  Standard PC (Q35 + ICH9, 2009)\\n' ;;
+-accel) printf 'Accelerators supported in QEMU binary:\\ntcg\\nkvm\\n' ;;
+-device) printf 'Network devices:\\nname "virtio-net-pci", bus PCI, alias "virtio-net"\\n' ;;
+-cpu) printf 'Available CPUs:\\nx86 core2duo              Intel Core 2 Duo P9xxx\\nx86 qemu64\\n\\nRecognized CPUID flags:\\n  fpu vme\\n' ;;
+-display) printf 'Available display backend types:\\nnone\\negl-headless\\n' ;;
+esac
+"""
+
+
+@pytest.fixture
+def fake_qemu(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(qemu_caps, "_capabilities", {})
+    qemu_bin = tmp_path / "qemu-system-x86_64"
+    qemu_bin.write_text(FAKE_QEMU)
+    qemu_bin.chmod(0o755)
+    return qemu_bin
+
+
+def test_qemu_capabilities(fake_qemu: Path) -> None:
+    capabilities = qemu_capabilities(str(fake_qemu))
+    assert capabilities.version == (8, 2, 2)
+    assert capabilities.machines == {"pc", "q35"}
+    assert capabilities.accelerators == {"tcg", "kvm"}
+    assert capabilities.devices == {"virtio-net-pci"}
+    assert capabilities.cpus == {"core2duo", "qemu64"}
+    assert capabilities.displays == {"none", "egl-headless"}
+
+
+def test_qemu_capabilities_are_persisted(fake_qemu: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    capabilities = qemu_capabilities(str(fake_qemu))
+    calls = (fake_qemu.parent / "calls").read_text()
+
+    # a new process only has the cache on disk
+    monkeypatch.setattr(qemu_caps, "_capabilities", {})
+    assert qemu_capabilities(str(fake_qemu)) == capabilities
+    assert (fake_qemu.parent / "calls").read_text() == calls
+
+    # a changed binary is probed again
+    fake_qemu.write_text(FAKE_QEMU + "\n")
+    qemu_capabilities(str(fake_qemu))
+    assert (fake_qemu.parent / "calls").read_text() == calls * 2
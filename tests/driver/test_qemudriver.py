@@ -0,0 +1,167 @@
+import os
+import socket
+from collections.abc import Iterator
+
+import pytest
+from conftest import FakeQMPServer
+from driver import BaseQEMUDriver, CustomQEMUDriver
+from driver.base_qemudriver import Endpoint, ForwardTable
+from driver.console_mux import ConsoleMux
+from driver.qemu_caps import QEMUCapabilities
+from labgrid import Target
+from labgrid.driver.exception import ExecutionError
+from pexpect import TIMEOUT
+from qmp import QMPError, hmp
+
+INFO_USERNET: str = """Hub -1 (net0):
+  Protocol[State]    FD  Source Address  Port   Dest. Address  Port RecvQ SendQ
+  TCP[HOST_FORWARD]  55       127.0.0.1 56065 192.168.187.100    22     0     0
+"""
+
+
+@pytest.fixture
+def qemu_driver(qmp_server: FakeQMPServer, monkeypatch: pytest.MonkeyPatch) -> Iterator[BaseQEMUDriver]:
+    monkeypatch.setenv("QMP_PORT", str(qmp_server.address[1]))
+    driver = BaseQEMUDriver(Target("test"), "qemu")
+    yield driver
+    driver._close_qmp()
+
+
+def test_monitor_commands(qemu_driver: BaseQEMUDriver, qmp_server: FakeQMPServer) -> None:
+    results = qemu_driver.monitor_commands([("query-status", None), ("fail", None)])
+    assert [result.ok for result in results] == [True, False]
+    assert qmp_server.connections == 1
+
+
+def test_add_port_forwarding_replaces_forward(qemu_driver: BaseQEMUDriver, qmp_server: FakeQMPServer) -> None:
+    qmp_server.hmp_responses["info usernet"] = INFO_USERNET
+    qmp_server.hmp_responses["hostfwd_remove tcp:127.0.0.1:56065"] = (
+        "host forwarding rule for tcp:127.0.0.1:56065 removed"
+    )
+
+    qemu_driver.add_port_forwarding("127.0.0.1", 2222, "192.168.187.100", 22)
+
+    assert qemu_driver.port_forwardings == {Endpoint("192.168.187.100", 22): Endpoint("127.0.0.1", 2222)}
+    assert qemu_driver.add_hostfwd("192.168.187.100", 22) == Endpoint("127.0.0.1", 2222)
+    # the forward table is only read once and then kept up to date
+    assert qmp_server.commands.count("human-monitor-command") == 3
+
+
+def test_forward_table_resync_after_reset(qemu_driver: BaseQEMUDriver, qmp_server: FakeQMPServer) -> None:
+    qemu_driver.add_port_forwarding("127.0.0.1", 2222, "192.168.187.100", 22)
+    with qemu_driver.qmp_events("RESET") as reset_events:
+        qemu_driver.monitor_command("system_reset")
+        reset_events.wait(timeout=5)
+
+    qmp_server.hmp_responses["info usernet"] = INFO_USERNET
+    assert qemu_driver.port_forwardings == {Endpoint("192.168.187.100", 22): Endpoint("127.0.0.1", 56065)}
+
+
+def test_forward_table() -> None:
+    table = ForwardTable({Endpoint("192.168.187.100", 22): Endpoint("127.0.0.1", 2222)})
+    table.add(Endpoint("127.0.0.1", 2223), Endpoint("192.168.187.100", 22))
+    assert table.host_endpoint(Endpoint("192.168.187.100", 22)) == Endpoint("127.0.0.1", 2223)
+    assert table.remove(Endpoint("127.0.0.1", 2223)) == Endpoint("192.168.187.100", 22)
+    assert table.host_endpoint(Endpoint("192.168.187.100", 22)) == Endpoint("127.0.0.1", 2222)
+    assert table.guest_endpoint(Endpoint("127.0.0.1", 2222)) == Endpoint("192.168.187.100", 22)
+    assert table.remove(Endpoint("127.0.0.1", 2224)) is None
+
+
+def test_add_port_forwarding_error(qemu_driver: BaseQEMUDriver, qmp_server: FakeQMPServer) -> None:
+    qmp_server.hmp_responses["hostfwd_add tcp:127.0.0.1:2222-192.168.187.100:22"] = (
+        "could not set up host forwarding rule 'tcp:127.0.0.1:2222-192.168.187.100:22'"
+    )
+
+    with pytest.raises(QMPError):
+        qemu_driver.add_port_forwarding("127.0.0.1", 2222, "192.168.187.100", 22)
+
+
+def test_remove_port_forward_not_found(qemu_driver: BaseQEMUDriver, qmp_server: FakeQMPServer) -> None:
+    qmp_server.hmp_responses["hostfwd_remove tcp:127.0.0.1:2222"] = (
+        "host forwarding rule for tcp:127.0.0.1:2222 not found"
+    )
+
+    with pytest.raises(QMPError):
+        qemu_driver.remove_port_forward(Endpoint("127.0.0.1", 2222))
+    assert qemu_driver.monitor_command(*hmp("info usernet")) == ""
+
+
+def test_read_drains_available_data() -> None:
+    driver = BaseQEMUDriver(Target("test"), "qemu", read_chunk_size=8)
+    driver._socket, peer = socket.socketpair()
+    try:
+        peer.sendall(b"root@")
+        peer.sendall(b"OpenWrt:~# ")
+        assert driver._read(timeout=1) == b"root@Ope"
+        assert driver._read(timeout=1, max_size=4) == b"nWrt"
+        assert driver._read(timeout=1) == b":~# "
+        with pytest.raises(TIMEOUT):
+            driver._read(timeout=0)
+    finally:
+        driver._socket.close()
+        peer.close()
+
+
+def test_qmp_waker(qemu_driver: BaseQEMUDriver) -> None:
+    with qemu_driver.qmp_waker("RESET") as waker:
+        qemu_driver.monitor_command("system_reset")
+        assert waker.wait(timeout=5)
+
+
+@pytest.mark.parametrize(
+    ("accel", "kvm_usable", "expected"),
+    [("auto", True, "kvm"), ("auto", False, "tcg,thread=multi"), ("tcg", True, "tcg,thread=multi")],
+)
+def test_select_accelerator(monkeypatch: pytest.MonkeyPatch, accel: str, kvm_usable: bool, expected: str) -> None:
+    monkeypatch.setattr(os, "access", lambda path, mode: kvm_usable)
+    driver = CustomQEMUDriver(
+        Target("test"), "qemu", qemu_bin="qemu", machine="pc", cpu="qemu64", memory="1G", extra_args="", accel=accel
+    )
+    capabilities = QEMUCapabilities((8, 2, 2), frozenset(), frozenset({"tcg", "kvm"}), *[frozenset()] * 3)
+    assert driver.select_accelerator(capabilities) == expected
+
+
+def test_select_accelerator_kvm_unusable(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(os, "access", lambda path, mode: False)
+    driver = CustomQEMUDriver(
+        Target("test"), "qemu", qemu_bin="qemu", machine="pc", cpu="qemu64", memory="1G", extra_args="", accel="kvm"
+    )
+    capabilities = QEMUCapabilities((8, 2, 2), frozenset(), frozenset({"tcg", "kvm"}), *[frozenset()] * 3)
+    with pytest.raises(ExecutionError):
+        driver.select_accelerator(capabilities)
+
+
+def test_drivers_side_by_side() -> None:
+    drivers = [
+        CustomQEMUDriver(
+            Target(f"test{n}"), "qemu", qemu_bin="qemu", machine="pc", cpu="qemu64", memory="1G", extra_args=""
+        )
+        for n in range(2)
+    ]
+    qmp_servers: list[FakeQMPServer] = []
+    upstreams: list[socket.socket] = []
+    try:
+        for driver in drivers:
+            # what QEMU does: serve QMP and connect its serial console to the multiplexer
+            qmp_servers.append(FakeQMPServer(driver.qmp_endpoint))
+            driver._console_mux = ConsoleMux(driver.serial_endpoint, driver.console_endpoint)
+            upstreams.append(socket.socket(socket.AF_UNIX))
+            upstreams[-1].connect(str(driver.serial_endpoint))
+            driver._console_mux.start(timeout=5)
+            driver.on_activate()
+        assert len({driver.runtime_dir for driver in drivers}) == 2
+
+        for n, (driver, upstream) in enumerate(zip(drivers, upstreams, strict=True)):
+            upstream.sendall(f"console {n}".encode())
+            assert driver._read(timeout=5) == f"console {n}".encode()
+            driver.monitor_command("query-status")
+        assert [server.commands for server in qmp_servers] == [["qmp_capabilities", "query-status"]] * 2
+    finally:
+        for driver in drivers:
+            if driver._socket is not None:
+                driver.on_deactivate()
+            driver._atexit()
+        for upstream in upstreams:
+            upstream.close()
+        for server in qmp_servers:
+            server.close()
@@ -0,0 +1,106 @@
+import json
+import os
+import shutil
+import threading
+from collections.abc import Iterator
+from dataclasses import dataclass
+from pathlib import Path
+
+import pytest
+import qemu_img
+from driver import CustomQEMUDriver
+from driver.remote_disk import RemoteImage, RemoteImageError, open_remote_image
+from labgrid import Target
+from server import ArtifactServer, Downloads
+
+IMAGE_URL = "http://artifacts:8000/openwrt.img"
+IMAGE_DATA = bytes(range(256)) * 4096
+
+
+@dataclass
+class Artifacts:
+    """An artifacts service serving its directory, with downloads which are controlled by the tests"""
+
+    url: str
+    directory: Path
+    downloads: Downloads
+
+
+@pytest.fixture
+def artifacts(tmp_path: Path) -> Iterator[Artifacts]:
+    directory = tmp_path / "artifacts"
+    directory.mkdir()
+    downloads = Downloads(directory)
+    httpd = ArtifactServer(("127.0.0.1", 0), directory, downloads=downloads)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield Artifacts(f"http://127.0.0.1:{httpd.server_address[1]}", directory, downloads)
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_open_remote_image(artifacts: Artifacts, tmp_path: Path) -> None:
+    download = artifacts.downloads.register(artifacts.directory / "openwrt.img")
+    download.part.write_bytes(IMAGE_DATA[:1024])
+    download.start(1024, len(IMAGE_DATA))
+
+    def complete() -> None:
+        download.part.write_bytes(IMAGE_DATA)
+        os.replace(download.part, download.path)
+        download.finish()
+
+    # the image is opened once the artifacts service has downloaded it completely
+    threading.Timer(0.3, complete).start()
+    image = open_remote_image(f"{artifacts.url}/openwrt.img", tmp_path, timeout=10)
+    assert image.size == len(IMAGE_DATA)
+    assert image.cache_path.parent == tmp_path
+    assert image.cache_path.name.startswith("openwrt.img.")
+    # the same image gets the same cache
+    assert open_remote_image(f"{artifacts.url}/openwrt.img", tmp_path, timeout=10) == image
+
+
+def test_open_remote_image_unavailable(artifacts: Artifacts, tmp_path: Path) -> None:
+    download = artifacts.downloads.register(artifacts.directory / "openwrt.img")
+    download.finish(OSError("connection reset"))
+    with pytest.raises(RemoteImageError, match="connection reset"):
+        open_remote_image(f"{artifacts.url}/openwrt.img", tmp_path, timeout=10)
+    with pytest.raises(RemoteImageError, match="unknown"):
+        open_remote_image(f"{artifacts.url}/missing.img", tmp_path, timeout=10)
+
+
+@pytest.mark.skipif(shutil.which("qemu-img") is None, reason="qemu-img is not installed")
+def test_remote_image_chain(artifacts: Artifacts, tmp_path: Path) -> None:
+    """QEMU reads the image from the artifacts service through the block node chain"""
+    (artifacts.directory / "openwrt.img").write_bytes(IMAGE_DATA)
+    image = open_remote_image(f"{artifacts.url}/openwrt.img", tmp_path, timeout=10)
+    overlay = tmp_path / "disk.qcow2"
+    image.prepare(overlay)
+    output = tmp_path / "disk.img"
+    qemu_img.convert(f"json:{json.dumps(image.blockdev(str(overlay), copy_on_read=False))}", output, "raw")
+    assert output.read_bytes() == IMAGE_DATA
+
+
+def test_remote_image_blockdev(tmp_path: Path) -> None:
+    image = RemoteImage(IMAGE_URL, 1048576, tmp_path / "cache.qcow2")
+    blockdev = image.blockdev("disk.qcow2")
+    assert blockdev["file"]["filename"] == "disk.qcow2"
+    copy_on_read = blockdev["backing"]
+    assert copy_on_read["driver"] == "copy-on-read"
+    assert copy_on_read["file"]["file"]["filename"] == str(tmp_path / "cache.qcow2")
+    assert copy_on_read["file"]["backing"]["file"] == {
+        "driver": "http",
+        "url": IMAGE_URL,
+        "readahead": 1048576,
+        "read-only": True,
+    }
+    # qemu-img reads the chain without writing to the cache
+    assert image.blockdev("disk.qcow2", copy_on_read=False)["backing"]["driver"] == "qcow2"
+
+
+def test_remote_disk_args(tmp_path: Path) -> None:
+    driver = CustomQEMUDriver(
+        Target("test"), "qemu", qemu_bin="qemu", machine="pc", cpu="qemu64", memory="1G", extra_args=""
+    )
+    driver.disk_remote = RemoteImage(IMAGE_URL, 1048576, tmp_path / "cache.qcow2")
+    option, blockdev, device, device_args = driver.get_remote_disk_args()
+    assert (option, device, device_args) == ("-blockdev", "-device", "virtio-blk-pci,drive=disk0")
+    assert json.loads(blockdev) == driver.disk_remote.blockdev("<disk>")
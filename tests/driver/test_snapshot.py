@@ -0,0 +1,93 @@
+import os
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from driver import CustomQEMUDriver
+from driver.qemu_caps import QEMUCapabilities
+from driver.snapshot import SnapshotCache, snapshot_key
+from labgrid import Target
+
+
+def test_snapshot_key(tmp_path: Path) -> None:
+    image = tmp_path / "disk.img"
+    image.write_bytes(b"\0" * 1024)
+    config = {"machine": "pc", "memory": "1G"}
+
+    key = snapshot_key(config, image, (9, 2, 0))
+    assert key == snapshot_key(dict(reversed(config.items())), image, (9, 2, 0))
+    assert key != snapshot_key(config, image, (9, 2, 1))
+    assert key != snapshot_key({**config, "memory": "2G"}, image, (9, 2, 0))
+
+    image.write_bytes(b"\1" * 1024)
+    assert key != snapshot_key(config, image, (9, 2, 0))
+
+
+def test_snapshot_cache_commit(tmp_path: Path) -> None:
+    cache = SnapshotCache(tmp_path / "snapshots")
+    assert not cache.get("abc").exists()
+
+    snapshot = cache.create("abc")
+    snapshot.state_path.write_bytes(b"state")
+    assert not cache.get("abc").exists()
+
+    committed = cache.commit("abc", snapshot, {"status": "shell"})
+    assert committed == cache.get("abc")
+    assert committed.exists()
+    assert committed.meta["status"] == "shell"
+    assert committed.state_path.read_bytes() == b"state"
+
+    duplicate = cache.create("abc")
+    assert cache.commit("abc", duplicate, {"status": "shell"}) == committed
+    assert not duplicate.path.exists()
+
+
+def test_snapshot_cache_prune(tmp_path: Path) -> None:
+    cache = SnapshotCache(tmp_path / "snapshots", keep=2)
+    for mtime, key in [(1000, "c"), (2000, "b")]:
+        cache.commit(key, cache.create(key), {"status": "shell"})
+        os.utime(cache.get(key).meta_path, (mtime, mtime))
+    # committing a third snapshot removes the least recently used one
+    cache.commit("a", cache.create("a"), {"status": "shell"})
+    assert [snapshot.path.name for snapshot in cache.entries()] == ["a", "b"]
+
+    cache.touch(cache.get("b"))
+    cache.commit("d", cache.create("d"), {"status": "shell"})
+    assert {snapshot.path.name for snapshot in cache.entries()} == {"b", "d"}
+    assert not cache.get("a").path.exists()
+
+
+def test_snapshot_key_of_driver(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path, caplog: pytest.LogCaptureFixture
+) -> None:
+    driver = CustomQEMUDriver(
+        Target("test"), "qemu", qemu_bin="qemu", machine="pc", cpu="qemu64", memory="1G", extra_args="", accel="tcg"
+    )
+    capabilities = QEMUCapabilities((8, 2, 2), frozenset(), frozenset({"tcg"}), *[frozenset()] * 3)
+    monkeypatch.setattr(driver, "get_qemu_capabilities", lambda qemu_bin: capabilities)
+    monkeypatch.setattr(driver.target, "env", SimpleNamespace(config=SimpleNamespace(get_tool=lambda name: name)))
+    assert driver.snapshot_capable
+    driver.disk = "disk-image"
+    assert not driver.snapshot_capable
+    driver.disk_base = tmp_path / "base.img"
+    driver.disk_base.write_bytes(b"\0" * 1024)
+    assert driver.snapshot_capable
+
+    key = driver.get_snapshot_key()
+    assert key == driver.get_snapshot_key()
+    # the key does not depend on the command line, whose accelerator selection is logged
+    assert "Using accelerator" not in caplog.text
+    driver.memory = "2G"
+    assert key != driver.get_snapshot_key()
+
+
+def test_cycle_cold_boots(monkeypatch: pytest.MonkeyPatch) -> None:
+    driver = CustomQEMUDriver(
+        Target("test"), "qemu", qemu_bin="qemu", machine="pc", cpu="qemu64", memory="1G", extra_args=""
+    )
+    starts: list[bool] = []
+    monkeypatch.setattr(driver, "off", lambda: None)
+    monkeypatch.setattr(driver, "_start", lambda restore: starts.append(restore))
+    driver.on()
+    driver.cycle()
+    assert starts == [True, False]
@@ -0,0 +1,104 @@
+import logging
+from pathlib import Path
+
+import pytest
+import yaml
+from labgrid import Environment
+from strategy import QEMUNetworkStrategy
+
+DISK_URL = "http://artifacts:8000/openwrt-24.10.0-x86-64-generic-ext4-combined.img.gz"
+BASE_IMAGE = "openwrt-24.10.0-x86-64-generic-ext4-combined.img"
+
+
+def make_strategy(tmp_path: Path, **params: bool) -> QEMUNetworkStrategy:
+    config = {
+        "targets": {
+            "main": {
+                "resources": [
+                    {"NetworkService": {"address": "", "port": 22, "username": "root"}},
+                    {"QEMUParams": params},
+                ],
+                "drivers": [
+                    {
+                        "CustomQEMUDriver": {
+                            "qemu_bin": "qemu-amd64",
+                            "machine": "pc",
+                            "cpu": "qemu64",
+                            "memory": "1G",
+                            "extra_args": "",
+                            "disk": "disk-image",
+                        }
+                    },
+                    {"ShellDriver": {"prompt": "# ", "login_prompt": "login:", "username": "root"}},
+                    {"SSHDriver": {}},
+                    {"QEMUNetworkStrategy": {}},
+                ],
+            }
+        },
+        "tools": {"qemu-amd64": "qemu-system-x86_64", "qemu-img": "qemu-img"},
+        "images": {"disk-image": str(tmp_path / "openwrt.img")},
+        "urls": {"disk-image": DISK_URL},
+    }
+    config_path = tmp_path / "qemu.yaml"
+    config_path.write_text(yaml.safe_dump(config))
+    target = Environment(str(config_path)).get_target("main")
+    assert target
+    return target.get_driver("QEMUNetworkStrategy")
+
+
+@pytest.fixture
+def fetched(monkeypatch: pytest.MonkeyPatch) -> list[Path | None]:
+    """Records the destinations the image is extracted to instead of downloading it"""
+    destinations: list[Path | None] = []
+
+    def fetch_image(self: QEMUNetworkStrategy, dest: Path | None) -> None:
+        destinations.append(dest)
+        if dest is not None:
+            dest.write_bytes(b"\0" * 1024)
+
+    monkeypatch.setattr(QEMUNetworkStrategy, "_fetch_image", fetch_image)
+    return destinations
+
+
+def test_overlay(tmp_path: Path, fetched: list[Path | None]) -> None:
+    strategy = make_strategy(tmp_path, overlay=True)
+    base = tmp_path / BASE_IMAGE
+    assert fetched == [base]
+    assert strategy.qemu.disk_base == base
+    assert not base.stat().st_mode & 0o222
+
+    # the base image is extracted only once
+    make_strategy(tmp_path, overlay=True)
+    assert fetched == [base]
+
+
+def test_overlay_compressed_base(tmp_path: Path, fetched: list[Path | None], monkeypatch: pytest.MonkeyPatch) -> None:
+    def compress_base_image(self: QEMUNetworkStrategy) -> None:
+        self.compressed_base_disk_path.write_bytes(b"qcow2")
+        self.base_disk_path.unlink()
+
+    monkeypatch.setattr(QEMUNetworkStrategy, "_compress_base_image", compress_base_image)
+    strategy = make_strategy(tmp_path, overlay=True, compressed_base=True)
+    assert fetched == [tmp_path / BASE_IMAGE]
+    assert strategy.qemu.disk_base == tmp_path / f"{Path(BASE_IMAGE).stem}.qcow2"
+    assert not (tmp_path / BASE_IMAGE).exists()
+
+    # the compressed base image is kept, so the raw one is not extracted again
+    make_strategy(tmp_path, overlay=True, compressed_base=True)
+    assert len(fetched) == 1
+
+
+def test_overwrite(tmp_path: Path, fetched: list[Path | None]) -> None:
+    strategy = make_strategy(tmp_path, overwrite=True)
+    assert fetched == [tmp_path / "openwrt.img"]
+    assert strategy.qemu.disk_base is None
+
+
+def test_overwrite_ignored_with_overlay(
+    tmp_path: Path, fetched: list[Path | None], caplog: pytest.LogCaptureFixture
+) -> None:
+    with caplog.at_level(logging.WARNING):
+        strategy = make_strategy(tmp_path, overlay=True, overwrite=True)
+    assert "overwrite has no effect" in caplog.text
+    assert fetched == [tmp_path / BASE_IMAGE]
+    assert strategy.qemu.disk_base == tmp_path / BASE_IMAGE
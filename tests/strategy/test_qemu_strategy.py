@@ -0,0 +1,86 @@
+from collections.abc import Iterator
+
+import attr
+import opkg
+import pytest
+import uci
+from conftest import FakeQMPServer
+from driver import BaseQEMUDriver
+from driver.base_qemudriver import Endpoint
+from labgrid import Target
+from labgrid.driver import ShellDriver, SSHDriver
+from labgrid.resource import NetworkService
+from strategy import GuestService, QEMUBaseStrategy, Status
+
+
+@attr.s(eq=False)
+class ForwardingStrategy(QEMUBaseStrategy):
+    """Strategy of a running VM whose guest address is known without asking its shell"""
+
+    bindings = {"qemu": "BaseQEMUDriver", "shell": "ShellDriver", "ssh": "SSHDriver"}
+
+    def on(self) -> None:
+        pass
+
+    def off(self) -> None:
+        pass
+
+    def get_remote_address(self) -> str:
+        return "192.168.187.100"
+
+
+@pytest.fixture
+def qemu_strategy(qmp_server: FakeQMPServer, monkeypatch: pytest.MonkeyPatch) -> Iterator[ForwardingStrategy]:
+    monkeypatch.setenv("QMP_PORT", str(qmp_server.address[1]))
+    target = Target("test")
+    NetworkService(target, "ssh", address="", port=22, username="root")
+    qemu = BaseQEMUDriver(target, "qemu")
+    ShellDriver(target, "shell", prompt="# ", login_prompt="login:", username="root")
+    SSHDriver(target, "ssh")
+    yield ForwardingStrategy(target, "strategy")
+    qemu._close_qmp()
+
+
+def test_forward_services(qemu_strategy: ForwardingStrategy, qmp_server: FakeQMPServer) -> None:
+    assert qemu_strategy.qemu
+    endpoints = qemu_strategy.forward_services([GuestService("luci", 80, host_port=8080)])
+    # SSH is always forwarded
+    assert set(endpoints) == {"ssh", "luci"}
+    assert endpoints["luci"] == Endpoint("127.0.0.1", 8080)
+    assert qemu_strategy.qemu.port_forwardings == {
+        Endpoint("192.168.187.100", 22): endpoints["ssh"],
+        Endpoint("192.168.187.100", 80): Endpoint("127.0.0.1", 8080),
+    }
+    hmp_count = qmp_server.commands.count("human-monitor-command")
+
+    # unchanged services do not cause any commands
+    assert qemu_strategy.forward_services([GuestService("luci", 80, host_port=8080)]) == endpoints
+    assert qmp_server.commands.count("human-monitor-command") == hmp_count
+
+    # removed and added services are applied in one batch
+    qmp_server.hmp_responses["hostfwd_remove tcp:127.0.0.1:8080"] = (
+        "host forwarding rule for tcp:127.0.0.1:8080 removed"
+    )
+    new_endpoints = qemu_strategy.forward_services([GuestService("iperf", 5201)])
+    assert set(new_endpoints) == {"ssh", "iperf"}
+    assert new_endpoints["ssh"] == endpoints["ssh"]
+    assert qemu_strategy.qemu.port_forwardings == {
+        Endpoint("192.168.187.100", 22): new_endpoints["ssh"],
+        Endpoint("192.168.187.100", 5201): new_endpoints["iperf"],
+    }
+    assert qmp_server.commands.count("human-monitor-command") == hmp_count + 2
+
+
+def test_off_invalidates_all_runners(qemu_strategy: ForwardingStrategy) -> None:
+    assert qemu_strategy.target
+    # like a GuestAgentDriver, a runner which is not bound to the strategy but runs commands on the same device
+    runner = ShellDriver(qemu_strategy.target, "console", prompt="# ", login_prompt="login:", username="root")
+    runners = [qemu_strategy.shell, qemu_strategy.ssh, runner]
+    for driver in runners:
+        uci._snapshots[driver] = {"dhcp": uci.Snapshot("dhcp", {"dhcp.lan.ignore": ["0"]})}
+        opkg.database(driver)
+
+    qemu_strategy.transition(Status.off)
+    for driver in runners:
+        assert not uci._snapshots[driver]
+        assert driver not in opkg._databases
@@ -1,3 +1,4 @@
+import os
 from ipaddress import IPv4Address
 from pathlib import Path
 
@@ -14,6 +15,17 @@ from ssh import put_file
 from x509 import PKI, create_pki
 
 OPENVPN_DIR = Path(__file__).parent / "openvpn"
+# e.g. http://artifacts:8000/feeds, to install packages from the mirror of the artifacts service
+OPKG_FEED_MIRROR = os.environ.get("OPKG_FEED_MIRROR")
+# the feeds of the guest image which are mirrored by the artifacts service
+OPKG_MIRRORED_FEEDS = (
+    "openwrt_core",
+    "openwrt_base",
+    "openwrt_luci",
+    "openwrt_packages",
+    "openwrt_routing",
+    "openwrt_telephony",
+)
 
 
 @pytest.fixture(scope="module")
@@ -55,9 +67,9 @@ def test_openvpn(
     ssh_command: SSHDriver,
 ) -> None:
     def step_openwrt_install_openvpn() -> None:
-        if not opkg.is_package_installed(ssh_command, "openvpn-openssl"):
-            opkg.update(ssh_command)
-            opkg.install(ssh_command, "openvpn-openssl")
+        if OPKG_FEED_MIRROR:
+            opkg.use_feed_mirror(ssh_command, OPKG_FEED_MIRROR, feeds=OPKG_MIRRORED_FEEDS)
+        if opkg.ensure_installed(ssh_command, "openvpn-openssl"):
             sync(ssh_command)
 
     def step_openwrt_setup_openvpn() -> None:
@@ -65,15 +77,19 @@ def test_openvpn(
         put_file(ssh_command, Path("/etc") / "openvpn" / "ca.crt", pki.ca_cert)
         put_file(ssh_command, Path("/etc") / "openvpn" / "client.crt", pki.client_cert)
         put_file(ssh_command, Path("/etc") / "openvpn" / "client.key", pki.client_key)
-        uci.set(ssh_command, "openvpn.sample_client.enabled", True)
-        uci.set(ssh_command, "openvpn.sample_client.remote", f"{openvpn_server_name} {openvpn_server_port}")
-        uci.commit(ssh_command, "openvpn")
-        service.restart(ssh_command, "openvpn", "sample_client")
+        with uci.Transaction(ssh_command) as transaction:
+            transaction.set("openvpn.sample_client.enabled", True)
+            transaction.set("openvpn.sample_client.remote", f"{openvpn_server_name} {openvpn_server_port}")
+            transaction.commit("openvpn")
+        if transaction.changed:
+            service.restart(ssh_command, "openvpn", "sample_client")
 
     def step_openwrt_configure_firewall() -> None:
-        uci.add_list(ssh_command, "firewall.@zone[0].device", "tun0")
-        uci.commit(ssh_command, "firewall")
-        service.restart(ssh_command, "firewall")
+        with uci.Transaction(ssh_command) as transaction:
+            transaction.add_list("firewall.@zone[0].device", "tun0")
+            transaction.commit("firewall")
+        if transaction.changed:
+            service.restart(ssh_command, "firewall")
 
     def step_verify_connected() -> None:
         assert run(ssh_command, "ping -c 5 192.168.123.1")
@@ -0,0 +1,51 @@
+import itertools
+import threading
+import time
+
+import pytest
+from func import Backoff, Waker, retry_exc, wait_for, wait_records
+
+
+def test_backoff_grows_up_to_maximum() -> None:
+    delays = list(itertools.islice(Backoff(initial=0.1, maximum=1, jitter=0.1), 8))
+    assert 0.09 <= delays[0] <= 0.11
+    assert all(delay <= 1 for delay in delays)
+    assert delays[-1] >= 0.9
+
+
+def test_wait_for_returns_when_woken() -> None:
+    waker = Waker()
+    done = threading.Event()
+    threading.Timer(0.1, lambda: (done.set(), waker.wake())).start()
+
+    start = time.monotonic()
+    assert wait_for(done.is_set, "woken up", delay=5, waker=waker)
+    assert time.monotonic() - start < 2
+    assert wait_records[-1].desc == "woken up"
+    assert wait_records[-1].success
+
+
+def test_wait_for_timeout() -> None:
+    with pytest.raises(TimeoutError):
+        wait_for(lambda: False, "never", timeout=0.1)
+    assert not wait_records[-1].success
+    assert wait_records[-1].attempts > 1
+
+
+def test_retry_exc() -> None:
+    attempts = iter([ValueError(), ValueError(), "result"])
+
+    def func() -> str:
+        if isinstance(result := next(attempts), Exception):
+            raise result
+        return result
+
+    assert retry_exc(func, ValueError, "retrying", delay=0.01) == "result"
+    assert wait_records[-1].attempts == 3
+
+
+def test_wait_for_min_delay() -> None:
+    with pytest.raises(TimeoutError):
+        wait_for(lambda: False, "expensive condition", delay=1, timeout=0.5, min_delay=0.2)
+    # the pauses start at min_delay instead of a few milliseconds
+    assert wait_records[-1].attempts <= 3
@@ -0,0 +1,88 @@
+import gzip
+import hashlib
+import zlib
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+from image import (
+    ChecksumError,
+    SparseWriter,
+    allocated_size,
+    gunzip_chunks,
+    parse_sha256sums,
+    prefetch,
+    store_image,
+)
+
+IMAGE: bytes = b"OpenWrt" * 1000 + bytes(3 << 20)
+# OpenWrt appends metadata to its gzip compressed images
+COMPRESSED_IMAGE: bytes = gzip.compress(IMAGE) + b"\0" * 512 + b"trailing metadata"
+
+
+def split(data: bytes, size: int = 4096) -> Iterator[bytes]:
+    for offset in range(0, len(data), size):
+        yield data[offset : offset + size]
+
+
+def test_gunzip_chunks_bounded() -> None:
+    chunks = list(gunzip_chunks(split(COMPRESSED_IMAGE), chunk_size=65536))
+    assert b"".join(chunks) == IMAGE
+    assert max(len(chunk) for chunk in chunks) <= 65536
+
+
+def test_gunzip_chunks_truncated() -> None:
+    with pytest.raises(zlib.error):
+        list(gunzip_chunks(split(COMPRESSED_IMAGE[:1000])))
+
+
+def test_prefetch_forwards_errors() -> None:
+    def failing() -> Iterator[bytes]:
+        yield b"a"
+        raise OSError("connection reset")
+
+    assert list(prefetch(split(b"abc", 1))) == [b"a", b"b", b"c"]
+    with pytest.raises(OSError):
+        list(prefetch(failing()))
+
+
+def test_store_image(tmp_path: Path) -> None:
+    sha256 = hashlib.sha256(COMPRESSED_IMAGE).hexdigest()
+    store_image(prefetch(split(COMPRESSED_IMAGE)), tmp_path / "image.img.gz", tmp_path / "image.img", sha256)
+
+    assert (tmp_path / "image.img.gz").read_bytes() == COMPRESSED_IMAGE
+    assert (tmp_path / "image.img").read_bytes() == IMAGE
+    # the zeros at the end of the image are not written
+    allocated, size = allocated_size(tmp_path / "image.img")
+    assert size == len(IMAGE)
+    assert allocated < 1 << 20
+
+
+def test_sparse_writer(tmp_path: Path) -> None:
+    data = b"a" + bytes(20000) + b"b" * 5000 + bytes(70000)
+    with open(tmp_path / "sparse.img", "wb") as f:
+        writer = SparseWriter(f)
+        # the chunks are not aligned to the blocks
+        for chunk in split(data, 3000):
+            writer.write(chunk)
+        writer.finish()
+
+    assert (tmp_path / "sparse.img").read_bytes() == data
+    assert allocated_size(tmp_path / "sparse.img")[0] < len(data) // 2
+
+
+def test_store_image_checksum_mismatch(tmp_path: Path) -> None:
+    with pytest.raises(ChecksumError):
+        store_image(split(COMPRESSED_IMAGE), tmp_path / "image.img.gz", tmp_path / "image.img", "00" * 32)
+
+    assert not list(tmp_path.iterdir())
+
+
+def test_parse_sha256sums() -> None:
+    assert parse_sha256sums(
+        "3c0f2b8b6a7d1a1e4b6bbf2c9e0d8a7f5e4d3c2b1a09f8e7d6c5b4a392817161 *openwrt-x86-64-combined.img.gz\n"
+        "ABCDEF  kernel.bin\n"
+    ) == {
+        "openwrt-x86-64-combined.img.gz": "3c0f2b8b6a7d1a1e4b6bbf2c9e0d8a7f5e4d3c2b1a09f8e7d6c5b4a392817161",
+        "kernel.bin": "abcdef",
+    }
@@ -1,4 +1,7 @@
 import json
+import socket
+import threading
+import time
 from dataclasses import dataclass
 from ipaddress import IPv4Address
 from unittest.mock import MagicMock, patch
@@ -6,6 +9,7 @@ from unittest.mock import MagicMock, patch
 import network
 import openwrt
 import pytest
+from func import Waker
 
 
 @dataclass
@@ -82,3 +86,33 @@ def test_openwrt_primary_host_ip_ok(mock_shell_run: MagicMock) -> None:
     mock_shell_run.side_effect = [ip_r_s_output, ip_a_s_output]
 
     assert network.primary_host_ip() == IPv4Address("192.168.1.1")
+
+
+def test_is_ssh_endpoint_ready() -> None:
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        host, port = server.getsockname()
+        # like a host forward whose guest port does not answer yet: accepted, but no banner
+        assert not network.is_ssh_endpoint_ready(host, port, timeout=0.2)
+        server.accept()[0].close()
+
+        def answer() -> None:
+            with server.accept()[0] as client:
+                client.sendall(b"SSH-2.0-dropbear\r\n")
+
+        threading.Thread(target=answer, daemon=True).start()
+        assert network.is_ssh_endpoint_ready(host, port, timeout=5)
+
+
+def test_enable_dhcp_woken_by_console() -> None:
+    runner = MagicMock()
+    routes = iter([[], ["default via 192.168.187.2 dev br-lan"]])
+    runner.run_check.side_effect = lambda cmd: next(routes) if cmd == "ip -4 r s default" else []
+    waker = Waker()
+    threading.Timer(0.1, waker.wake).start()
+
+    start = time.monotonic()
+    with patch("uci.Transaction") as transaction:
+        transaction.return_value.__enter__.return_value.changed = False
+        openwrt.enable_dhcp(runner, waker=waker)
+    # the second check follows the wake-up instead of the pause before it
+    assert time.monotonic() - start < openwrt.CONSOLE_MIN_DELAY * 2
@@ -1,6 +1,6 @@
 from unittest.mock import MagicMock
 
-from opkg import is_package_installed, list_installed_names
+from opkg import PackageDatabase, is_package_installed, list_installed_names, rewrite_distfeeds
 
 OPKG_LIST_INSTALLED_OUTPUT: str = """base-files - 1559-r24012-d8dd03c46f
 bnx2-firmware - 20230804-1
@@ -106,3 +106,37 @@ def test_is_package_installed() -> None:
     shell.run_check.return_value = OPKG_LIST_INSTALLED_OUTPUT.split("\n")
 
     assert is_package_installed(shell, "kmod-ixgbe")
+
+
+def test_package_database() -> None:
+    shell = MagicMock()
+    shell.run_check.return_value = OPKG_LIST_INSTALLED_OUTPUT.split("\n")
+    packages = PackageDatabase(shell)
+
+    assert packages.is_installed("dnsmasq", "dropbear")
+    assert packages.missing("dnsmasq", "openvpn-openssl", "iperf3") == ["openvpn-openssl", "iperf3"]
+    assert packages.ensure_installed("dnsmasq", "openvpn-openssl", "iperf3") == ["openvpn-openssl", "iperf3"]
+    assert [call.args[0] for call in shell.run_check.call_args_list] == [
+        "opkg list-installed",
+        "opkg update",
+        "opkg install openvpn-openssl iperf3",
+    ]
+
+    # the listing is refreshed after installing
+    packages.is_installed("dnsmasq")
+    assert shell.run_check.call_args_list[-1].args[0] == "opkg list-installed"
+
+
+def test_rewrite_distfeeds() -> None:
+    distfeeds = """src/gz openwrt_core https://downloads.openwrt.org/releases/24.10.0/targets/x86/64/packages
+src/gz openwrt_base https://downloads.openwrt.org/releases/24.10.0/packages/x86_64/base
+src/gz openwrt_kmods https://downloads.openwrt.org/releases/24.10.0/targets/x86/64/kmods/6.6.73-1-a
+# src/gz openwrt_custom https://example.com/feed
+"""
+    assert rewrite_distfeeds(distfeeds, "http://artifacts:8000/feeds/", feeds=["openwrt_core", "openwrt_base"]) == (
+        """src/gz openwrt_core http://artifacts:8000/feeds/releases/24.10.0/targets/x86/64/packages
+src/gz openwrt_base http://artifacts:8000/feeds/releases/24.10.0/packages/x86_64/base
+# src/gz openwrt_kmods https://downloads.openwrt.org/releases/24.10.0/targets/x86/64/kmods/6.6.73-1-a
+# src/gz openwrt_custom https://example.com/feed
+"""
+    )
@@ -0,0 +1,135 @@
+import asyncio
+import threading
+
+import pytest
+from conftest import FakeQMPServer
+from func import wait_for
+from qmp import AsyncQMPClient, QMPConnectionError, QMPError, QMPSession, hmp
+
+
+def test_qmp_session_reuses_connection(qmp_server: FakeQMPServer) -> None:
+    session = QMPSession(qmp_server.address)
+    try:
+        assert session.execute("query-status") == {"command": "query-status", "arguments": {}}
+        assert session.execute("cont", {"a": 1}) == {"command": "cont", "arguments": {"a": 1}}
+        assert qmp_server.connections == 1
+        assert qmp_server.commands == ["qmp_capabilities", "query-status", "cont"]
+    finally:
+        session.close()
+
+
+def test_qmp_session_reconnects(qmp_server: FakeQMPServer) -> None:
+    session = QMPSession(qmp_server.address)
+    try:
+        session.execute("query-status")
+        qmp_server.drop_clients()
+        wait_for(lambda: not session.connected, "QMP session noticed the dropped connection", timeout=5)
+        assert session.execute("query-status") == {"command": "query-status", "arguments": {}}
+        assert qmp_server.connections == 2
+    finally:
+        session.close()
+
+
+def test_qmp_session_does_not_repeat_sent_commands(qmp_server: FakeQMPServer) -> None:
+    session = QMPSession(qmp_server.address, timeout=5)
+    try:
+        session.execute("query-status")
+        with pytest.raises(QMPConnectionError):
+            session.execute("drop")
+        assert qmp_server.commands.count("drop") == 1
+        assert session.execute("query-status") == {"command": "query-status", "arguments": {}}
+    finally:
+        session.close()
+
+
+def test_qmp_session_close_ends_subscriptions(qmp_server: FakeQMPServer) -> None:
+    session = QMPSession(qmp_server.address, timeout=5)
+    session.execute("query-status")
+    with session.events("RESET") as reset_events:
+        threading.Timer(0.1, session.close).start()
+        with pytest.raises(QMPConnectionError):
+            reset_events.wait(timeout=5)
+
+
+def test_qmp_session_error(qmp_server: FakeQMPServer) -> None:
+    session = QMPSession(qmp_server.address)
+    try:
+        with pytest.raises(QMPError):
+            session.execute("fail")
+        assert qmp_server.connections == 1
+    finally:
+        session.close()
+
+
+def test_qmp_session_events(qmp_server: FakeQMPServer) -> None:
+    session = QMPSession(qmp_server.address)
+    received: list[str] = []
+    session.subscribe(lambda event: received.append(event["event"]))
+    try:
+        with session.events("RESET") as reset_events:
+            session.execute("system_reset")
+            assert reset_events.wait(timeout=5)["data"] == {"guest": False}
+        assert received == ["STOP", "RESET"]
+    finally:
+        session.close()
+
+
+def test_async_qmp_client_concurrent_commands(qmp_server: FakeQMPServer) -> None:
+    async def run() -> None:
+        client = AsyncQMPClient()
+        await client.connect(qmp_server.address)
+        async with client.events("STOP") as events:
+            results = await asyncio.gather(*(client.execute("query-status", {"n": n}) for n in range(5)))
+            assert [result["arguments"]["n"] for result in results] == list(range(5))
+            assert (await anext(events))["event"] == "STOP"
+        assert not client._streams
+        with pytest.raises(QMPError):
+            await client.execute("fail")
+        await client.close()
+        assert not client.connected
+
+    asyncio.run(run())
+
+
+def test_qmp_session_batch(qmp_server: FakeQMPServer) -> None:
+    session = QMPSession(qmp_server.address)
+    try:
+        results = session.execute_batch([("query-status", None), ("fail", None), hmp("info usernet")])
+        assert [result.ok for result in results] == [True, False, True]
+        assert results[0].unwrap() == {"command": "query-status", "arguments": {}}
+        assert results[2].result == ""
+        with pytest.raises(QMPError):
+            results[1].unwrap()
+        assert qmp_server.commands == ["qmp_capabilities", "query-status", "fail", "human-monitor-command"]
+    finally:
+        session.close()
+
+
+def test_qmp_session_answer_without_id(qmp_server: FakeQMPServer) -> None:
+    session = QMPSession(qmp_server.address, timeout=5)
+    try:
+        with pytest.raises(QMPError):
+            session.execute("malformed")
+        assert session.execute("query-status") == {"command": "query-status", "arguments": {}}
+    finally:
+        session.close()
+
+
+def test_qmp_session_rejects_calls_from_event_callbacks(qmp_server: FakeQMPServer) -> None:
+    session = QMPSession(qmp_server.address, timeout=5)
+    errors: list[Exception] = []
+
+    def callback(event: dict) -> None:
+        try:
+            session.execute("query-status")
+        except RuntimeError as exc:
+            errors.append(exc)
+
+    session.subscribe(callback)
+    try:
+        with session.events("RESET") as reset_events:
+            session.execute("system_reset")
+            reset_events.wait(timeout=5)
+        assert errors
+    finally:
+        session.close()
@@ -0,0 +1,110 @@
+import subprocess
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+import uci
+from uci import Snapshot, Transaction, UciError
+
+
+def test_transaction_script() -> None:
+    transaction = Transaction(MagicMock())
+    transaction.set("dhcp.@dnsmasq[0].domainneeded", False).add_list("firewall.@zone[0].device", "tun 0")
+    transaction.commit("dhcp")
+    assert transaction.script() == (
+        "(f=0; "
+        "o=$(uci set 'dhcp.@dnsmasq[0].domainneeded=0' 2>&1) || { f=1; echo \"@uci-error 0\" $o; }; "
+        "o=$(uci add_list 'firewall.@zone[0].device=tun 0' 2>&1) || { f=1; echo \"@uci-error 1\" $o; }; "
+        'if [ "$f" = 0 ]; then o=$(uci commit dhcp 2>&1) || echo "@uci-error 2" $o; '
+        "else uci revert dhcp; uci revert firewall; fi)"
+    )
+
+
+def run_script(script: str) -> tuple[list[str], list[str], int]:
+    """Runs the script against a fake uci which rejects setting keys starting with `bad`"""
+    fake_uci = 'uci() { case "$1 $2" in show*) cat "$2" 2>/dev/null; return;; "set bad"*) echo "uci: Invalid argument" >&2; return 1;; esac; echo "$@" >> log; }'
+    process = subprocess.run(["/bin/sh", "-c", f"{fake_uci}; {script}"], capture_output=True, text=True)
+    return process.stdout.splitlines(), [], process.returncode
+
+
+def test_transaction_apply(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    runner = MagicMock()
+    runner.run.side_effect = run_script
+
+    with Transaction(runner) as transaction:
+        transaction.set("network.lan.proto", "dhcp")
+        transaction.commit("network")
+    assert (tmp_path / "log").read_text().splitlines() == ["set network.lan.proto=dhcp", "commit network"]
+    assert transaction.changed
+    # one for loading the snapshot, one for applying the transaction
+    assert runner.run.call_count == 2
+
+
+def test_transaction_reports_failed_operations(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    runner = MagicMock()
+    runner.run.side_effect = run_script
+
+    transaction = Transaction(runner, diff=False).set("network.lan.proto", "dhcp").set("bad.key", 1).commit("network")
+    with pytest.raises(UciError) as exc_info:
+        transaction.apply()
+    assert [(str(operation), message) for operation, message in exc_info.value.failures] == [
+        ("uci set bad.key=1", "uci: Invalid argument")
+    ]
+    assert (tmp_path / "log").read_text().splitlines() == [
+        "set network.lan.proto=dhcp",
+        "revert network",
+        "revert bad",
+    ]
+
+
+UCI_SHOW_OUTPUT = """dhcp.@dnsmasq[0]=dnsmasq
+dhcp.@dnsmasq[0].domainneeded='1'
+dhcp.@dnsmasq[0].server='/lan/' 'it'\\''s'
+"""
+
+
+def test_snapshot() -> None:
+    snapshot = Snapshot.parse("dhcp", UCI_SHOW_OUTPUT)
+    assert snapshot.get("dhcp.@dnsmasq[0]") == "dnsmasq"
+    assert snapshot.get("dhcp.@dnsmasq[0].domainneeded") == "1"
+    assert snapshot.get_list("dhcp.@dnsmasq[0].server") == ["/lan/", "it's"]
+    assert snapshot.get("dhcp.@dnsmasq[0].missing") is None
+
+
+def test_transaction_skips_unchanged_values(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "dhcp").write_text(UCI_SHOW_OUTPUT)
+    runner = MagicMock()
+    runner.run.side_effect = run_script
+
+    assert uci.get(runner, "dhcp.@dnsmasq[0].domainneeded") == "1"
+    with Transaction(runner) as transaction:
+        transaction.set("dhcp.@dnsmasq[0].domainneeded", True)
+        transaction.add_list("dhcp.@dnsmasq[0].server", "/lan/")
+        transaction.commit("dhcp")
+    assert not transaction.changed
+    # the snapshot has been loaded once and nothing has been written
+    assert runner.run.call_count == 1
+    assert not (tmp_path / "log").exists()
+
+    with Transaction(runner) as transaction:
+        transaction.set("dhcp.@dnsmasq[0].domainneeded", False)
+        transaction.commit("dhcp")
+    assert transaction.changed
+    assert (tmp_path / "log").read_text().splitlines() == ["set dhcp.@dnsmasq[0].domainneeded=0", "commit dhcp"]
+
+    # the snapshot is loaded again after the commit
+    uci.get(runner, "dhcp.@dnsmasq[0].domainneeded")
+    assert runner.run.call_count == 3
+
+
+def test_get_missing_option(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "dhcp").write_text(UCI_SHOW_OUTPUT)
+    runner = MagicMock()
+    runner.run.side_effect = run_script
+
+    with pytest.raises(KeyError):
+        uci.get(runner, "dhcp.@dnsmasq[0].missing")
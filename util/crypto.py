@@ -1,6 +1,17 @@
+import hashlib
 import secrets
 import string
+from pathlib import Path
 
 
 def generate_random_string(k: int) -> str:
     return "".join(secrets.choice(string.ascii_letters + string.digits) for _ in range(k))
+
+
+def sha256_file(path: Path, chunk_size: int = 1 << 20) -> str:
+    """Returns the hex encoded SHA-256 digest of the file at `path`."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
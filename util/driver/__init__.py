@@ -1,5 +1,6 @@
 from .base_qemudriver import BaseQEMUDriver, Endpoint
 from .custom_qemudriver import CustomQEMUDriver
+from .guestagent import GuestAgentDriver
 from .params import QEMUParams
 from .stateful_qemudriver import StatefulQEMUDriver
 
@@ -7,6 +8,7 @@ __all__ = [
     "BaseQEMUDriver",
     "CustomQEMUDriver",
     "Endpoint",
+    "GuestAgentDriver",
     "QEMUParams",
     "StatefulQEMUDriver",
 ]
@@ -1,19 +1,20 @@
 import re
 import select
 import socket
-import time
 from dataclasses import dataclass
+from pathlib import Path
 
 import attr
+from func import Waker
 from labgrid.driver import Driver
 from labgrid.driver.consoleexpectmixin import ConsoleExpectMixin
 from labgrid.protocol import ConsoleProtocol
 from labgrid.step import step
 from labgrid.util import get_free_port
 from pexpect import TIMEOUT
-from qmp import QMPMonitor
+from qmp import QMPCommand, QMPError, QMPEventSubscription, QMPResult, QMPSession, hmp
 
-from driver.params import get_qmp_port
+from driver.params import get_console_port, get_qmp_port
 
 
 @dataclass(frozen=True)
@@ -22,6 +23,34 @@ class Endpoint:
     port: int
 
 
+# address of a socket: a TCP endpoint or the path of a Unix domain socket
+SocketAddress = Endpoint | Path
+
+
+def socket_address(address: SocketAddress) -> tuple[str, int] | str:
+    """Returns the address of a socket in the form the socket module expects it"""
+    return str(address) if isinstance(address, Path) else (address.addr, address.port)
+
+
+def connect(address: SocketAddress, timeout: float | None = None) -> socket.socket:
+    if isinstance(address, Path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(str(address))
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+    return socket.create_connection((address.addr, address.port), timeout)
+
+
+def listen(address: SocketAddress) -> socket.socket:
+    if isinstance(address, Path):
+        return socket.create_server(str(address), family=socket.AF_UNIX)
+    return socket.create_server((address.addr, address.port))
+
+
 PORT_FORWARDING_PATTERN = re.compile(r"TCP\[HOST_FORWARD\]\s+\d+\s+([\w\.-]+)\s+(\d+)\s+([\w\.-]+)\s+(\d+)")
 
 
@@ -33,55 +62,158 @@ def parse_port_forwardings(qmp_output: str) -> dict[Endpoint, Endpoint]:
     return result
 
 
+class ForwardTable:
+    """Host forwards of QEMU's user mode network, indexed by guest and by host endpoint"""
+
+    def __init__(self, forwards: dict[Endpoint, Endpoint] | None = None) -> None:
+        self._by_guest: dict[Endpoint, Endpoint] = {}
+        self._by_host: dict[Endpoint, Endpoint] = {}
+        for guest_endpoint, host_endpoint in (forwards or {}).items():
+            self.add(host_endpoint, guest_endpoint)
+
+    def add(self, host_endpoint: Endpoint, guest_endpoint: Endpoint) -> None:
+        self.remove(host_endpoint)
+        self._by_host[host_endpoint] = guest_endpoint
+        self._by_guest[guest_endpoint] = host_endpoint
+
+    def remove(self, host_endpoint: Endpoint) -> Endpoint | None:
+        """Removes the forward from the given host endpoint and returns the guest endpoint it pointed to"""
+        guest_endpoint = self._by_host.pop(host_endpoint, None)
+        if guest_endpoint is not None and self._by_guest.get(guest_endpoint) == host_endpoint:
+            del self._by_guest[guest_endpoint]
+            # another host endpoint may still forward to the same guest endpoint
+            for other_host, other_guest in self._by_host.items():
+                if other_guest == guest_endpoint:
+                    self._by_guest[guest_endpoint] = other_host
+                    break
+        return guest_endpoint
+
+    def host_endpoint(self, guest_endpoint: Endpoint) -> Endpoint | None:
+        return self._by_guest.get(guest_endpoint)
+
+    def guest_endpoint(self, host_endpoint: Endpoint) -> Endpoint | None:
+        return self._by_host.get(host_endpoint)
+
+    def as_dict(self) -> dict[Endpoint, Endpoint]:
+        """Returns the mapping of guest endpoints to host endpoints, like :func:`parse_port_forwardings`"""
+        return dict(self._by_guest)
+
+
 @attr.s(eq=False)
 class BaseQEMUDriver(ConsoleExpectMixin, Driver, ConsoleProtocol):
+    """
+    Args:
+        read_chunk_size (int): maximum number of bytes a single console read returns
+    """
+
+    read_chunk_size: int = attr.ib(default=65536, validator=attr.validators.instance_of(int))
+
     def __attrs_post_init__(self) -> None:
         super().__attrs_post_init__()
         self.txdelay = None
         self._socket: socket.socket | None = None
+        self._read_buffer = memoryview(bytearray(self.read_chunk_size))
+        self._qmp: QMPSession | None = None
+        self._forwards: ForwardTable | None = None
 
     def on_activate(self) -> None:
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.connect(("localhost", 12345))
+        self._socket = connect(self.console_endpoint)
 
     def on_deactivate(self) -> None:
         assert self._socket
 
         self._socket.close()
         self._socket = None
+        self._close_qmp()
+
+    @property
+    def console_endpoint(self) -> SocketAddress:
+        """Endpoint the serial console is connected through"""
+        return Endpoint("localhost", get_console_port())
+
+    @property
+    def qmp_endpoint(self) -> SocketAddress:
+        """Endpoint of the QEMU Machine Protocol server"""
+        return Endpoint("localhost", get_qmp_port())
+
+    @property
+    def qmp(self) -> QMPSession:
+        """QMP session which is kept open until the driver gets deactivated"""
+        if self._qmp is None:
+            self._qmp = QMPSession(socket_address(self.qmp_endpoint))
+            self._qmp.subscribe(self._on_qmp_event)
+        return self._qmp
+
+    def _on_qmp_event(self, event: dict) -> None:
+        if event["event"] == "RESET":
+            self._forwards = None
+
+    def qmp_events(self, *names: str) -> QMPEventSubscription:
+        """Collect the QMP events with the given names, e.g. RESET, SHUTDOWN or STOP"""
+        return self.qmp.events(*names)
+
+    def qmp_waker(self, *names: str) -> Waker:
+        """Waker which wakes up on the QMP events with the given names (or on any event if none are given)"""
+        waker = Waker()
+        waker.add_cleanup(
+            self.qmp.subscribe(lambda event: waker.wake() if not names or event["event"] in names else None)
+        )
+        return waker
+
+    def console_waker(self, pattern: bytes | re.Pattern[bytes]) -> Waker:
+        """Waker which wakes up whenever the console output matches `pattern`. The console is not shared here, so
+        it never wakes up and waiting falls back to polling."""
+        return Waker()
+
+    def _close_qmp(self) -> None:
+        if self._qmp is not None:
+            self._qmp.close()
+        self._qmp = None
+        # QEMU may be restarted before the next session is opened
+        self._forwards = None
 
     @step(result=True, args=["command", "arguments"])
     def monitor_command(self, command: str, arguments: dict | None = None) -> str:
         """Execute a monitor_command via the QMP"""
-        socket_qmp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        socket_qmp.connect(("localhost", get_qmp_port()))
-        try:
-            qmp_file = socket_qmp.makefile("rw")
+        if arguments is None:
+            arguments = {}
+        return self.qmp.execute(command, arguments)
 
-            def write_flush(msg: str) -> None:
-                qmp_file.write(msg)
-                qmp_file.flush()
+    @step(result=True, args=["commands"])
+    def monitor_commands(self, commands: list[QMPCommand]) -> list[QMPResult]:
+        """Execute several monitor_commands via the QMP within a single round trip"""
+        return self.qmp.execute_batch(commands)
 
-            qmp = QMPMonitor(qmp_file.readline, write_flush)
+    @staticmethod
+    def _hostfwd_add_command(local_address: str, local_port: int, remote_address: str, remote_port: int) -> QMPCommand:
+        proto: str = "tcp"  # only this protocol is currently supported
+        return hmp(f"hostfwd_add {proto}:{local_address}:{local_port}-{remote_address}:{remote_port}")
 
-            if arguments is None:
-                arguments = {}
-            return qmp.execute(command, arguments)
-        finally:
-            socket_qmp.close()
+    @staticmethod
+    def _hostfwd_remove_command(local_endpoint: Endpoint) -> QMPCommand:
+        proto: str = "tcp"  # only this protocol is currently supported
+        return hmp(f"hostfwd_remove {proto}:{local_endpoint.addr}:{local_endpoint.port}")
+
+    def _monitor_commands_check(self, commands: list[QMPCommand]) -> None:
+        try:
+            for result in self.monitor_commands(commands):
+                result.unwrap()
+        except QMPError:
+            # some of the commands may have been applied, so the forward table has to be read again
+            self._forwards = None
+            raise
 
     def _add_port_forward(self, local_address: str, local_port: int, remote_address: str, remote_port: int) -> None:
-        proto: str = "tcp"  # only this protocol is currently supported
-        self.monitor_command(
-            "human-monitor-command",
-            {"command-line": f"hostfwd_add {proto}:{local_address}:{local_port}-{remote_address}:{remote_port}"},
+        self._monitor_commands_check(
+            [self._hostfwd_add_command(local_address, local_port, remote_address, remote_port)]
         )
+        self.forward_table.add(Endpoint(local_address, local_port), Endpoint(remote_address, remote_port))
 
     def add_hostfwd(self, remote_address: str, remote_port: int) -> Endpoint:
         remote_endpoint = Endpoint(remote_address, remote_port)
-        host_forward = self.port_forwardings  # cache
-        if remote_endpoint in host_forward:
-            return host_forward[remote_endpoint]
+        current_local_endpoint = self.forward_table.host_endpoint(remote_endpoint)
+        if current_local_endpoint is not None:
+            return current_local_endpoint
         local_endpoint = Endpoint("127.0.0.1", get_free_port())
         self._add_port_forward(local_endpoint.addr, local_endpoint.port, remote_address, remote_port)
         return local_endpoint
@@ -89,38 +221,75 @@ class BaseQEMUDriver(ConsoleExpectMixin, Driver, ConsoleProtocol):
     def add_port_forwarding(self, local_address: str, local_port: int, remote_address: str, remote_port: int) -> None:
         local_endpoint = Endpoint(local_address, local_port)
         remote_endpoint = Endpoint(remote_address, remote_port)
-        host_forward = self.port_forwardings  # cache
-        if host_forward.get(remote_endpoint, None) == local_endpoint:
+        current_local_endpoint = self.forward_table.host_endpoint(remote_endpoint)
+        if current_local_endpoint == local_endpoint:
             return
-        self.remove_port_forward(remote_endpoint)
-        self._add_port_forward(local_endpoint.addr, local_endpoint.port, remote_address, remote_port)
+        self.update_port_forwardings(
+            [current_local_endpoint] if current_local_endpoint is not None else [], {local_endpoint: remote_endpoint}
+        )
+
+    @step(args=["remove", "add"])
+    def update_port_forwardings(self, remove: list[Endpoint], add: dict[Endpoint, Endpoint]) -> None:
+        """Removes and adds host forwards within a single round trip.
+
+        Args:
+            remove (list[Endpoint]): host endpoints whose forwards are removed first
+            add (dict[Endpoint, Endpoint]): forwards to add, mapping host endpoints to guest endpoints
+        """
+        if not remove and not add:
+            return
+        forward_table = self.forward_table
+        commands = [self._hostfwd_remove_command(local_endpoint) for local_endpoint in remove]
+        commands += [
+            self._hostfwd_add_command(local.addr, local.port, remote.addr, remote.port) for local, remote in add.items()
+        ]
+        self._monitor_commands_check(commands)
+        for local_endpoint in remove:
+            forward_table.remove(local_endpoint)
+        for local_endpoint, remote_endpoint in add.items():
+            forward_table.add(local_endpoint, remote_endpoint)
 
     def remove_port_forward(self, local_endpoint: Endpoint) -> None:
-        proto: str = "str"  # only this protocol is currently supported
-        self.monitor_command(
-            "human-monitor-command",
-            {"command-line": f"hostfwd_remove {proto}:{local_endpoint.addr}:{local_endpoint.port}"},
-        )
+        self._monitor_commands_check([self._hostfwd_remove_command(local_endpoint)])
+        self.forward_table.remove(local_endpoint)
+
+    @property
+    def forward_table(self) -> ForwardTable:
+        """Host forwards as maintained by this driver, read from QEMU only when unknown, e.g. after a reset"""
+        if self._forwards is None:
+            return self.resync_port_forwardings()
+        return self._forwards
+
+    def resync_port_forwardings(self) -> ForwardTable:
+        """Reads the host forwards from QEMU, e.g. after they have been changed by someone else"""
+        qmp_output = self.monitor_command(*hmp("info usernet"))
+        self._forwards = ForwardTable(parse_port_forwardings(qmp_output))
+        return self._forwards
 
     @property
     def port_forwardings(self) -> dict[Endpoint, Endpoint]:
-        qmp_output = self.monitor_command("human-monitor-command", {"command-line": "info usernet"})
-        return parse_port_forwardings(qmp_output)
+        return self.forward_table.as_dict()
 
     def _read(self, size: int = 1, timeout: float = 10, max_size: int | None = None) -> bytes:
         assert self._socket
 
         ready, _, _ = select.select([self._socket], [], [], timeout)
-        if ready:
-            # Collect some more data
-            time.sleep(0.01)
-            # Always read a page, regardless of size
-            size = 4096
-            size = min(max_size, size) if max_size else size
-            res = self._socket.recv(size)
-        else:
+        if not ready:
             raise TIMEOUT(f"Timeout of {timeout:.2f} seconds exceeded")
-        return res
+        # Always read a whole chunk, regardless of size
+        limit = min(max_size, self.read_chunk_size) if max_size else self.read_chunk_size
+        view = self._read_buffer[:limit]
+        received = self._socket.recv_into(view)
+        # Drain whatever else has already arrived without waiting for more
+        while 0 < received < limit:
+            try:
+                count = self._socket.recv_into(view[received:], 0, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            if not count:
+                break
+            received += count
+        return bytes(view[:received])
 
     def _write(self, data: bytes) -> int:  # type: ignore
         assert self._socket
@@ -0,0 +1,360 @@
+import contextlib
+import logging
+import re
+import select
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+
+from func import Waker
+
+from .base_qemudriver import SocketAddress, listen
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+RECV_SIZE = 1 << 16
+
+
+class ConsoleReader:
+    """Buffer for the console output seen by one reader.
+
+    The buffer holds at most `max_size` bytes. When the reader falls behind, the oldest data is dropped so that a
+    slow reader never stalls the console or the other readers.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_BUFFER_SIZE) -> None:
+        self.max_size = max_size
+        self.dropped = 0
+        self.closed = False
+        self._chunks: deque[bytes] = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def feed(self, data: bytes) -> None:
+        with self._cond:
+            self._chunks.append(data)
+            self._size += len(data)
+            while self._size > self.max_size:
+                excess = self._size - self.max_size
+                head = self._chunks[0]
+                if len(head) <= excess:
+                    self._chunks.popleft()
+                    excess = len(head)
+                else:
+                    self._chunks[0] = head[excess:]
+                self._size -= excess
+                self.dropped += excess
+            self._cond.notify_all()
+
+    def read(self, timeout: float | None = None) -> bytes:
+        """Returns all buffered data, waiting up to `timeout` seconds for data to arrive.
+
+        Returns b"" once the console has been closed and all data has been read.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._chunks or self.closed, timeout):
+                raise TimeoutError(f"no console output within {timeout} seconds")
+            return self._take()
+
+    def _take(self) -> bytes:
+        with self._cond:
+            data = b"".join(self._chunks)
+            self._chunks.clear()
+            self._size = 0
+            return data
+
+    def __len__(self) -> int:
+        with self._cond:
+            return self._size
+
+    def close(self) -> None:
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class _PatternWatch:
+    # output is matched across chunk boundaries, up to this many bytes
+    MAX_TAIL = 4096
+
+    def __init__(self, pattern: re.Pattern[bytes], waker: Waker) -> None:
+        self.pattern = pattern
+        self.waker = waker
+        self._tail = b""
+
+    def feed(self, data: bytes) -> None:
+        output = self._tail + data
+        if match := self.pattern.search(output):
+            self.waker.wake()
+            output = output[match.end() :]
+        self._tail = output[-self.MAX_TAIL :]
+
+
+class _Client:
+    def __init__(self, sock: socket.socket, reader: ConsoleReader) -> None:
+        self.sock = sock
+        self.reader = reader
+        self.pending = b""
+
+
+class ConsoleMux:
+    """Shares a single serial console connection between several readers.
+
+    The upstream end (e.g. a QEMU chardev with `server=off`) connects to `upstream`. Network clients connect to
+    `listen` and in-process readers are attached with :meth:`reader`. Every reader sees all console output. Input
+    from any network client or from :meth:`write` is queued and forwarded upstream whenever the upstream end
+    accepts data, so an upstream end which stops reading does not stall the console output.
+
+    Both listening sockets, TCP endpoints or Unix domain sockets, are bound immediately, so clients do not have to
+    wait for them to come up.
+    """
+
+    def __init__(
+        self, upstream: SocketAddress, listen_address: SocketAddress, buffer_size: int = DEFAULT_BUFFER_SIZE
+    ) -> None:
+        self.buffer_size = buffer_size
+        self.logger = logging.getLogger(f"{self}")
+        self._upstream_listener = listen(upstream)
+        self._listener = listen(listen_address)
+        self._listener.setblocking(False)
+        self._upstream: socket.socket | None = None
+        # input waiting to be sent upstream, guarded by _write_lock
+        self._upstream_pending = bytearray()
+        self._write_lock = threading.Lock()
+        self._readers: list[ConsoleReader] = []
+        self._watches: list[_PatternWatch] = []
+        self._readers_lock = threading.Lock()
+        self._clients: dict[socket.socket, _Client] = {}
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._selector = selectors.DefaultSelector()
+        self._thread: threading.Thread | None = None
+        self._closed = False
+
+    def __str__(self) -> str:
+        return "ConsoleMux"
+
+    def start(self, timeout: float = 10, alive: Callable[[], bool] | None = None) -> None:
+        """Waits for the upstream end to connect and starts forwarding.
+
+        :param timeout: Timeout in seconds for the upstream connection.
+        :param alive: Optional check whether the upstream end (e.g. its process) is still running, so that
+            waiting for it is cut short when it has terminated.
+        :raises TimeoutError: If the upstream end does not connect within the timeout.
+        :raises ConnectionError: If the upstream end terminated before it connected.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Timeout while waiting for the console to connect to {self.upstream_address}.")
+            ready, _, _ = select.select([self._upstream_listener], [], [], min(remaining, 0.5))
+            if ready:
+                break
+            if alive is not None and not alive():
+                raise ConnectionError("console went away before connecting")
+        self._upstream, _ = self._upstream_listener.accept()
+        self._upstream.setblocking(False)
+        self._upstream_listener.close()
+
+        self._selector.register(self._upstream, selectors.EVENT_READ)
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._run, name="console-mux", daemon=True)
+        self._thread.start()
+
+    @property
+    def upstream_address(self) -> tuple[str, int] | str:
+        return self._upstream_listener.getsockname()
+
+    @property
+    def address(self) -> tuple[str, int] | str:
+        return self._listener.getsockname()
+
+    def reader(self, max_size: int | None = None) -> ConsoleReader:
+        """Attaches an in-process reader which receives all console output from now on"""
+        reader = ConsoleReader(max_size or self.buffer_size)
+        with self._readers_lock:
+            if self._closed:
+                reader.close()
+            else:
+                self._readers.append(reader)
+        return reader
+
+    def remove_reader(self, reader: ConsoleReader) -> None:
+        with self._readers_lock:
+            if reader in self._readers:
+                self._readers.remove(reader)
+        reader.close()
+
+    def pattern_waker(self, pattern: bytes | re.Pattern[bytes]) -> Waker:
+        """Returns a waker which wakes up whenever the console output matches `pattern`, e.g. a login prompt"""
+        waker = Waker()
+        watch = _PatternWatch(re.compile(pattern), waker)
+        with self._readers_lock:
+            self._watches.append(watch)
+
+        def remove() -> None:
+            with self._readers_lock:
+                if watch in self._watches:
+                    self._watches.remove(watch)
+
+        waker.add_cleanup(remove)
+        return waker
+
+    def write(self, data: bytes) -> None:
+        """Queues `data` to be sent upstream"""
+        if self._upstream is None or self._closed:
+            raise ConnectionError("console is not connected")
+        with self._write_lock:
+            self._upstream_pending += data
+        if threading.current_thread() is self._thread:
+            self._watch_upstream()
+        else:
+            # the selector thread starts watching the upstream end for writability
+            with contextlib.suppress(OSError):
+                self._wakeup_w.send(b"\0")
+
+    def _watch_upstream(self) -> None:
+        assert self._upstream
+        with self._write_lock:
+            pending = bool(self._upstream_pending)
+        self._selector.modify(self._upstream, selectors.EVENT_READ | (selectors.EVENT_WRITE if pending else 0))
+
+    def _run(self) -> None:
+        try:
+            while not self._closed:
+                for key, events in self._selector.select():
+                    if key.fileobj is self._wakeup_r:
+                        self._wakeup_r.recv(RECV_SIZE)
+                        self._watch_upstream()
+                    elif key.fileobj is self._upstream:
+                        if events & selectors.EVENT_WRITE and not self._flush_upstream():
+                            return
+                        if events & selectors.EVENT_READ and not self._forward_output():
+                            return
+                    elif key.fileobj is self._listener:
+                        self._accept()
+                    else:
+                        self._serve_client(key.fileobj, events)  # type: ignore[arg-type]
+        except Exception:
+            self.logger.exception("Console multiplexer failed")
+        finally:
+            self._shutdown()
+
+    def _forward_output(self) -> bool:
+        assert self._upstream
+        try:
+            data = self._upstream.recv(RECV_SIZE)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b""
+        if not data:
+            self.logger.info("Console closed by upstream")
+            return False
+        with self._readers_lock:
+            for reader in self._readers:
+                reader.feed(data)
+            for watch in self._watches:
+                watch.feed(data)
+        for client in self._clients.values():
+            client.reader.feed(data)
+            self._selector.modify(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        return True
+
+    def _flush_upstream(self) -> bool:
+        assert self._upstream
+        with self._write_lock:
+            try:
+                sent = self._upstream.send(self._upstream_pending)
+            except BlockingIOError:
+                return True
+            except OSError:
+                self.logger.info("Console closed by upstream")
+                return False
+            del self._upstream_pending[:sent]
+        self._watch_upstream()
+        return True
+
+    def _accept(self) -> None:
+        try:
+            sock, address = self._listener.accept()
+        except BlockingIOError:
+            return
+        self.logger.debug("Client %s attached", address)
+        sock.setblocking(False)
+        self._clients[sock] = _Client(sock, ConsoleReader(self.buffer_size))
+        self._selector.register(sock, selectors.EVENT_READ)
+
+    def _serve_client(self, sock: socket.socket, events: int) -> None:
+        # the client may have been dropped while handling an earlier event of the same batch
+        client = self._clients.get(sock)
+        if client is None:
+            return
+        if events & selectors.EVENT_READ and not self._forward_input(client):
+            return
+        if events & selectors.EVENT_WRITE:
+            self._flush(client)
+
+    def _forward_input(self, client: _Client) -> bool:
+        try:
+            data = client.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b""
+        if not data:
+            self._drop_client(client)
+            return False
+        self.write(data)
+        return True
+
+    def _flush(self, client: _Client) -> None:
+        if not client.pending:
+            client.pending = client.reader._take()
+        try:
+            sent = client.sock.send(client.pending)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._drop_client(client)
+            return
+        client.pending = client.pending[sent:]
+        if not client.pending and not len(client.reader):
+            self._selector.modify(client.sock, selectors.EVENT_READ)
+
+    def _drop_client(self, client: _Client) -> None:
+        if client.reader.dropped:
+            self.logger.warning("Client fell behind, %d bytes of console output were dropped", client.reader.dropped)
+        self._selector.unregister(client.sock)
+        del self._clients[client.sock]
+        client.sock.close()
+
+    def _shutdown(self) -> None:
+        with self._readers_lock:
+            self._closed = True
+            readers, self._readers = self._readers, []
+        for reader in readers:
+            reader.close()
+        for client in list(self._clients.values()):
+            self._drop_client(client)
+        self._selector.close()
+        self._listener.close()
+        self._wakeup_r.close()
+        if self._upstream is not None:
+            self._upstream.close()
+
+    def close(self) -> None:
+        """Disconnects all clients and the upstream end"""
+        if self._thread is None:
+            self._upstream_listener.close()
+            self._shutdown()
+        else:
+            self._closed = True
+            with contextlib.suppress(OSError):
+                self._wakeup_w.send(b"\0")
+            self._thread.join()
+            self._thread = None
+        self._wakeup_w.close()
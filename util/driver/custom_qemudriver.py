@@ -1,51 +1,51 @@
 """The QEMUDriver implements a driver to use a QEMU target"""
 
 import atexit
+import json
+import os
 import re
-import select
 import shlex
-import socket
+import shutil
 import subprocess
-import time
+import tempfile
+from pathlib import Path
 
 import attr
-from func import wait_for
+from func import Waker
 from labgrid.driver import Driver
 from labgrid.driver.consoleexpectmixin import ConsoleExpectMixin
 from labgrid.driver.exception import ExecutionError
 from labgrid.factory import target_factory
 from labgrid.protocol import ConsoleProtocol, PowerProtocol
 from labgrid.step import step
-from network import is_port_in_use
-from pexpect import TIMEOUT
 from process import kill_process
-from qmp import QMPMonitor
-
-from driver.params import get_qmp_port
+from qemu_img import convert, create_overlay
 
 from .base_qemudriver import BaseQEMUDriver
-
-
-def start_ser2net_mux(port_conn: int, port_accept: int) -> subprocess.Popen:
-    return subprocess.Popen(
-        [
-            "/usr/sbin/ser2net",
-            "-n",
-            "-d",
-            "-Y",
-            "connection: &con01",
-            "-Y",
-            f"  connector: tcp,localhost,{port_conn}",
-            "-Y",
-            f"  accepter: tcp,localhost,{port_accept}",
-            "-Y",
-            "  options:",
-            "-Y",
-            "    max-connections: 10",
-            "-Y",
-            "    mdns: false",
-        ],
-    )
+from .console_mux import ConsoleMux
+from .qemu_caps import QEMUCapabilities, qemu_capabilities
+from .remote_disk import DISK_NODE, RemoteImage
+from .snapshot import Snapshot, SnapshotCache, snapshot_key
+
+# configuration which a VM state snapshot can only be restored with; per-run values such as paths of temporary
+# files and ports are not part of it
+SNAPSHOT_ATTRIBUTES = (
+    "machine",
+    "cpu",
+    "memory",
+    "extra_args",
+    "boot_args",
+    "kernel",
+    "disk_opts",
+    "rootfs",
+    "dtb",
+    "flash",
+    "bios",
+    "display",
+    "nic",
+    "smp",
+    "guest_agent",
+)
 
 
 @target_factory.reg_driver
@@ -76,6 +76,19 @@ class CustomQEMUDriver(BaseQEMUDriver, ConsoleExpectMixin, Driver, PowerProtocol
             fb-headless: Create a headless framebuffer device
             egl-headless: Create a headless GPU-backed graphics card. Requires host support
         nic (str): optional, configuration string to pass to QEMU to create a network interface
+        snapshot_dir (str): optional, experimental, directory to cache VM state snapshots in; on() resumes from a
+            cached snapshot instead of cold booting if one matches the configuration, disk image and QEMU version.
+            The disk has to be an immutable base image (overlay or lazy mode), cycle() always cold boots
+        snapshot_keep (int, default=2): optional, number of snapshots kept in snapshot_dir, the least recently
+            used ones are removed
+        accel (str, default="auto"): optional, accelerator to use; must be one of:
+            auto: KVM if /dev/kvm is usable and QEMU supports it, multi-threaded TCG otherwise
+            kvm: KVM, fails if it is not usable
+            tcg: multi-threaded TCG
+        smp (str): optional, vCPU topology passed to -smp, e.g. "4" or "cpus=4,cores=2"
+        guest_agent (bool, default=False): optional, attach a virtio-serial channel for the QEMU guest agent,
+            which the GuestAgentDriver runs commands through; the guest has to run qemu-ga
+        read_chunk_size (int, default=65536): optional, maximum number of bytes a single console read returns
     """
 
     qemu_bin: str | None = attr.ib(default=None, validator=attr.validators.instance_of(str))
@@ -101,30 +114,164 @@ class CustomQEMUDriver(BaseQEMUDriver, ConsoleExpectMixin, Driver, PowerProtocol
         ),
     )
     nic: str | None = attr.ib(default=None, validator=attr.validators.optional(attr.validators.instance_of(str)))
+    accel: str = attr.ib(
+        default="auto",
+        validator=attr.validators.and_(
+            attr.validators.instance_of(str),
+            attr.validators.in_(["auto", "kvm", "tcg"]),
+        ),
+    )
+    smp: str | None = attr.ib(default=None, validator=attr.validators.optional(attr.validators.instance_of(str)))
+    guest_agent: bool = attr.ib(default=False, validator=attr.validators.instance_of(bool))
+    snapshot_dir: str | None = attr.ib(
+        default=None, validator=attr.validators.optional(attr.validators.instance_of(str))
+    )
+    snapshot_keep: int = attr.ib(default=2, validator=attr.validators.instance_of(int))
 
     def __attrs_post_init__(self) -> None:
         super().__attrs_post_init__()
         self.status: int = 0
+        self.restored_snapshot: Snapshot | None = None
         self._child_qemu: subprocess.Popen | None = None
-        self._child_ser2net: subprocess.Popen | None = None
+        self._console_mux: ConsoleMux | None = None
+        self._runtime_dir: Path | None = None
+        self._disk_path: str | None = None
+        # when set, QEMU runs on a fresh qcow2 overlay over this image instead of the configured disk
+        self.disk_base: Path | None = None
+        # when set, QEMU runs on a fresh qcow2 overlay over this image, reading it on demand from an HTTP server
+        self.disk_remote: RemoteImage | None = None
+        self._snapshot_key: str | None = None
         atexit.register(self._atexit)
 
     def _atexit(self) -> None:
-        kill_process(self._child_ser2net)
-        self._child_ser2net = None
+        self._close_console_mux()
         kill_process(self._child_qemu)
         self._child_qemu = None
+        self._remove_runtime_dir()
+
+    # QEMU is controlled through Unix domain sockets in the private runtime directory of each instance, so that
+    # several VMs can run side by side without competing for TCP ports
+
+    @property
+    def serial_endpoint(self) -> Path:
+        """Socket QEMU's serial port chardev connects to"""
+        return self.runtime_dir / "serial.sock"
+
+    @property
+    def guest_agent_endpoint(self) -> Path | None:
+        """Socket of the guest agent channel, if enabled"""
+        return self.runtime_dir / "guest-agent.sock" if self.guest_agent else None
+
+    @property
+    def console_mux(self) -> ConsoleMux | None:
+        """Multiplexer sharing the serial console of the running VM, e.g. to attach a log recorder"""
+        return self._console_mux
+
+    def console_waker(self, pattern: bytes | re.Pattern[bytes]) -> Waker:
+        """Waker which wakes up whenever the console output of the running VM matches `pattern`"""
+        if self._console_mux is None:
+            return super().console_waker(pattern)
+        return self._console_mux.pattern_waker(pattern)
+
+    def _close_console_mux(self) -> None:
+        if self._console_mux is not None:
+            self._console_mux.close()
+        self._console_mux = None
+
+    @property
+    def console_endpoint(self) -> Path:
+        return self.runtime_dir / "console.sock"
+
+    @property
+    def qmp_endpoint(self) -> Path:
+        return self.runtime_dir / "qmp.sock"
+
+    @property
+    def runtime_dir(self) -> Path:
+        """Directory for files which only live as long as the QEMU instance"""
+        if self._runtime_dir is None:
+            self._runtime_dir = Path(tempfile.mkdtemp(prefix="labgrid-qemu-"))
+        return self._runtime_dir
+
+    def _remove_runtime_dir(self) -> None:
+        if self._runtime_dir is not None:
+            shutil.rmtree(self._runtime_dir, ignore_errors=True)
+        self._runtime_dir = None
+
+    @property
+    def qemu_img(self) -> str:
+        assert self.target
+        return self.target.env.config.get_tool("qemu-img")
+
+    def get_disk_path(self) -> str | None:
+        """Returns the path of the disk image QEMU is started with"""
+        assert self.target
+        if self._disk_path is not None:
+            return self._disk_path
+        if self.disk is None:
+            return None
+        return self.target.env.config.get_image_path(self.disk)
+
+    @property
+    def snapshots(self) -> SnapshotCache | None:
+        assert self.target
+        if self.snapshot_dir is None:
+            return None
+        return SnapshotCache(Path(self.target.env.config.resolve_path(self.snapshot_dir)), self.snapshot_keep)
+
+    @property
+    def snapshot_capable(self) -> bool:
+        """Whether the disk is immutable, so that a snapshot can be keyed by its content; a disk which QEMU writes
+        to directly would change with every run and produce a new snapshot each time"""
+        return self.disk is None or self.disk_base is not None or self.disk_remote is not None
+
+    def get_snapshot_key(self) -> str:
+        """Returns the key of the snapshot cache entry matching the current VM configuration"""
+        assert self.target
+        qemu_bin = self.target.env.config.get_tool(self.qemu_bin)
+        capabilities = self.get_qemu_capabilities(qemu_bin)
+        config = {name: getattr(self, name) for name in SNAPSHOT_ATTRIBUTES}
+        # the memory state can only be restored with the accelerator it was saved with
+        config["accel"] = self.get_accelerator(capabilities)
+        if self.disk_remote is not None:
+            # the remote image is identified by its URL and the entity tag in the cache name
+            config["disk_remote"] = self.disk_remote.cache_path.name
+            image = None
+        else:
+            image = self.disk_base
+        return snapshot_key(config, image, capabilities.version)
+
+    def get_qemu_capabilities(self, qemu_bin: str) -> QEMUCapabilities:
+        return qemu_capabilities(qemu_bin)
 
     def get_qemu_version(self, qemu_bin: str) -> tuple[int, int, int]:
-        p = subprocess.run([qemu_bin, "-version"], stdout=subprocess.PIPE, encoding="utf-8")
-        if p.returncode != 0:
-            raise ExecutionError(f"Unable to get QEMU version. QEMU exited with: {p.returncode}")  # type: ignore
+        return self.get_qemu_capabilities(qemu_bin).version
 
-        m = re.search(r"(?P<major>\d+)\.(?P<minor>\d+)\.(?P<micro>\d+)", p.stdout.splitlines()[0])
-        if m is None:
-            raise ExecutionError(f"Unable to find QEMU version in: {p.stdout.splitlines()[0]}")  # type: ignore
+    def check_qemu_capabilities(self, capabilities: QEMUCapabilities) -> None:
+        """Checks that the configured machine, cpu and display are supported by the QEMU binary"""
+        assert self.machine
+        assert self.cpu
 
-        return (int(m.group("major")), int(m.group("minor")), int(m.group("micro")))
+        if self.machine.split(",")[0] not in capabilities.machines:
+            raise ExecutionError(f"QEMU does not support machine '{self.machine}'")  # type: ignore
+        cpu = self.cpu.split(",")[0]
+        if capabilities.cpus and cpu not in capabilities.cpus | {"host", "max"}:
+            raise ExecutionError(f"QEMU does not support cpu '{self.cpu}'")  # type: ignore
+        if self.display == "egl-headless" and "egl-headless" not in capabilities.displays:
+            raise ExecutionError("QEMU does not support the egl-headless display")  # type: ignore
+
+    def get_accelerator(self, capabilities: QEMUCapabilities) -> str:
+        """Returns the -accel option according to the accel policy"""
+        kvm_usable = "kvm" in capabilities.accelerators and os.access("/dev/kvm", os.R_OK | os.W_OK)
+        if self.accel == "kvm" and not kvm_usable:
+            raise ExecutionError("KVM has been requested but /dev/kvm is not usable")  # type: ignore
+        return "kvm" if kvm_usable and self.accel != "tcg" else "tcg,thread=multi"
+
+    def select_accelerator(self, capabilities: QEMUCapabilities) -> str:
+        """Returns the -accel option according to the accel policy and logs it"""
+        accel = self.get_accelerator(capabilities)
+        self.logger.info("Using accelerator %s", accel)
+        return accel
 
     def get_qemu_base_args(self) -> list[str]:
         """Returns the base command line used for Qemu without the options
@@ -144,15 +291,19 @@ class CustomQEMUDriver(BaseQEMUDriver, ConsoleExpectMixin, Driver, PowerProtocol
             raise KeyError("QEMU Binary Path not configured in tools configuration key")
         cmd = [qemu_bin]
 
-        qemu_version = self.get_qemu_version(qemu_bin)
+        capabilities = self.get_qemu_capabilities(qemu_bin)
+        self.check_qemu_capabilities(capabilities)
+        qemu_version = capabilities.version
 
         boot_args = []
 
         if self.kernel is not None:
             cmd.append("-kernel")
             cmd.append(self.target.env.config.get_image_path(self.kernel))
-        if self.disk is not None:
-            disk_path = self.target.env.config.get_image_path(self.disk)
+        if self.disk_remote is not None:
+            cmd += self.get_remote_disk_args()
+            boot_args.append("root=/dev/vda rootwait")
+        elif (disk_path := self.get_disk_path()) is not None:
             disk_format = "raw"
             if disk_path.endswith(".qcow2"):
                 disk_format = "qcow2"
@@ -185,16 +336,23 @@ class CustomQEMUDriver(BaseQEMUDriver, ConsoleExpectMixin, Driver, PowerProtocol
             cmd.append("-bios")
             cmd.append(self.target.env.config.get_image_path(self.bios))
 
-        if "-append" in shlex.split(self.extra_args):
+        extra_args = shlex.split(self.extra_args)
+        if "-append" in extra_args:
             raise ExecutionError("-append in extra_args not allowed, use boot_args instead")  # type: ignore
 
-        cmd.extend(shlex.split(self.extra_args))
+        cmd.extend(extra_args)
         cmd.append("-machine")
         cmd.append(self.machine)
         cmd.append("-cpu")
         cmd.append(self.cpu)
         cmd.append("-m")
         cmd.append(self.memory)
+        if not {"-accel", "-enable-kvm"} & set(extra_args):
+            cmd.append("-accel")
+            cmd.append(self.select_accelerator(capabilities))
+        if self.smp is not None and "-smp" not in extra_args:
+            cmd.append("-smp")
+            cmd.append(self.smp)
         if self.display == "none":
             cmd.append("-nographic")
         elif self.display == "fb-headless":
@@ -222,33 +380,86 @@ class CustomQEMUDriver(BaseQEMUDriver, ConsoleExpectMixin, Driver, PowerProtocol
             cmd.append("-append")
             cmd.append(" ".join(boot_args))
 
+        return cmd
+
+    def get_remote_disk_args(self) -> list[str]:
+        """Returns the arguments for a disk which is an overlay over the remote image; disk_opts do not apply"""
+        assert self.disk_remote
+        if self.machine not in ["pc", "q35", "virt"]:
+            raise NotImplementedError(f"QEMU remote disk image support not implemented for machine '{self.machine}'")
+        overlay = self._disk_path or "<disk>"
+        if self.restored_snapshot is not None:
+            # the overlay is backed by the disk of the snapshot, which is read from its image header
+            blockdev = {"driver": "qcow2", "node-name": DISK_NODE, "file": {"driver": "file", "filename": overlay}}
+        else:
+            blockdev = self.disk_remote.blockdev(overlay)
+        return ["-blockdev", json.dumps(blockdev), "-device", f"virtio-blk-pci,drive={DISK_NODE}"]
+
+    def get_qemu_control_args(self) -> list[str]:
+        """Returns the options through which QEMU is controlled, i.e. QMP, the serial console and the guest agent"""
+        cmd: list[str] = []
+
         cmd.append("-S")  # freeze CPU at startup
 
         cmd.append("-qmp")
         # cmd.append("stdio")
-        cmd.append(f"tcp:localhost:{get_qmp_port()},server=on,wait=off")
+        cmd.append(f"unix:{self.qmp_endpoint},server=on,wait=off")
 
         cmd.append("-chardev")
-        cmd.append("socket,id=serialsocket,host=0.0.0.0,port=54321,server=on,wait=off")
+        cmd.append(f"socket,id=serialsocket,path={self.serial_endpoint},server=off")
         cmd.append("-serial")
         cmd.append("chardev:serialsocket")
 
+        if (guest_agent_endpoint := self.guest_agent_endpoint) is not None:
+            cmd.append("-chardev")
+            cmd.append(f"socket,id=qga0,path={guest_agent_endpoint},server=on,wait=off")
+            cmd.append("-device")
+            cmd.append("virtio-serial")
+            cmd.append("-device")
+            cmd.append("virtserialport,chardev=qga0,name=org.qemu.guest_agent.0")
+
         return cmd
 
     @step()
     def on(self) -> None:
-        """Start the QEMU subprocess, accept the unix socket connection and
+        """Start the QEMU subprocess, accept its serial console connection and
         afterwards start the emulator using a QMP Command"""
+        self._start(restore=True)
 
+    def _start(self, restore: bool) -> None:
+        """Starts QEMU, resuming from a cached snapshot if `restore` is set and there is one"""
         if self.status:
             return
-        cmd = self.get_qemu_base_args()
-        self.logger.info("Starting with: %s", " ".join(cmd))
-        self._child_qemu = subprocess.Popen(cmd)  # , stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        wait_for(lambda: is_port_in_use(54321), "port 54321 in use")
 
-        self._child_ser2net = start_ser2net_mux(54321, 12345)
-        wait_for(lambda: is_port_in_use(12345), "port 12345 in use")
+        snapshot = self._lookup_snapshot(restore)
+        if snapshot is not None:
+            self.logger.info("Resuming from snapshot %s", snapshot.path.name)
+            if self.disk is not None:
+                # writes go to a throw-away overlay, keeping the cached disk intact
+                self._disk_path = str(self.runtime_dir / "disk.qcow2")
+                create_overlay(snapshot.disk_path, Path(self._disk_path), self.qemu_img)
+        elif self.disk_base is not None:
+            self._disk_path = str(self.runtime_dir / "disk.qcow2")
+            create_overlay(self.disk_base, Path(self._disk_path), self.qemu_img)
+        elif self.disk_remote is not None:
+            self._disk_path = str(self.runtime_dir / "disk.qcow2")
+            self.disk_remote.prepare(Path(self._disk_path), self.qemu_img)
+        self.restored_snapshot = snapshot
+
+        cmd = self.get_qemu_base_args() + self.get_qemu_control_args()
+        if snapshot is not None:
+            cmd += ["-incoming", f"exec:cat {shlex.quote(str(snapshot.state_path))}"]
+        # the multiplexer listens before QEMU starts, so QEMU's chardev connects to it right away
+        self._console_mux = ConsoleMux(self.serial_endpoint, self.console_endpoint)
+        self.logger.info("Starting with: %s", " ".join(cmd))
+        child_qemu = self._child_qemu = subprocess.Popen(cmd)  # , stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            self._console_mux.start(alive=lambda: child_qemu.poll() is None)
+        except (TimeoutError, ConnectionError) as exc:
+            self._close_console_mux()
+            kill_process(self._child_qemu)
+            self._child_qemu = None
+            raise ExecutionError(f"QEMU did not connect to the serial console: {exc}") from exc  # type: ignore
 
         self.status = 1
 
@@ -260,60 +471,84 @@ class CustomQEMUDriver(BaseQEMUDriver, ConsoleExpectMixin, Driver, PowerProtocol
         if not self.status:
             return
 
-        kill_process(self._child_ser2net)
-        self._child_ser2net = None
+        self._close_console_mux()
 
         self.monitor_command("quit")
+        self._close_qmp()
         kill_process(self._child_qemu)
         self._child_qemu = None
 
+        self._disk_path = None
+        self.restored_snapshot = None
+        self._remove_runtime_dir()
+
         self.status = 0
 
-    def cycle(self) -> None:
-        """Cycle the emulator by restarting it"""
-        self.off()
-        self.on()
+    def _lookup_snapshot(self, restore: bool = True) -> Snapshot | None:
+        cache = self.snapshots
+        self._snapshot_key = None
+        if cache is None:
+            return None
+        if not self.snapshot_capable:
+            self.logger.warning("Snapshots require an immutable base image (overlay or lazy mode), not using them")
+            return None
+        self._disk_path = None
+        self._snapshot_key = self.get_snapshot_key()
+        snapshot = cache.get(self._snapshot_key)
+        if not restore or not snapshot.exists():
+            return None
+        cache.touch(snapshot)
+        return snapshot
+
+    @step(args=["status"])
+    def save_snapshot(self, status: str, timeout: float = 120) -> None:
+        """Capture memory and disk of the running VM so that later boots resume from this state.
+
+        Args:
+            status (str): the state the target has reached, stored along with the snapshot
+            timeout (float): timeout in seconds for writing the VM state
+        """
+        cache = self.snapshots
+        if cache is None:
+            raise ExecutionError("snapshot_dir has not been configured")  # type: ignore
+        if not self.status:
+            raise ExecutionError("QEMU is not running")  # type: ignore
+        if self._snapshot_key is None:
+            raise ExecutionError("Snapshots require an immutable base image (overlay or lazy mode)")  # type: ignore
+        disk_path = self.get_disk_path()
 
-    @step(result=True, args=["command", "arguments"])
-    def monitor_command(self, command: str, arguments: dict | None = None) -> str:
-        """Execute a monitor_command via the QMP"""
-        socket_qmp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        socket_qmp.connect(("localhost", get_qmp_port()))
+        snapshot = cache.create(self._snapshot_key)
+        self.monitor_command("stop")
         try:
-            qmp_file = socket_qmp.makefile("rw")
-
-            def write_flush(msg: str) -> None:
-                qmp_file.write(msg)
-                qmp_file.flush()
-
-            qmp = QMPMonitor(qmp_file.readline, write_flush)
-
-            if arguments is None:
-                arguments = {}
-            return qmp.execute(command, arguments)
+            self.monitor_command(
+                "migrate-set-capabilities", {"capabilities": [{"capability": "events", "state": True}]}
+            )
+            with self.qmp_events("MIGRATION") as migration_events:
+                self.monitor_command("migrate", {"uri": f"exec:cat > {shlex.quote(str(snapshot.state_path))}"})
+                event = migration_events.wait(
+                    lambda event: event["data"]["status"] in ("completed", "failed", "cancelled"), timeout
+                )
+            if event["data"]["status"] != "completed":
+                raise ExecutionError(f"Saving the VM state failed: {event['data']['status']}")  # type: ignore
+            if disk_path is not None:
+                # the VM is paused, so the disk is consistent with the saved memory
+                convert(self._disk_source(disk_path), snapshot.disk_path, force_share=True, qemu_img=self.qemu_img)
+        except BaseException:
+            cache.discard(snapshot)
+            raise
         finally:
-            socket_qmp.close()
-
-    def _read(self, size: int = 1, timeout: float = 10, max_size: int | None = None) -> bytes:
-        assert self._socket
-
-        ready, _, _ = select.select([self._socket], [], [], timeout)
-        if ready:
-            # Collect some more data
-            time.sleep(0.01)
-            # Always read a page, regardless of size
-            size = 4096
-            size = min(max_size, size) if max_size else size
-            res = self._socket.recv(size)
-        else:
-            raise TIMEOUT(f"Timeout of {timeout:.2f} seconds exceeded")
-        return res
+            self.monitor_command("cont")
+        cache.commit(self._snapshot_key, snapshot, {"status": status})
 
-    def _write(self, data: bytes) -> int:  # type: ignore
-        assert self._socket
+    def _disk_source(self, disk_path: str) -> Path | str:
+        """Returns the disk image qemu-img reads the disk of the running VM from"""
+        if self.disk_remote is None or self.restored_snapshot is not None:
+            return Path(disk_path)
+        # the backing chain is only known to the QEMU command line, a paused VM does not write to the cache
+        return f"json:{json.dumps(self.disk_remote.blockdev(disk_path, copy_on_read=False))}"
 
-        return self._socket.send(data)
-
-    def __str__(self) -> str:
-        assert self.target
-        return f"QemuDriver({self.target.name})"
+    @step()
+    def cycle(self) -> None:
+        """Cycle the emulator by restarting it; a power cycle always cold boots, even if a snapshot exists"""
+        self.off()
+        self._start(restore=False)
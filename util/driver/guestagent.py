@@ -0,0 +1,160 @@
+"""The GuestAgentDriver runs commands through the QEMU guest agent"""
+
+import base64
+import json
+import random
+from dataclasses import dataclass
+
+import attr
+from func import retry_exc, wait_for
+from labgrid.driver import Driver
+from labgrid.driver.commandmixin import CommandMixin
+from labgrid.factory import target_factory
+from labgrid.protocol import CommandProtocol
+from labgrid.step import step
+
+from .base_qemudriver import SocketAddress, connect
+
+
+class GuestAgentError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class GuestExecResult:
+    stdout: bytes
+    stderr: bytes
+    exitcode: int
+
+
+class GuestAgentClient:
+    """Synchronous client of the QEMU guest agent protocol"""
+
+    def __init__(self, endpoint: SocketAddress, timeout: float = 10) -> None:
+        self._socket = connect(endpoint, timeout)
+        self._file = self._socket.makefile("rb")
+        try:
+            self._sync()
+        except BaseException:
+            self.close()
+            raise
+
+    def _send(self, command: str, arguments: dict | None = None) -> None:
+        message: dict = {"execute": command}
+        if arguments is not None:
+            message["arguments"] = arguments
+        self._socket.sendall(json.dumps(message).encode() + b"\n")
+
+    def _receive(self) -> dict:
+        while True:
+            line = self._file.readline()
+            if not line:
+                raise ConnectionError("guest agent closed the connection")
+            if line.strip():
+                return json.loads(line)
+
+    def _sync(self) -> None:
+        # the agent may still hold a partial command of a previous client, which a 0xff byte discards
+        sync_id = random.randrange(1 << 31)  # noqa: S311
+        self._socket.sendall(b"\xff")
+        self._send("guest-sync-delimited", {"id": sync_id})
+        # the agent answers with a 0xff byte, so that responses to previous clients can be skipped
+        while (byte := self._file.read(1)) != b"\xff":
+            if not byte:
+                raise ConnectionError("guest agent closed the connection")
+        while self._receive().get("return") != sync_id:
+            pass
+
+    def execute(self, command: str, arguments: dict | None = None) -> dict:
+        self._send(command, arguments)
+        response = self._receive()
+        if "error" in response:
+            raise GuestAgentError(f"{command} failed: {response['error'].get('desc', response['error'])}")
+        return response["return"]
+
+    def close(self) -> None:
+        self._file.close()
+        self._socket.close()
+
+
+def guest_exec(client: GuestAgentClient, command: str, timeout: float = 30) -> GuestExecResult:
+    """Runs a shell command in the guest and returns its output and exit code"""
+    pid = client.execute("guest-exec", {"path": "/bin/sh", "arg": ["-c", command], "capture-output": True})["pid"]
+    status: dict = wait_for(
+        lambda: (status := client.execute("guest-exec-status", {"pid": pid}))["exited"] and status,
+        f"command '{command}' has exited",
+        timeout=timeout,
+    )
+    return GuestExecResult(
+        stdout=base64.b64decode(status.get("out-data", "")),
+        stderr=base64.b64decode(status.get("err-data", "")),
+        # processes killed by a signal have no exit code, report it like a shell does
+        exitcode=status.get("exitcode", 128 + status.get("signal", 0)),
+    )
+
+
+@target_factory.reg_driver
+@attr.s(eq=False)
+class GuestAgentDriver(CommandMixin, Driver, CommandProtocol):
+    """
+    The GuestAgentDriver runs commands through the QEMU guest agent instead of typing them into the serial
+    console. The CustomQEMUDriver has to be configured with guest_agent enabled and the guest has to run qemu-ga.
+
+    Args:
+        timeout (float, default=60): timeout in seconds for the guest agent to respond when activating the driver
+    """
+
+    bindings = {"qemu": "CustomQEMUDriver"}
+
+    timeout: float = attr.ib(default=60.0, converter=float)
+
+    def __attrs_post_init__(self) -> None:
+        super().__attrs_post_init__()
+        self._client: GuestAgentClient | None = None
+
+    def on_activate(self) -> None:
+        endpoint = self.qemu.guest_agent_endpoint  # type: ignore[attr-defined]
+        if endpoint is None:
+            raise GuestAgentError("guest_agent is not enabled in the QEMU driver")
+        # the agent only answers once the guest has started it, which opens the port and emits VSERPORT_CHANGE
+        with self.qemu.qmp_waker("VSERPORT_CHANGE") as waker:  # type: ignore[attr-defined]
+            self._client = retry_exc(
+                lambda: GuestAgentClient(endpoint, timeout=5),
+                OSError,
+                "guest agent responds",
+                timeout=self.timeout,
+                waker=waker,
+            )
+
+    def on_deactivate(self) -> None:
+        if self._client is not None:
+            self._client.close()
+        self._client = None
+
+    @Driver.check_active
+    @step(args=["cmd"], result=True)
+    def execute(self, cmd: str, *, timeout: float = 30.0) -> GuestExecResult:
+        """Runs a shell command and returns its raw output and exit code"""
+        assert self._client
+        return guest_exec(self._client, cmd, timeout)
+
+    def _run(
+        self, cmd: str, *, timeout: float = 30.0, codec: str = "utf-8", decodeerrors: str = "strict"
+    ) -> tuple[list[str], list[str], int]:
+        assert self._client
+        result = guest_exec(self._client, cmd, timeout)
+        return (
+            result.stdout.decode(codec, decodeerrors).splitlines(),
+            result.stderr.decode(codec, decodeerrors).splitlines(),
+            result.exitcode,
+        )
+
+    @Driver.check_active
+    @step(args=["cmd"], result=True)
+    def run(
+        self, cmd: str, *, timeout: float = 30.0, codec: str = "utf-8", decodeerrors: str = "strict"
+    ) -> tuple[list[str], list[str], int]:
+        return self._run(cmd, timeout=timeout, codec=codec, decodeerrors=decodeerrors)
+
+    def get_status(self) -> int:
+        return 1
@@ -8,10 +8,27 @@ from labgrid.resource import Resource
 @target_factory.reg_resource
 @attr.s(eq=False)
 class QEMUParams(Resource):
+    # extract the disk image again for every session, discarding the changes of previous runs; not applicable in
+    # overlay or lazy mode, where every run starts from a fresh overlay over an immutable base image
     overwrite: bool | None = attr.ib(
         default=False, validator=attr.validators.optional(attr.validators.instance_of(bool))
     )
+    # run QEMU on a per-run qcow2 overlay over an immutable, once extracted base image
+    overlay: bool | None = attr.ib(default=False, validator=attr.validators.optional(attr.validators.instance_of(bool)))
+    # in overlay mode, convert the base image into a compressed qcow2 image once and remove the raw image
+    compressed_base: bool | None = attr.ib(
+        default=False, validator=attr.validators.optional(attr.validators.instance_of(bool))
+    )
+    # boot from a per-run qcow2 overlay over the decompressed image on the artifacts server, whose blocks are only
+    # fetched when they are read and then cached locally (see `decompress` in artifacts.yaml)
+    lazy: bool | None = attr.ib(default=False, validator=attr.validators.optional(attr.validators.instance_of(bool)))
+    # name of the strategy status at which a VM state snapshot is taken (see CustomQEMUDriver.snapshot_dir)
+    snapshot: str | None = attr.ib(default=None, validator=attr.validators.optional(attr.validators.instance_of(str)))
 
 
 def get_qmp_port() -> int:
     return int(os.environ.get("QMP_PORT", "4444"))
+
+
+def get_console_port() -> int:
+    return int(os.environ.get("CONSOLE_PORT", "12345"))
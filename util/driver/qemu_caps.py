@@ -0,0 +1,141 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from labgrid.driver.exception import ExecutionError
+
+
+@dataclass(frozen=True)
+class QEMUCapabilities:
+    """What a QEMU binary supports, as reported by its `help` options"""
+
+    version: tuple[int, int, int]
+    machines: frozenset[str]
+    accelerators: frozenset[str]
+    devices: frozenset[str]
+    cpus: frozenset[str]
+    displays: frozenset[str]
+
+    def to_json(self) -> dict:
+        return {name: sorted(value) if isinstance(value, frozenset) else value for name, value in asdict(self).items()}
+
+    @classmethod
+    def from_json(cls, data: dict) -> "QEMUCapabilities":
+        return cls(
+            version=tuple(data["version"]),  # type: ignore[arg-type]
+            machines=frozenset(data["machines"]),
+            accelerators=frozenset(data["accelerators"]),
+            devices=frozenset(data["devices"]),
+            cpus=frozenset(data["cpus"]),
+            displays=frozenset(data["displays"]),
+        )
+
+
+_capabilities: dict[str, QEMUCapabilities] = {}
+
+
+def get_cache_path() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "labgrid-qemu" / "capabilities.json"
+
+
+def _cache_key(qemu_bin: str) -> str:
+    path = Path(shutil.which(qemu_bin) or qemu_bin).resolve()
+    stat = path.stat()
+    return f"{path}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def _run_help(qemu_bin: str, *args: str) -> list[str]:
+    p = subprocess.run([qemu_bin, *args], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding="utf-8")
+    if p.returncode != 0:
+        raise ExecutionError(f"Unable to run {' '.join(args)}. QEMU exited with: {p.returncode}")  # type: ignore
+    return p.stdout.splitlines()
+
+
+def parse_version(lines: list[str]) -> tuple[int, int, int]:
+    m = re.search(r"(?P<major>\d+)\.(?P<minor>\d+)\.(?P<micro>\d+)", lines[0] if lines else "")
+    if m is None:
+        raise ExecutionError(f"Unable to find QEMU version in: {lines[0] if lines else ''}")  # type: ignore
+    return (int(m.group("major")), int(m.group("minor")), int(m.group("micro")))
+
+
+def parse_names(lines: list[str]) -> frozenset[str]:
+    """Parses lists like the output of `-machine help`, `-accel help` or `-display help`: a header line followed by
+    one entry per line, starting with its name"""
+    return frozenset(line.split()[0] for line in lines[1:] if line.strip())
+
+
+def parse_devices(lines: list[str]) -> frozenset[str]:
+    return frozenset(re.findall(r'^name "([^"]+)"', "\n".join(lines), re.MULTILINE))
+
+
+def parse_cpus(lines: list[str]) -> frozenset[str]:
+    """Parses the output of `-cpu help`, e.g. `x86 core2duo  Intel Core 2 Duo P9xxx` or `  cortex-a9`"""
+    cpus: set[str] = set()
+    for line in lines[1:]:
+        if not line.strip():
+            if cpus:
+                # further sections, e.g. the CPUID flags, follow the CPU list
+                break
+            continue
+        tokens = line.split()
+        name = tokens[1] if tokens[0] == "x86" and len(tokens) > 1 else tokens[0]
+        cpus.add(name)
+    return frozenset(cpus)
+
+
+def probe(qemu_bin: str) -> QEMUCapabilities:
+    return QEMUCapabilities(
+        version=parse_version(_run_help(qemu_bin, "-version")),
+        machines=parse_names(_run_help(qemu_bin, "-machine", "help")),
+        accelerators=parse_names(_run_help(qemu_bin, "-accel", "help")),
+        devices=parse_devices(_run_help(qemu_bin, "-device", "help")),
+        cpus=parse_cpus(_run_help(qemu_bin, "-cpu", "help")),
+        displays=parse_names(_run_help(qemu_bin, "-display", "help")),
+    )
+
+
+def _load_cache(cache_path: Path) -> dict[str, dict]:
+    try:
+        return json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _store_cache(cache_path: Path, key: str, capabilities: QEMUCapabilities) -> None:
+    # binaries which are no longer around are dropped along the way
+    entries = {
+        entry_key: entry
+        for entry_key, entry in _load_cache(cache_path).items()
+        if Path(entry_key.rsplit(":", 2)[0]).exists()
+    }
+    entries[key] = capabilities.to_json()
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=cache_path.parent, delete=False) as f:
+            json.dump(entries, f)
+        os.replace(f.name, cache_path)
+    except OSError:
+        pass  # the cache is an optimization only
+
+
+def qemu_capabilities(qemu_bin: str) -> QEMUCapabilities:
+    """Returns the capabilities of a QEMU binary.
+
+    The binary is only probed once: the result is cached in memory and on disk, keyed by the path, modification
+    time and size of the binary.
+    """
+    key = _cache_key(qemu_bin)
+    if key not in _capabilities:
+        cache_path = get_cache_path()
+        try:
+            _capabilities[key] = QEMUCapabilities.from_json(_load_cache(cache_path)[key])
+        except (KeyError, TypeError):
+            _capabilities[key] = probe(qemu_bin)
+            _store_cache(cache_path, key, _capabilities[key])
+    return _capabilities[key]
@@ -0,0 +1,101 @@
+import hashlib
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
+from func import wait_for
+from qemu_img import create_image
+
+DISK_NODE = "disk0"
+# the artifacts service reports at /_ready/<path> whether the file at <path> has been downloaded completely
+READY_PREFIX = "/_ready"
+
+
+class RemoteImageError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class RemoteImage:
+    """A raw disk image on an HTTP server which QEMU reads on demand by byte ranges instead of downloading it first.
+
+    Blocks which have been read are copied into a local qcow2 cache image, which is kept across runs, so that later
+    boots only fetch blocks which have not been read before. Writes go to a per-run overlay. The cache can only be
+    used by one QEMU instance at a time.
+    """
+
+    url: str
+    size: int
+    cache_path: Path
+    readahead: int = 1 << 20
+
+    def remote_node(self) -> dict:
+        return {"driver": urlsplit(self.url).scheme, "url": self.url, "readahead": self.readahead, "read-only": True}
+
+    def cache_node(self, copy_on_read: bool = True) -> dict:
+        # backing images are opened read-only unless this is overridden, the cache is written by copy-on-read
+        cache: dict = {
+            "driver": "qcow2",
+            "read-only": not copy_on_read,
+            "file": {"driver": "file", "filename": str(self.cache_path), "read-only": not copy_on_read},
+            "backing": {"driver": "raw", "read-only": True, "file": self.remote_node()},
+        }
+        if not copy_on_read:
+            return cache
+        return {"driver": "copy-on-read", "read-only": False, "file": cache}
+
+    def blockdev(self, overlay: str, copy_on_read: bool = True) -> dict:
+        """Returns the definition of the block node chain for -blockdev: the overlay backed by the cache, which is
+        backed by the remote image"""
+        return {
+            "driver": "qcow2",
+            "node-name": DISK_NODE,
+            "file": {"driver": "file", "filename": overlay},
+            "backing": self.cache_node(copy_on_read),
+        }
+
+    def prepare(self, overlay: Path, qemu_img: str = "qemu-img") -> None:
+        """Creates the overlay and, unless it exists already, the cache image"""
+        if not self.cache_path.exists():
+            partial = self.cache_path.with_name(f"{self.cache_path.name}.part")
+            create_image(partial, self.size, qemu_img)
+            os.replace(partial, self.cache_path)
+        create_image(overlay, self.size, qemu_img)
+
+
+def ready_url(url: str) -> str:
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc, f"{READY_PREFIX}{parts.path}", "", ""))
+
+
+def _is_ready(url: str) -> bool:
+    try:
+        response = httpx.get(ready_url(url))
+    except httpx.TransportError:
+        # the artifacts service has not started yet
+        return False
+    if response.status_code == httpx.codes.SERVICE_UNAVAILABLE:
+        return False
+    if response.status_code != httpx.codes.OK:
+        # the download failed or the image is unknown, which waiting does not change
+        raise RemoteImageError(f"{url} is not available: {response.text.strip()}")
+    return True
+
+
+def open_remote_image(url: str, cache_dir: Path, timeout: float = 600) -> RemoteImage:
+    """Waits until the artifacts service reports the image at `url` as ready and returns it with a cache image in
+    `cache_dir`. The cache is keyed by the URL and the entity tag of the image, so that it is not used for an image
+    which has changed."""
+    wait_for(lambda: _is_ready(url), f"{url} is ready", delay=1, timeout=timeout)
+    response = httpx.head(url, follow_redirects=True)
+    response.raise_for_status()
+    # QEMU reads the image by byte ranges
+    if response.headers.get("Accept-Ranges") != "bytes" or "Content-Length" not in response.headers:
+        raise RemoteImageError(f"{url} does not support range requests")
+    size = int(response.headers["Content-Length"])
+    etag = response.headers.get("ETag", "")
+    key = hashlib.sha256(f"{url}\n{etag}\n{size}".encode()).hexdigest()[:16]
+    name = Path(urlsplit(url).path).name
+    return RemoteImage(url, size, cache_dir / f"{name}.{key}.cache.qcow2")
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from crypto import sha256_file
+
+_image_digests: dict[tuple[Path, int, int], str] = {}
+
+
+def image_digest(path: Path) -> str:
+    """Returns the SHA-256 digest of an image, memoized as long as the file is unmodified."""
+    stat = path.stat()
+    key = (path.resolve(), stat.st_mtime_ns, stat.st_size)
+    if key not in _image_digests:
+        _image_digests[key] = sha256_file(path)
+    return _image_digests[key]
+
+
+def snapshot_key(config: object, image: Path | None, qemu_version: tuple[int, int, int]) -> str:
+    """Identifies a VM state by the VM configuration, the disk image content and the QEMU version.
+
+    The configuration must be JSON serializable and must not contain per-run values such as temporary file names
+    or port numbers.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(config, sort_keys=True).encode())
+    digest.update((image_digest(image) if image is not None else "").encode())
+    digest.update(".".join(map(str, qemu_version)).encode())
+    return digest.hexdigest()
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """Cache entry consisting of the migrated VM state and a copy of its disk."""
+
+    path: Path
+
+    @property
+    def state_path(self) -> Path:
+        return self.path / "state"
+
+    @property
+    def disk_path(self) -> Path:
+        return self.path / "disk.qcow2"
+
+    @property
+    def meta_path(self) -> Path:
+        return self.path / "meta.json"
+
+    def exists(self) -> bool:
+        return self.meta_path.exists()
+
+    @property
+    def meta(self) -> dict:
+        return json.loads(self.meta_path.read_text())
+
+
+class SnapshotCache:
+    """Snapshots by key, of which only the `keep` most recently used ones are kept"""
+
+    def __init__(self, directory: Path, keep: int = 2) -> None:
+        self.directory = directory
+        self.keep = keep
+
+    def get(self, key: str) -> Snapshot:
+        return Snapshot(self.directory / key)
+
+    def entries(self) -> list[Snapshot]:
+        """Returns the committed snapshots, the most recently used first"""
+        if not self.directory.is_dir():
+            return []
+        snapshots = [Snapshot(path) for path in self.directory.iterdir() if not path.name.startswith(".")]
+        snapshots = [snapshot for snapshot in snapshots if snapshot.exists()]
+        return sorted(snapshots, key=lambda snapshot: snapshot.meta_path.stat().st_mtime, reverse=True)
+
+    def touch(self, snapshot: Snapshot) -> None:
+        """Marks a snapshot as used, so that it is pruned last"""
+        snapshot.meta_path.touch()
+
+    def prune(self) -> list[Snapshot]:
+        """Removes all but the `keep` most recently used snapshots and returns the removed ones"""
+        removed = self.entries()[self.keep :]
+        for snapshot in removed:
+            logging.info(f"Removing snapshot {snapshot.path.name}.")
+            self.discard(snapshot)
+        return removed
+
+    def create(self, key: str) -> Snapshot:
+        """Returns a temporary entry in the cache directory which is published by :meth:`commit`."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        return Snapshot(Path(tempfile.mkdtemp(prefix=f".{key}.", dir=self.directory)))
+
+    def commit(self, key: str, snapshot: Snapshot, meta: dict) -> Snapshot:
+        snapshot.meta_path.write_text(json.dumps({**meta, "created": time.time()}))
+        target = self.get(key)
+        try:
+            os.rename(snapshot.path, target.path)
+        except OSError:
+            # another session has published the same entry in the meantime
+            logging.info(f"Snapshot {key} already exists, discarding {snapshot.path.name}.")
+            shutil.rmtree(snapshot.path)
+        self.prune()
+        return target
+
+    def discard(self, snapshot: Snapshot) -> None:
+        shutil.rmtree(snapshot.path, ignore_errors=True)
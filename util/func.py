@@ -1,49 +1,172 @@
+import logging
+import random
+import threading
 import time
-from collections.abc import Callable
+from collections import deque
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
 from typing import TypeVar
 
 T = TypeVar("T")
 
 
-def wait_for(cond: Callable[[], T], desc: str, delay: float = 0.1, timeout: float = 10) -> T:
+@dataclass(frozen=True)
+class WaitRecord:
+    desc: str
+    duration: float
+    attempts: int
+    success: bool
+
+
+# the most recent waits, to see where e.g. boot time goes
+wait_records: deque[WaitRecord] = deque(maxlen=1000)
+
+
+def _record_wait(desc: str, start: float, attempts: int, success: bool) -> None:
+    record = WaitRecord(desc, time.monotonic() - start, attempts, success)
+    wait_records.append(record)
+    logging.debug(f"Waited {record.duration:.3f}s ({attempts} attempts, success: {success}) for: {desc}")
+
+
+class Backoff:
+    """Exponentially growing delays from `initial` up to `maximum` seconds.
+
+    Each delay is varied by a random fraction of up to `jitter` so that concurrent waiters do not synchronize.
+    """
+
+    def __init__(self, initial: float = 0.01, maximum: float = 1, factor: float = 2, jitter: float = 0.1) -> None:
+        self.initial = min(initial, maximum)
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+
+    def __iter__(self) -> Iterator[float]:
+        delay = self.initial
+        while True:
+            yield min(delay * random.uniform(1 - self.jitter, 1 + self.jitter), self.maximum)  # noqa: S311
+            delay = min(delay * self.factor, self.maximum)
+
+
+class Waker:
+    """Cuts the pause between two checks of a waiting function short.
+
+    Wake-up sources (QMP events, console output, ...) call :meth:`wake` whenever the awaited condition may have
+    changed. Without wake-ups, waiting falls back to polling with backoff.
+    """
+
+    def __init__(self) -> None:
+        self._event = threading.Event()
+        self._cleanups: list[Callable[[], None]] = []
+
+    def wake(self) -> None:
+        self._event.set()
+
+    def wait(self, timeout: float) -> bool:
+        """Waits for a wake-up for at most `timeout` seconds and returns whether there was one"""
+        woken = self._event.wait(timeout)
+        self._event.clear()
+        return woken
+
+    def add_cleanup(self, cleanup: Callable[[], None]) -> None:
+        """Registers a function detaching a wake-up source, called by :meth:`close`"""
+        self._cleanups.append(cleanup)
+
+    def close(self) -> None:
+        while self._cleanups:
+            self._cleanups.pop()()
+
+    def __enter__(self) -> "Waker":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+
+def wait_for(
+    cond: Callable[[], T],
+    desc: str,
+    delay: float = 0.1,
+    timeout: float = 10,
+    waker: Waker | None = None,
+    min_delay: float = 0.01,
+) -> T:
     """Wait for a condition to become true within a specified timeout.
 
+    The condition is checked with exponentially growing pauses from `min_delay` up to `delay` seconds. A `waker`
+    triggers the next check right away, so the wait ends as soon as the condition is met. Each wait is recorded in
+    `wait_records`.
+
     :param cond: A callable that returns a result with its boolean value representing the condition to wait for.
     :param desc: A description of the condition being waited for.
-    :param delay: Time in seconds to wait between condition checks.
+    :param delay: Maximum time in seconds to wait between condition checks.
     :param timeout: Timeout in seconds to wait for the condition to become true.
+    :param waker: Optional wake-up source signalling that the condition may have changed.
+    :param min_delay: Minimum time in seconds between condition checks; conditions which are expensive to check,
+        e.g. commands on the serial console, should not be checked more often than necessary.
     :return: True if the condition becomes true within the timeout.
     :raises TimeoutError: If the condition does not become true within the timeout.
     """
-    start_time = time.time()
-    while time.time() - start_time < timeout:
+    start_time = time.monotonic()
+    attempts = 0
+    for pause in Backoff(initial=min_delay, maximum=delay):
+        attempts += 1
         if (result := cond()) and bool(result):
+            _record_wait(desc, start_time, attempts, True)
             return result
-        time.sleep(delay)  # Sleep briefly to avoid busy-waiting
+        remaining = start_time + timeout - time.monotonic()
+        if remaining <= 0:
+            break
+        _pause(min(pause, remaining), waker)
+    _record_wait(desc, start_time, attempts, False)
     raise TimeoutError(f"Timeout while waiting for condition to become true: {desc}.")
 
 
 S = TypeVar("S")
 
 
-def retry_exc(func: Callable[[], S], exc_type: type[Exception], desc: str, delay: float = 1, timeout: float = 10) -> S:
+def retry_exc(
+    func: Callable[[], S],
+    exc_type: type[Exception],
+    desc: str,
+    delay: float = 1,
+    timeout: float = 10,
+    waker: Waker | None = None,
+    min_delay: float = 0.01,
+) -> S:
     """Retry a function until it succeeds or a specific exception type is no longer raised.
 
     :param func: A callable to execute, which may raise the specified exception type.
     :param exc_type: The type of exception to handle during retries.
     :param desc: A description of the action being retried.
-    :param delay: Time in seconds to wait between retries.
+    :param delay: Maximum time in seconds to wait between retries.
     :param timeout: Timeout in seconds to wait before giving up.
+    :param waker: Optional wake-up source signalling that a retry may succeed.
+    :param min_delay: Minimum time in seconds between retries.
     :return: The result of the function if it succeeds.
     :raises TimeoutError: If the function does not succeed within the specified timeout.
     """
-    start_time = time.time()
+    start_time = time.monotonic()
+    attempts = 0
     exc: Exception | None = None
-    while time.time() - start_time < timeout:
+    for pause in Backoff(initial=min_delay, maximum=delay):
+        attempts += 1
         try:
-            return func()
+            result = func()
         except exc_type as exc_:
             exc = exc_
-            pass
-        time.sleep(delay)  # Sleep briefly to avoid busy-waiting
+        else:
+            _record_wait(desc, start_time, attempts, True)
+            return result
+        remaining = start_time + timeout - time.monotonic()
+        if remaining <= 0:
+            break
+        _pause(min(pause, remaining), waker)
+    _record_wait(desc, start_time, attempts, False)
     raise TimeoutError(f"Timeout while waiting for condition to become true: {desc}.") from exc
+
+
+def _pause(seconds: float, waker: Waker | None) -> None:
+    if waker is None:
+        time.sleep(seconds)
+    else:
+        waker.wait(seconds)
@@ -0,0 +1,202 @@
+import contextlib
+import hashlib
+import os
+import queue
+import threading
+import zlib
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import BinaryIO
+
+CHUNK_SIZE = 1 << 20
+# granularity in which runs of zeros become holes, the block size of common file systems
+SPARSE_BLOCK_SIZE = 4096
+SPARSE_SCAN_SIZE = 1 << 16
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def parse_sha256sums(manifest: str) -> dict[str, str]:
+    """Parses the output of `sha256sum` (e.g. OpenWrt's sha256sums file) into a mapping of file name to digest."""
+    result: dict[str, str] = {}
+    for line in manifest.splitlines():
+        digest, _, name = line.strip().partition(" ")
+        if digest and name:
+            result[name.strip().lstrip("*")] = digest.lower()
+    return result
+
+
+def read_chunks(path: Path, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def prefetch(chunks: Iterable[bytes], depth: int = 16) -> Iterator[bytes]:
+    """Produces `chunks` in a background thread so that producing and consuming them overlap.
+
+    At most `depth` chunks are buffered, so memory use stays bounded.
+    """
+    buffer: queue.Queue[bytes | BaseException | None] = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item: bytes | BaseException | None) -> bool:
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+        except BaseException as exc:
+            put(exc)
+            return
+        put(None)
+
+    producer = threading.Thread(target=produce, name="prefetch", daemon=True)
+    producer.start()
+    try:
+        while (item := buffer.get()) is not None:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
+
+
+def gunzip_chunks(chunks: Iterable[bytes], chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Incrementally decompresses a gzip stream, yielding chunks of at most `chunk_size` bytes.
+
+    Like gunzip, data trailing the gzip stream is ignored: OpenWrt appends metadata to its images.
+    """
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = chunk
+        while not decompressor.eof:
+            output = decompressor.decompress(data, chunk_size)
+            if output:
+                yield output
+            data = decompressor.unconsumed_tail
+            if not data and not output:
+                break
+    if not decompressor.eof:
+        raise zlib.error("gzip stream is truncated")
+
+
+def tee(chunks: Iterable[bytes], output: BinaryIO) -> Iterator[bytes]:
+    """Writes all chunks to `output` while passing them on."""
+    for chunk in chunks:
+        output.write(chunk)
+        yield chunk
+
+
+def digest(chunks: Iterable[bytes], hash_object: "hashlib._Hash") -> Iterator[bytes]:
+    """Feeds all chunks to `hash_object` while passing them on."""
+    for chunk in chunks:
+        hash_object.update(chunk)
+        yield chunk
+
+
+class SparseWriter:
+    """Writes data to a new file, seeking over blocks which only contain zeros so that they become holes.
+
+    Disk images consist of large runs of zeros, which then neither take up disk space nor write bandwidth.
+    """
+
+    def __init__(self, output: BinaryIO, block_size: int = SPARSE_BLOCK_SIZE) -> None:
+        self.output = output
+        self.block_size = block_size
+        self.size = 0
+        self._zeros = bytes(block_size)
+        self._pending = 0
+
+    def write(self, data: bytes) -> None:
+        view = memoryview(data)
+        # start of the data which has not been written yet
+        self._pending = 0
+        # blocks are aligned to the file offset; the parts of a block at the end of one chunk and the start of the
+        # next one are skipped separately if they are zeros, so that the block still becomes a hole
+        head = min(-self.size % self.block_size, len(view))
+        if head and data.count(0, 0, head) == head:
+            self._skip(view, 0, head)
+        # large blocks are checked first, most of them are either all zeros or do not contain a zero block at all
+        for offset in range(head, len(view), SPARSE_SCAN_SIZE):
+            end = min(offset + SPARSE_SCAN_SIZE, len(view))
+            if data.count(0, offset, end) == end - offset:
+                self._skip(view, offset, end - offset)
+                continue
+            if data.find(self._zeros, offset, end) < 0 and end - offset >= self.block_size:
+                continue
+            for block_offset in range(offset, end, self.block_size):
+                block_end = min(block_offset + self.block_size, end)
+                if data.count(0, block_offset, block_end) == block_end - block_offset:
+                    self._skip(view, block_offset, block_end - block_offset)
+        if self._pending < len(view):
+            self.output.write(view[self._pending :])
+        self.size += len(view)
+
+    def _skip(self, view: memoryview, offset: int, length: int) -> None:
+        if self._pending < offset:
+            self.output.write(view[self._pending : offset])
+        self.output.seek(length, os.SEEK_CUR)
+        self._pending = offset + length
+
+    def finish(self) -> None:
+        """Sets the size of the file, which does not grow by seeking over zeros at its end"""
+        self.output.truncate(self.size)
+
+
+def allocated_size(path: Path) -> tuple[int, int]:
+    """Returns the bytes allocated for a file on disk and its logical size, which holes do not take up."""
+    stat = path.stat()
+    return stat.st_blocks * 512, stat.st_size
+
+
+def _partial_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.part")
+
+
+def store_image(
+    chunks: Iterable[bytes],
+    compressed_dest: Path | None = None,
+    dest: Path | None = None,
+    sha256: str | None = None,
+) -> None:
+    """Streams a gzip compressed image into the given files.
+
+    The compressed data is stored in `compressed_dest` and decompressed into the sparse file `dest` at the same
+    time (either one is optional). Both files only appear once the data is complete and matches `sha256` (if given).
+    """
+    partial_paths = [_partial_path(path) for path in (compressed_dest, dest) if path is not None]
+    hash_object = hashlib.sha256()
+    try:
+        with contextlib.ExitStack() as stack:
+            stream = digest(chunks, hash_object)
+            if compressed_dest is not None:
+                stream = tee(stream, stack.enter_context(open(_partial_path(compressed_dest), "wb")))
+            if dest is not None:
+                output = SparseWriter(stack.enter_context(open(_partial_path(dest), "wb")))
+                for chunk in gunzip_chunks(stream):
+                    output.write(chunk)
+                output.finish()
+            else:
+                for _ in stream:
+                    pass
+        if sha256 is not None and hash_object.hexdigest() != sha256.lower():
+            raise ChecksumError(f"SHA-256 mismatch: expected {sha256}, got {hash_object.hexdigest()}")
+    except BaseException:
+        for path in partial_paths:
+            path.unlink(missing_ok=True)
+        raise
+    for path in (compressed_dest, dest):
+        if path is not None:
+            _partial_path(path).replace(path)
@@ -44,6 +44,24 @@ def get_free_udp_port() -> int:
         return s.getsockname()[1]
 
 
+def is_ssh_endpoint_ready(host: str, port: int, timeout: float = 1.0) -> bool:
+    """
+    Check if an SSH server answers at a given host and port with its version banner.
+
+    A successful connect alone does not tell, as QEMU's host forwards accept connections before the guest does.
+
+    :param host: The hostname or IP address of the server.
+    :param port: The port number to connect to.
+    :param timeout: The number of seconds to wait for the connection and the banner.
+    :return: True if the server has sent an SSH banner, False otherwise.
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            return sock.recv(4, socket.MSG_WAITALL) == b"SSH-"
+    except OSError:
+        return False
+
+
 def is_tcp_endpoint_reachable(host: str, port: int, timeout: float = 1.0) -> bool:
     """
     Check if a connection to a given host and port is successful.
@@ -4,11 +4,16 @@ from ipaddress import IPv4Address
 
 import service
 import uci
-from func import wait_for
+from func import Waker, wait_for
 from process import Runner, run
 
 IPV4_ADDR_REGEX = re.compile(r"inet\s+(\d+\.\d+\.\d+\.\d+)")
 
+# kernel messages on the console when a network link comes up, after which addresses and routes may change
+NETWORK_CONSOLE_EVENTS = re.compile(rb"entered forwarding state|link becomes ready|Link is Up")
+# conditions which run commands on the console are not checked more often than this
+CONSOLE_MIN_DELAY = 0.25
+
 
 def get_ip_addr(runner: Runner, if_name: str) -> list[IPv4Address]:
     ip_output = run(runner, f"ip -4 -o addr show dev {if_name}")
@@ -38,17 +43,28 @@ class NetworkConfigurationError(Exception):
     pass
 
 
-def enable_dhcp(runner: Runner) -> None:
-    if uci.get(runner, "network.lan.proto") != "dhcp":
-        uci.set(runner, "network.lan.proto", "dhcp")
-        uci.commit(runner, "network")
+def enable_dhcp(runner: Runner, waker: Waker | None = None) -> None:
+    """Configures the LAN interface via DHCP and waits for a default gateway. A `waker`, e.g. on
+    NETWORK_CONSOLE_EVENTS, checks the gateway again right away when the network may have come up."""
+    with uci.Transaction(runner) as transaction:
+        transaction.set("network.lan.proto", "dhcp")
+        transaction.commit("network")
+    if transaction.changed:
         service.restart(runner, "network", wait=1)
-    if not wait_for(partial(get_gateway_ip, runner), "gateway IP has been assigned", delay=1):
+    if not wait_for(
+        partial(get_gateway_ip, runner),
+        "gateway IP has been assigned",
+        delay=1,
+        waker=waker,
+        min_delay=CONSOLE_MIN_DELAY,
+    ):
         raise NetworkConfigurationError("no gateway has been assigned on time.")
 
 
 def enable_local_dns_queries(runner: Runner) -> None:
-    uci.set(runner, "dhcp.@dnsmasq[0].domainneeded", "0")
-    uci.set(runner, "dhcp.@dnsmasq[0].rebind_protection", "0")
-    uci.commit(runner, "dhcp")
-    service.restart(runner, "dnsmasq")
+    with uci.Transaction(runner) as transaction:
+        transaction.set("dhcp.@dnsmasq[0].domainneeded", "0")
+        transaction.set("dhcp.@dnsmasq[0].rebind_protection", "0")
+        transaction.commit("dhcp")
+    if transaction.changed:
+        service.restart(runner, "dnsmasq")
@@ -1,7 +1,12 @@
+import shlex
+import weakref
+from collections.abc import Collection
 from dataclasses import dataclass
 
-from labgrid.driver import ShellDriver, SSHDriver
-from process import run
+from process import Runner, run
+
+DISTFEEDS_PATH = "/etc/opkg/distfeeds.conf"
+UPSTREAM_FEEDS = "https://downloads.openwrt.org"
 
 
 @dataclass
@@ -10,23 +15,132 @@ class Package:
     version: str
 
 
-def list_installed(shell: ShellDriver | SSHDriver) -> list[Package]:
-    """Parses the output of `opkg list-installed` and returns a list of Package objects."""
+class PackageDatabase:
+    """Packages installed on a device, listed once and indexed by name until packages are installed or removed"""
+
+    def __init__(self, shell: Runner) -> None:
+        self.shell = shell
+        self._installed: dict[str, Package] | None = None
+        self._updated = False
+
+    @property
+    def installed(self) -> dict[str, Package]:
+        if self._installed is None:
+            self._installed = {package.name: package for package in _list_installed(self.shell)}
+        return self._installed
+
+    def invalidate(self) -> None:
+        self._installed = None
+
+    def is_installed(self, *packages: str) -> bool:
+        """Returns whether all given packages are installed"""
+        return not self.missing(*packages)
+
+    def missing(self, *packages: str) -> list[str]:
+        installed = self.installed
+        return [package for package in packages if package not in installed]
+
+    def feeds_changed(self) -> None:
+        """Makes the next update download the package lists again"""
+        self._updated = False
+
+    def update(self) -> None:
+        """Downloads the package lists, once per session"""
+        if not self._updated:
+            run(self.shell, "opkg update")
+            self._updated = True
+
+    def install(self, *packages: str) -> None:
+        if packages:
+            run(self.shell, f"opkg install {shlex.join(packages)}")
+            self._changed()
+
+    def remove(self, *packages: str) -> None:
+        if packages:
+            run(self.shell, f"opkg remove {shlex.join(packages)}")
+            self._changed()
+
+    def _changed(self) -> None:
+        self.invalidate()
+        for package_database in _databases.values():
+            package_database.invalidate()
+
+    def ensure_installed(self, *packages: str) -> list[str]:
+        """Installs the packages which are missing with a single `opkg install` and returns their names"""
+        missing = self.missing(*packages)
+        if missing:
+            self.update()
+            self.install(*missing)
+        return missing
+
+
+# databases are kept per runner for the whole session; as the shell and SSH runners of a target see the same
+# device, installing or removing packages invalidates all of them
+_databases: weakref.WeakKeyDictionary[Runner, PackageDatabase] = weakref.WeakKeyDictionary()
+
+
+def database(shell: Runner) -> PackageDatabase:
+    if shell not in _databases:
+        _databases[shell] = PackageDatabase(shell)
+    return _databases[shell]
+
+
+def invalidate(shell: Runner) -> None:
+    """Drops all cached state, e.g. when the device has been rebooted into a fresh image"""
+    _databases.pop(shell, None)
+
+
+def _list_installed(shell: Runner) -> list[Package]:
     return [Package(*line.split(" - ", 1)) for line in run(shell, "opkg list-installed").splitlines() if " - " in line]
 
 
-def list_installed_names(shell: ShellDriver | SSHDriver) -> list[str]:
-    # return [line.partition(" ")[0] for line in run(shell, "opkg list-installed").splitlines() if line]
-    return [package.name for package in list_installed(shell)]
+def list_installed(shell: Runner) -> list[Package]:
+    """Parses the output of `opkg list-installed` and returns a list of Package objects."""
+    return list(database(shell).installed.values())
+
+
+def list_installed_names(shell: Runner) -> list[str]:
+    return list(database(shell).installed)
+
+
+def is_package_installed(shell: Runner, *packages: str) -> bool:
+    return database(shell).is_installed(*packages)
+
+
+def update(shell: Runner) -> None:
+    database(shell).update()
+
+
+def install(shell: Runner, *packages: str) -> None:
+    database(shell).install(*packages)
 
 
-def is_package_installed(shell: ShellDriver | SSHDriver, package: str) -> bool:
-    return package in list_installed_names(shell)
+def ensure_installed(shell: Runner, *packages: str) -> list[str]:
+    return database(shell).ensure_installed(*packages)
 
 
-def update(shell: ShellDriver | SSHDriver) -> None:
-    run(shell, "opkg update")
+def rewrite_distfeeds(
+    content: str, mirror: str, upstream: str = UPSTREAM_FEEDS, feeds: Collection[str] | None = None
+) -> str:
+    """Points the feeds of a distfeeds.conf at a mirror which keeps the paths of the upstream URLs; feeds which are
+    not listed in `feeds` are commented out"""
+    lines = []
+    for line in content.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0].startswith("src"):
+            if feeds is not None and fields[1] not in feeds:
+                line = f"# {line}"
+            elif fields[2].startswith(upstream):
+                line = f"{fields[0]} {fields[1]} {mirror.rstrip('/')}{fields[2].removeprefix(upstream)}"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
 
 
-def install(shell: ShellDriver | SSHDriver, package: str) -> None:
-    run(shell, f"opkg install {package}")
+def use_feed_mirror(
+    shell: Runner, mirror: str, upstream: str = UPSTREAM_FEEDS, feeds: Collection[str] | None = None
+) -> None:
+    """Installs packages from a mirror of the upstream feeds, e.g. the one of the artifacts service"""
+    content = rewrite_distfeeds(run(shell, f"cat {DISTFEEDS_PATH}"), mirror, upstream, feeds)
+    run(shell, f"printf %s {shlex.quote(content)} > {DISTFEEDS_PATH}")
+    for package_database in _databases.values():
+        package_database.feeds_changed()
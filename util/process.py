@@ -1,8 +1,10 @@
 import subprocess
 
 from labgrid.driver import ShellDriver, SSHDriver
+from labgrid.protocol import CommandProtocol
 
-Runner = ShellDriver | SSHDriver
+# CommandProtocol covers the GuestAgentDriver, which can not be imported here without a circular import
+Runner = ShellDriver | SSHDriver | CommandProtocol
 
 
 def shell_run(cmd: str, shell: str = "/bin/bash") -> str:
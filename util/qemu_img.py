@@ -0,0 +1,42 @@
+import subprocess
+from pathlib import Path
+
+
+def image_format(path: Path | str) -> str:
+    """Returns the QEMU disk format of an image based on its file name."""
+    return "qcow2" if str(path).endswith(".qcow2") else "raw"
+
+
+def create_overlay(base: Path, overlay: Path, qemu_img: str = "qemu-img") -> None:
+    """Creates a thin qcow2 overlay which is backed by `base`."""
+    subprocess.run(
+        [qemu_img, "create", "-q", "-f", "qcow2", "-b", str(base), "-F", image_format(base), str(overlay)],
+        check=True,
+    )
+
+
+def create_image(path: Path, size: int, qemu_img: str = "qemu-img") -> None:
+    """Creates an empty qcow2 image of `size` bytes; a backing image can still be attached when it is opened."""
+    subprocess.run([qemu_img, "create", "-q", "-f", "qcow2", str(path), str(size)], check=True)
+
+
+def convert(
+    src: Path | str,
+    dest: Path,
+    dest_format: str = "qcow2",
+    compress: bool = False,
+    force_share: bool = False,
+    qemu_img: str = "qemu-img",
+) -> None:
+    """Converts `src` into a standalone image `dest`, flattening any backing chain. `src` may also be a `json:`
+    block node definition.
+
+    :param force_share: open `src` even though a (paused) QEMU instance holds a lock on it.
+    """
+    cmd = [qemu_img, "convert", "-q", "-O", dest_format]
+    if compress:
+        cmd.append("-c")
+    if force_share:
+        cmd.append("-U")
+    cmd += [str(src), str(dest)]
+    subprocess.run(cmd, check=True)
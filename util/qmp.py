@@ -1,6 +1,19 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import itertools
 import json
 import logging
-from collections.abc import Callable
+import queue
+import threading
+import time
+from collections.abc import Callable, Coroutine, Iterable, Sequence
+from dataclasses import dataclass
+from typing import Any, TypeVar
+
+T = TypeVar("T")
+
+QMPCommand = tuple[str, dict | None]
 
 
 class QMPMonitor:
@@ -26,7 +39,7 @@ class QMPMonitor:
         line = self.monitor_out()
         self.logger.debug("Received line: %s", line.rstrip("\r\n"))
         if not line:
-            raise QMPError("Received empty response")
+            raise QMPConnectionError("Received empty response")
         return json.loads(line)
 
     def execute(self, command: str, arguments: dict | None = None) -> str:
@@ -46,5 +59,451 @@ class QMPMonitor:
         return answer["return"]
 
 
+class AsyncQMPClient:
+    """asyncio based QMP client.
+
+    Command responses are matched to their requests by ``id`` so that several commands can be in flight at
+    once. Asynchronous events are handed to callbacks registered with :meth:`subscribe` and to the async
+    iterators returned by :meth:`events`.
+    """
+
+    def __init__(self) -> None:
+        self.logger = logging.getLogger(f"{self}")
+        self.greeting: dict = {}
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._reader_task: asyncio.Task | None = None
+        self._ids = itertools.count()
+        self._pending: dict[str, asyncio.Future[dict]] = {}
+        self._callbacks: list[Callable[[dict], None]] = []
+        self._streams: list[QMPEventStream] = []
+
+    @property
+    def connected(self) -> bool:
+        return self._reader_task is not None and not self._reader_task.done()
+
+    async def connect(self, address: tuple[str, int] | str) -> None:
+        """Connects to a TCP address or, given a path, to a Unix domain socket"""
+        if isinstance(address, str):
+            self._reader, self._writer = await asyncio.open_unix_connection(address)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(*address)
+        try:
+            line = await self._reader.readline()
+            if not line:
+                raise QMPConnectionError("Received empty response")
+            self.greeting = json.loads(line)
+            if not self.greeting.get("QMP"):
+                raise QMPError("QMP greeting message invalid")
+            self._reader_task = asyncio.get_running_loop().create_task(self._read_loop())
+            await self.execute("qmp_capabilities")
+        except BaseException:
+            await self.close()
+            raise
+
+    async def _read_loop(self) -> None:
+        assert self._reader
+        try:
+            while line := await self._reader.readline():
+                self.logger.debug("Received line: %s", line.decode().rstrip("\r\n"))
+                message = json.loads(line)
+                if "event" in message:
+                    self._dispatch_event(message)
+                elif (future := self._pending.pop(message.get("id"), None)) is not None:
+                    if not future.done():
+                        future.set_result(message)
+                elif "id" not in message and self._pending:
+                    # QEMU answers without id if it could not parse the request, e.g. on malformed input;
+                    # answers arrive in order, so the reply belongs to the oldest command still pending
+                    future = self._pending.pop(next(iter(self._pending)))
+                    if not future.done():
+                        future.set_result(message)
+                else:
+                    self.logger.warning("Dropping unexpected QMP message: %s", message)
+        except (OSError, ValueError) as exc:
+            self.logger.debug("QMP connection failed: %s", exc)
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(QMPConnectionError("QMP connection closed"))
+            self._pending.clear()
+            for stream in self._streams:
+                stream.offer(None)
+
+    def _dispatch_event(self, event: dict) -> None:
+        for callback in list(self._callbacks):
+            try:
+                callback(event)
+            except Exception:
+                self.logger.exception("QMP event callback failed")
+        for stream in self._streams:
+            stream.offer(event)
+
+    async def request(self, command: str, arguments: dict | None = None) -> dict:
+        """Send a command and return the raw answer, i.e. the dict containing either "return" or "error"."""
+        (answer,) = await self.request_batch([(command, arguments)])
+        return answer
+
+    async def request_batch(self, commands: Sequence[QMPCommand]) -> list[dict]:
+        """Send all commands with a single write and return their raw answers in order.
+
+        Raises :class:`QMPNotSentError` if the connection was found closed before anything was written, i.e. QEMU
+        has certainly not executed any of the commands.
+        """
+        if not self.connected or self._writer is None or self._writer.is_closing():
+            raise QMPNotSentError("QMP client is not connected")
+        loop = asyncio.get_running_loop()
+        command_ids: list[str] = []
+        futures: list[asyncio.Future[dict]] = []
+        payload = bytearray()
+        for command, arguments in commands:
+            command_id = f"c{next(self._ids)}"
+            future: asyncio.Future[dict] = loop.create_future()
+            self._pending[command_id] = future
+            command_ids.append(command_id)
+            futures.append(future)
+            payload += json.dumps({"execute": command, "arguments": arguments or {}, "id": command_id}).encode()
+            payload += b"\n"
+        try:
+            self._writer.write(payload)
+            await self._writer.drain()
+            return list(await asyncio.gather(*futures))
+        finally:
+            for command_id in command_ids:
+                self._pending.pop(command_id, None)
+
+    async def execute(self, command: str, arguments: dict | None = None) -> Any:  # noqa: ANN401
+        answer = await self.request(command, arguments)
+        if "error" in answer:
+            raise QMPError(answer["error"])
+        return answer["return"]
+
+    async def execute_batch(self, commands: Sequence[QMPCommand]) -> list["QMPResult"]:
+        """Pipeline `commands` and collect the outcome of each of them.
+
+        Failing commands do not raise, their error is reported in the corresponding result instead.
+        """
+        answers = await self.request_batch(commands)
+        return [
+            QMPResult.from_answer(command, arguments, answer)
+            for (command, arguments), answer in zip(commands, answers, strict=True)
+        ]
+
+    def subscribe(self, callback: Callable[[dict], None]) -> Callable[[], None]:
+        """Call `callback` for every event received; returns a function which cancels the subscription."""
+        self._callbacks.append(callback)
+        return lambda: self._callbacks.remove(callback)
+
+    def events(self, *names: str) -> "QMPEventStream":
+        """Iterate over the events with the given names (all events if none are given).
+
+        Events are collected from the moment this method is called until the returned stream is closed, so
+        use it as an async context manager::
+
+            async with client.events("STOP") as stop_events:
+                await client.execute("stop")
+                await anext(stop_events)
+        """
+        stream = QMPEventStream(names, self._streams.remove)
+        self._streams.append(stream)
+        return stream
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            with contextlib.suppress(OSError):
+                await self._writer.wait_closed()
+        if self._reader_task is not None:
+            await self._reader_task
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+
+    def __str__(self) -> str:
+        return "AsyncQMPClient"
+
+
+class QMPEventStream:
+    """Async iterator over the QMP events delivered by an :class:`AsyncQMPClient`.
+
+    The iteration stops once the connection has been closed.
+    """
+
+    def __init__(self, names: Iterable[str], unsubscribe: Callable[["QMPEventStream"], None]) -> None:
+        self.names = frozenset(names)
+        self._unsubscribe = unsubscribe
+        self._queue: asyncio.Queue[dict | None] = asyncio.Queue()
+        self._closed = False
+
+    def offer(self, event: dict | None) -> None:
+        if event is None or not self.names or event["event"] in self.names:
+            self._queue.put_nowait(event)
+
+    def __aiter__(self) -> "QMPEventStream":
+        return self
+
+    async def __anext__(self) -> dict:
+        if self._closed or (event := await self._queue.get()) is None:
+            await self.aclose()
+            raise StopAsyncIteration
+        return event
+
+    async def aclose(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._unsubscribe(self)
+
+    async def __aenter__(self) -> "QMPEventStream":
+        return self
+
+    async def __aexit__(self, *_: object) -> None:
+        await self.aclose()
+
+
+class QMPEventSubscription:
+    """Thread-safe queue of QMP events delivered by a :class:`QMPSession`.
+
+    Once the session has been closed, waiting for further events raises :class:`QMPConnectionError`.
+    """
+
+    def __init__(self, names: Iterable[str], unsubscribe: Callable[["QMPEventSubscription"], None]) -> None:
+        self.names = frozenset(names)
+        self._unsubscribe = unsubscribe
+        self._queue: queue.SimpleQueue[dict | None] = queue.SimpleQueue()
+
+    def offer(self, event: dict) -> None:
+        if not self.names or event["event"] in self.names:
+            self._queue.put(event)
+
+    def end(self) -> None:
+        """Wakes up all waiters, called when the session is closed"""
+        self._queue.put(None)
+
+    def get(self, timeout: float | None = None) -> dict:
+        try:
+            event = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"Timeout while waiting for QMP events {sorted(self.names)}") from None
+        if event is None:
+            # keep the end marker for the next waiter
+            self._queue.put(None)
+            raise QMPConnectionError("QMP session closed")
+        return event
+
+    def wait(self, predicate: Callable[[dict], bool] | None = None, timeout: float | None = None) -> dict:
+        """Wait for the next event which satisfies `predicate`."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            event = self.get(remaining)
+            if predicate is None or predicate(event):
+                return event
+
+    def close(self) -> None:
+        self._unsubscribe(self)
+
+    def __enter__(self) -> "QMPEventSubscription":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+
+class QMPSession:
+    """Long-lived QMP connection which is established on first use.
+
+    This is the synchronous facade of :class:`AsyncQMPClient`: the client runs in a private event loop thread,
+    so several threads may issue commands concurrently. A connection which went stale in the meantime (e.g.
+    because QEMU has been restarted) is re-established transparently, but a request is only repeated if it had not
+    been sent yet. Event subscriptions survive reconnects and end when the session is closed.
+    """
+
+    def __init__(self, address: tuple[str, int] | str, timeout: float | None = None) -> None:
+        self.address = address
+        self.timeout = timeout
+        self.logger = logging.getLogger(f"{self}")
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._client: AsyncQMPClient | None = None
+        self._callbacks: list[Callable[[dict], None]] = []
+        self._subscriptions: list[QMPEventSubscription] = []
+
+    @property
+    def connected(self) -> bool:
+        client = self._client
+        return client is not None and client.connected
+
+    def _run(self, coro: Coroutine[Any, Any, T]) -> T:
+        assert self._loop
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError(f"{self} must not be used from its event callbacks")
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def _dispatch_event(self, event: dict) -> None:
+        for callback in list(self._callbacks):
+            try:
+                callback(event)
+            except Exception:
+                self.logger.exception("QMP event callback failed")
+        for subscription in list(self._subscriptions):
+            subscription.offer(event)
+
+    def _connect(self) -> AsyncQMPClient:
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever, name=f"{self}", daemon=True)
+            self._thread.start()
+        client = AsyncQMPClient()
+        client.subscribe(self._dispatch_event)
+        self._run(client.connect(self.address))
+        self._client = client
+        return client
+
+    def _disconnect(self) -> None:
+        if self._client is not None:
+            with contextlib.suppress(OSError, QMPError):
+                self._run(self._client.close())
+        self._client = None
+
+    def _get_client(self) -> tuple[AsyncQMPClient, bool]:
+        with self._lock:
+            if self._client is not None and self._client.connected:
+                return self._client, True
+            self._disconnect()
+            return self._connect(), False
+
+    def _call(self, request: Callable[[AsyncQMPClient], Coroutine[Any, Any, T]]) -> T:
+        client, reused = self._get_client()
+        try:
+            return self._run(request(client))
+        except (OSError, QMPConnectionError) as exc:
+            with self._lock:
+                if self._client is client:
+                    self._disconnect()
+            # once the request has been written, QEMU may have executed it before the connection dropped;
+            # repeating it could run non-idempotent commands such as hostfwd_add twice
+            if not reused or not isinstance(exc, QMPNotSentError):
+                raise
+        # the connection went stale since its last use: retry once on a fresh one
+        self.logger.debug("Reconnecting to QMP at %s", self._address_str)
+        client, _ = self._get_client()
+        return self._run(request(client))
+
+    def execute(self, command: str, arguments: dict | None = None) -> Any:  # noqa: ANN401
+        return self._call(lambda client: client.execute(command, arguments))
+
+    def execute_batch(self, commands: Sequence[QMPCommand]) -> list["QMPResult"]:
+        """Send all commands in one write and collect their results, see :meth:`AsyncQMPClient.execute_batch`."""
+        if not commands:
+            return []
+        return self._call(lambda client: client.execute_batch(commands))
+
+    def subscribe(self, callback: Callable[[dict], None]) -> Callable[[], None]:
+        """Call `callback` (from the event loop thread) for every event received.
+
+        Returns a function which cancels the subscription.
+        """
+        self._callbacks.append(callback)
+        return lambda: self._callbacks.remove(callback)
+
+    def events(self, *names: str) -> QMPEventSubscription:
+        """Start collecting the events with the given names (all events if none are given).
+
+        Subscribe before issuing the command which causes the event, e.g.::
+
+            with session.events("STOP") as stop_events:
+                session.execute("stop")
+                stop_events.wait(timeout=5)
+        """
+        subscription = QMPEventSubscription(names, self._subscriptions.remove)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def wait_event(
+        self, name: str, predicate: Callable[[dict], bool] | None = None, timeout: float | None = None
+    ) -> dict:
+        """Wait for the next event `name` which satisfies `predicate`."""
+        with self.events(name) as subscription:
+            self._get_client()
+            return subscription.wait(predicate, timeout)
+
+    def close(self) -> None:
+        for subscription in list(self._subscriptions):
+            subscription.end()
+        with self._lock:
+            self._disconnect()
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                assert self._thread
+                self._thread.join()
+                self._loop.close()
+            self._loop = None
+            self._thread = None
+
+    @property
+    def _address_str(self) -> str:
+        return self.address if isinstance(self.address, str) else f"{self.address[0]}:{self.address[1]}"
+
+    def __str__(self) -> str:
+        return f"QMPSession({self._address_str})"
+
+
+@dataclass(frozen=True)
+class QMPResult:
+    command: str
+    arguments: dict | None
+    result: Any = None
+    error: dict | None = None
+
+    @classmethod
+    def from_answer(cls, command: str, arguments: dict | None, answer: dict) -> "QMPResult":
+        result = answer.get("return")
+        error = answer.get("error")
+        if error is None and command == "human-monitor-command" and isinstance(result, str):
+            # human monitor commands report failures as text within a successful answer
+            command_name, _, _ = (arguments or {}).get("command-line", "").partition(" ")
+            check = HMP_SUCCESS_CHECKS.get(command_name)
+            if check is not None and not check(result):
+                error = {"class": "HMPError", "desc": result.strip()}
+        return cls(command, arguments, result, error)
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def unwrap(self) -> Any:  # noqa: ANN401
+        """Return the result of the command or raise its error"""
+        if self.error is not None:
+            raise QMPError(self.error)
+        return self.result
+
+
+# checks whether the output of a human monitor command indicates success
+HMP_SUCCESS_CHECKS: dict[str, Callable[[str], bool]] = {
+    "hostfwd_add": lambda output: not output.strip(),
+    "hostfwd_remove": lambda output: output.rstrip().endswith(" removed"),
+}
+
+
+def hmp(command_line: str) -> QMPCommand:
+    """Wrap a human monitor command so that it can be sent via QMP"""
+    return ("human-monitor-command", {"command-line": command_line})
+
+
 class QMPError(Exception):
     pass
+
+
+class QMPConnectionError(QMPError):
+    pass
+
+
+class QMPNotSentError(QMPConnectionError):
+    """The connection was closed before the request was sent"""
@@ -1,9 +1,10 @@
 from .qemu_network import QEMUNetworkStrategy
 from .qemu_stateful import QEMUStatefulStrategy
-from .qemu_strategy import QEMUBaseStrategy
+from .qemu_strategy import GuestService, QEMUBaseStrategy
 from .status import Status
 
 __all__ = [
+    "GuestService",
     "QEMUBaseStrategy",
     "QEMUNetworkStrategy",
     "QEMUStatefulStrategy",
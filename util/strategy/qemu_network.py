@@ -14,15 +14,19 @@
 
 import logging
 import os
-import subprocess
 import urllib.parse
 from pathlib import Path
 
 import attr
 import httpx
+from driver.remote_disk import open_remote_image
+from image import CHUNK_SIZE, ChecksumError, allocated_size, parse_sha256sums, prefetch, read_chunks, store_image
 from labgrid import step, target_factory
+from labgrid.strategy import StrategyError
+from qemu_img import convert
 
 from .qemu_strategy import QEMUBaseStrategy
+from .status import Status
 
 
 @target_factory.reg_driver
@@ -38,15 +42,47 @@ class QEMUNetworkStrategy(QEMUBaseStrategy):
     def __attrs_post_init__(self) -> None:
         super().__attrs_post_init__()
         assert self.params
-
-        self._download_image()  # keep .gz image
-        if self.params.overwrite:
+        if self.params.snapshot is not None:
+            if self.params.snapshot not in Status.__members__:
+                raise StrategyError(f"invalid snapshot status {self.params.snapshot}")  # type: ignore
+            if not (self.params.overlay or self.params.lazy):
+                # a disk which QEMU writes to directly changes with every run, each run would add a snapshot
+                raise StrategyError("snapshot requires overlay or lazy mode")  # type: ignore
+            if self.qemu.snapshot_dir is None:  # type: ignore
+                raise StrategyError("snapshot requires snapshot_dir in CustomQEMUDriver")  # type: ignore
+
+        if self.params.overwrite and (self.params.overlay or self.params.lazy):
+            # the base image is immutable and each run gets a fresh overlay anyway
+            logging.warning("overwrite has no effect in overlay or lazy mode, the base image is never overwritten")
+
+        if self.params.lazy:
+            self.qemu.disk_remote = open_remote_image(self.raw_disk_url, self.disk_path.parent)  # type: ignore
+        elif self.params.overlay and self.params.compressed_base:
+            if not self.compressed_base_disk_path.exists():
+                if not self.base_disk_path.exists():
+                    self._fetch_image(self.base_disk_path)
+                self._compress_base_image()
+            self.qemu.disk_base = self.compressed_base_disk_path  # type: ignore
+        elif self.params.overlay:
+            if not self.base_disk_path.exists():
+                self._fetch_image(self.base_disk_path)
+                self.base_disk_path.chmod(0o444)  # the base image is shared and must never change
+            self.qemu.disk_base = self.base_disk_path  # type: ignore
+        elif self.params.overwrite:
             logging.info(f"Overwriting image {self.disk_path}")
-            self._extract_image()  # overwrite image if existing
+            self._fetch_image(self.disk_path)  # overwrite image if existing
+        else:
+            self._fetch_image(None)
 
     def on(self) -> None:
         self.qemu.on()  # type: ignore
 
+    def _status_reached(self, status: Status) -> None:
+        assert self.params
+
+        if self.params.snapshot == status.name and self.qemu.restored_snapshot is None:  # type: ignore
+            self.qemu.save_snapshot(status.name)  # type: ignore
+
     def off(self) -> None:
         self.qemu.off()  # type: ignore
 
@@ -54,6 +90,16 @@ class QEMUNetworkStrategy(QEMUBaseStrategy):
     def disk_url(self) -> str:
         return self.target.env.config.data["urls"]["disk-image"]
 
+    @property
+    def raw_disk_url(self) -> str:
+        """URL of the decompressed disk image which is read on demand in lazy mode"""
+        return self.target.env.config.data["urls"].get("disk-image-raw") or self.disk_url.removesuffix(".gz")
+
+    @property
+    def disk_sha256sums_url(self) -> str | None:
+        """URL of a sha256sum manifest listing the compressed disk image"""
+        return self.target.env.config.data["urls"].get("disk-image-sha256sums")
+
     @property
     def disk_path(self) -> Path:
         if not self.qemu.disk:
@@ -64,29 +110,65 @@ class QEMUNetworkStrategy(QEMUBaseStrategy):
     def compressed_disk_path(self) -> Path:
         return self.disk_path.parent / os.path.basename(urllib.parse.urlparse(self.disk_url).path)
 
-    @step()
-    def _download_image(self) -> None:
+    @property
+    def base_disk_path(self) -> Path:
+        """Decompressed image which the per-run overlays are backed by in overlay mode"""
+        return self.compressed_disk_path.with_suffix("")
+
+    @property
+    def compressed_base_disk_path(self) -> Path:
+        """Compressed qcow2 image which the per-run overlays are backed by with compressed_base"""
+        return self.base_disk_path.with_suffix(".qcow2")
+
+    def _fetch_image(self, dest: Path | None) -> None:
+        """Make sure the compressed image has been downloaded (it is kept) and decompress it into `dest`"""
         if self.compressed_disk_path.exists():
             logging.info(f"Image {self.compressed_disk_path} already exists. Skipping download.")
+            if dest is not None:
+                self._extract_image(dest)
             return
-        response = httpx.get(self.disk_url)
+        self._download_image(dest)
+
+    def _expected_sha256(self) -> str | None:
+        if self.disk_sha256sums_url is None:
+            return None
+        response = httpx.get(self.disk_sha256sums_url, follow_redirects=True)
         response.raise_for_status()
-        self.compressed_disk_path.write_bytes(response.content)
+        sha256sums = parse_sha256sums(response.text)
+        if self.compressed_disk_path.name not in sha256sums:
+            raise ChecksumError(f"{self.compressed_disk_path.name} is not listed in {self.disk_sha256sums_url}")
+        return sha256sums[self.compressed_disk_path.name]
+
+    @step(args=["dest"])
+    def _download_image(self, dest: Path | None) -> None:
+        # download and decompression overlap: chunks are received in a background thread while the
+        # previously received ones are decompressed
+        sha256 = self._expected_sha256()
+        with httpx.stream("GET", self.disk_url, follow_redirects=True) as response:
+            response.raise_for_status()
+            store_image(prefetch(response.iter_bytes(CHUNK_SIZE)), self.compressed_disk_path, dest, sha256)
+        if dest is not None:
+            log_image_size(dest)
+
+    @step(args=["dest"])
+    def _extract_image(self, dest: Path) -> None:
+        logging.info(f"Extracting {self.compressed_disk_path.name} to {dest.name}.")
+        store_image(prefetch(read_chunks(self.compressed_disk_path)), dest=dest)
+        log_image_size(dest)
 
     @step()
-    def _extract_image(self) -> None:
-        # using gunzip to extract the image as it is more robust than Python's built-in gzip module
-        logging.info(f"Extracting {self.compressed_disk_path.name} to {self.disk_path.name}.")
-        with open(self.disk_path, "wb") as output_file:
-            gunzip_process = subprocess.Popen(
-                ["/usr/bin/gunzip"],
-                stdin=subprocess.PIPE,
-                stdout=output_file,
-                stderr=subprocess.PIPE,
-            )
-
-            assert gunzip_process.stdin
-            gunzip_process.stdin.write(self.compressed_disk_path.read_bytes())
-            gunzip_process.stdin.close()
-
-            gunzip_process.wait()
+    def _compress_base_image(self) -> None:
+        dest = self.compressed_base_disk_path
+        partial = dest.with_name(f"{dest.name}.part")
+        logging.info(f"Converting {self.base_disk_path.name} to compressed {dest.name}.")
+        convert(self.base_disk_path, partial, compress=True, qemu_img=self.qemu.qemu_img)  # type: ignore
+        partial.chmod(0o444)  # the base image is shared and must never change
+        partial.replace(dest)
+        log_image_size(dest)
+        # the compressed image replaces the raw one, which can be extracted again from the downloaded image
+        self.base_disk_path.unlink()
+
+
+def log_image_size(path: Path) -> None:
+    allocated, size = allocated_size(path)
+    logging.info(f"{path.name}: {allocated >> 20} MiB allocated on disk, {size >> 20} MiB image size.")
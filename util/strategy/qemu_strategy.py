@@ -1,7 +1,11 @@
 from abc import ABC, abstractmethod
+from collections.abc import Iterable
+from dataclasses import dataclass
 from functools import partial
 
 import attr
+import opkg
+import uci
 from driver import BaseQEMUDriver, QEMUParams
 from driver.base_qemudriver import Endpoint
 from func import retry_exc, wait_for
@@ -10,8 +14,9 @@ from labgrid.driver import ShellDriver, SSHDriver
 from labgrid.driver.exception import ExecutionError
 from labgrid.step import Step
 from labgrid.strategy import Strategy, StrategyError
-from network import is_tcp_endpoint_reachable
-from openwrt import enable_dhcp, enable_local_dns_queries
+from labgrid.util import get_free_port
+from network import is_ssh_endpoint_ready
+from openwrt import CONSOLE_MIN_DELAY, NETWORK_CONSOLE_EVENTS, enable_dhcp, enable_local_dns_queries
 
 from .status import Status
 
@@ -20,6 +25,21 @@ class SetupError(Exception):
     pass
 
 
+@dataclass(frozen=True)
+class GuestService:
+    """TCP service in the guest which is made reachable through a host forward"""
+
+    name: str
+    port: int
+    # guest address, defaults to the address of the DUT
+    address: str | None = None
+    # fixed host port, a free one is picked otherwise
+    host_port: int | None = None
+
+
+SSH_SERVICE = "ssh"
+
+
 class QEMUBaseStrategy(ABC, Strategy):
     status: Status = attr.ib(default=Status.unknown)
     qemu: BaseQEMUDriver | None = None
@@ -31,6 +51,10 @@ class QEMUBaseStrategy(ABC, Strategy):
         super().__attrs_post_init__()
         self._ssh_local_endpoint: Endpoint | None = None
         self._ssh_remote_port: int = self.ssh.networkservice.port
+        self._remote_address: str | None = None
+        self._services: dict[str, GuestService] = {SSH_SERVICE: GuestService(SSH_SERVICE, self._ssh_remote_port)}
+        # host endpoints of the forwards created for the declared services
+        self._service_endpoints: dict[str, Endpoint] = {}
 
     @abstractmethod
     def on(self) -> None:
@@ -46,6 +70,19 @@ class QEMUBaseStrategy(ABC, Strategy):
 
         return str(self.shell.get_ip_addresses()[0].ip)
 
+    def _wait_remote_address(self) -> str:
+        assert self.qemu
+
+        with self.qemu.console_waker(NETWORK_CONSOLE_EVENTS) as waker:
+            return retry_exc(
+                self.get_remote_address,
+                ExecutionError,
+                "getting the remote address",
+                timeout=20,
+                waker=waker,
+                min_delay=CONSOLE_MIN_DELAY,
+            )
+
     @property
     def local_ssh_endpoint(self) -> Endpoint | None:
         return self._ssh_local_endpoint
@@ -57,23 +94,65 @@ class QEMUBaseStrategy(ABC, Strategy):
         assert self.ssh
         assert self._ssh_remote_port
 
-        dst_address: str = retry_exc(self.get_remote_address, ExecutionError, "getting the remote address", timeout=20)
+        self._remote_address = self._wait_remote_address()
+        ssh_endpoint = self._apply_service_forwards(self._remote_address)[SSH_SERVICE]
         networkservice = self.ssh.networkservice
 
-        if networkservice.address != dst_address:
+        if ssh_endpoint != self._ssh_local_endpoint:
             self.target.deactivate(self.ssh)
 
-            if self._ssh_local_endpoint is not None:
-                self.qemu.remove_port_forward(self._ssh_local_endpoint)
-
-            self._ssh_local_endpoint = self.qemu.add_hostfwd(
-                dst_address,
-                self._ssh_remote_port,
-            )
+            self._ssh_local_endpoint = ssh_endpoint
 
             networkservice.address = self._ssh_local_endpoint.addr
             networkservice.port = self._ssh_local_endpoint.port
 
+    @step(args=["services"], result=True)
+    def forward_services(self, services: Iterable[GuestService]) -> dict[str, Endpoint]:
+        """Makes the given guest services reachable from the host.
+
+        The services replace the previously declared ones; SSH is always forwarded. Only the differences to the
+        current forwards are applied, all within a single QMP round trip.
+
+        Returns the host endpoint of each service by name.
+        """
+        services = {service.name: service for service in services}
+        services.setdefault(SSH_SERVICE, self._services[SSH_SERVICE])
+        self._services = services
+        if self._remote_address is None:
+            self._remote_address = self._wait_remote_address()
+        return self._apply_service_forwards(self._remote_address)
+
+    def _apply_service_forwards(self, remote_address: str) -> dict[str, Endpoint]:
+        assert self.qemu
+
+        forward_table = self.qemu.forward_table
+        remove: list[Endpoint] = []
+        add: dict[Endpoint, Endpoint] = {}
+        endpoints: dict[str, Endpoint] = {}
+        for service in self._services.values():
+            remote_endpoint = Endpoint(service.address or remote_address, service.port)
+            local_endpoint = self._service_endpoints.get(service.name)
+            if local_endpoint is None or forward_table.guest_endpoint(local_endpoint) != remote_endpoint:
+                local_endpoint = forward_table.host_endpoint(remote_endpoint)
+            if local_endpoint is None or service.host_port not in (None, local_endpoint.port):
+                local_endpoint = Endpoint("127.0.0.1", service.host_port or get_free_port())
+                if forward_table.guest_endpoint(local_endpoint) is not None:
+                    remove.append(local_endpoint)
+                add[local_endpoint] = remote_endpoint
+            endpoints[service.name] = local_endpoint
+        # forwards of services which are gone or have moved
+        for local_endpoint in self._service_endpoints.values():
+            if (
+                local_endpoint not in endpoints.values()
+                and forward_table.guest_endpoint(local_endpoint) is not None
+                and local_endpoint not in remove
+            ):
+                remove.append(local_endpoint)
+
+        self.qemu.update_port_forwardings(remove, add)
+        self._service_endpoints = endpoints
+        return endpoints
+
     @step(args=["status"])
     def transition(self, status: Status | str, *, step: Step | None = None) -> None:  # type: ignore
         assert step
@@ -94,6 +173,11 @@ class QEMUBaseStrategy(ABC, Strategy):
 
             self.target.deactivate(self.qemu)
             self.off()
+            # the cached configuration and package state do not survive a power cycle; they are kept per runner,
+            # so every driver which may have run commands on the device is invalidated, e.g. a GuestAgentDriver too
+            for driver in self.target.drivers:
+                uci.invalidate(driver)
+                opkg.invalidate(driver)
 
         elif status == Status.shell:
             assert self.target
@@ -109,7 +193,10 @@ class QEMUBaseStrategy(ABC, Strategy):
             self.transition(Status.shell)
 
             assert self.shell
-            enable_dhcp(self.shell)
+            assert self.qemu
+            # the waker is attached before the network is restarted, so that no link event is missed
+            with self.qemu.console_waker(NETWORK_CONSOLE_EVENTS) as waker:
+                enable_dhcp(self.shell, waker=waker)
             enable_local_dns_queries(self.shell)
 
         elif status == Status.ssh:
@@ -119,11 +206,19 @@ class QEMUBaseStrategy(ABC, Strategy):
             self.update_network_service()
             if self.local_ssh_endpoint is None:
                 raise SetupError("SSH portforwarding could not be established")
+            # QEMU accepts connections to the host forward right away, only the banner tells that sshd answers
             connected = wait_for(
-                partial(is_tcp_endpoint_reachable, self.local_ssh_endpoint.addr, self.local_ssh_endpoint.port),
-                "SSH connection can be established",
+                partial(is_ssh_endpoint_ready, self.local_ssh_endpoint.addr, self.local_ssh_endpoint.port),
+                "SSH server answers",
+                delay=1,
+                min_delay=0.1,
             )
             if not connected:
                 raise SetupError("Could not connect to SSH port of DUT.")
 
         self.status = status
+        self._status_reached(status)
+
+    def _status_reached(self, status: Status) -> None:
+        """Hook which is called after each successful transition"""
+        pass
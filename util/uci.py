@@ -1,5 +1,8 @@
-from labgrid.driver import ShellDriver, SSHDriver
-from process import run
+import shlex
+import weakref
+from dataclasses import dataclass
+
+from process import Runner, run
 
 
 def _to_uci_value(value: str | int | bool) -> str:
@@ -10,20 +13,219 @@ def _to_uci_value(value: str | int | bool) -> str:
     return str(value)
 
 
-def set(shell: ShellDriver | SSHDriver, key: str, value: str | int | bool) -> None:
+class Snapshot:
+    """Values of one UCI package as shown by `uci show`, including changes which have not been committed yet"""
+
+    def __init__(self, package: str, values: dict[str, list[str]]) -> None:
+        self.package = package
+        self.values = values
+
+    @classmethod
+    def parse(cls, package: str, output: str) -> "Snapshot":
+        values: dict[str, list[str]] = {}
+        for line in output.splitlines():
+            key, sep, value = line.partition("=")
+            if sep:
+                values[key] = shlex.split(value)
+        return cls(package, values)
+
+    def get(self, key: str) -> str | None:
+        """Returns the value of an option like `uci get` (list items are joined by spaces), None if unknown"""
+        values = self.values.get(key)
+        return " ".join(values) if values is not None else None
+
+    def get_list(self, key: str) -> list[str] | None:
+        return self.values.get(key)
+
+
+# snapshots are cached per runner until they are invalidated by a write through this module; as the shell and
+# SSH runners of a target see the same configuration, writes invalidate the package for all runners
+_snapshots: weakref.WeakKeyDictionary[Runner, dict[str, Snapshot]] = weakref.WeakKeyDictionary()
+
+
+def snapshot(shell: Runner, package: str) -> Snapshot:
+    """Returns the values of a UCI package, loaded with a single command and cached afterwards"""
+    snapshots = _snapshots.setdefault(shell, {})
+    if package not in snapshots:
+        stdout, _, exitcode = shell.run(f"uci show {shlex.quote(package)}")
+        # a package which does not exist has no values
+        snapshots[package] = Snapshot.parse(package, "\n".join(stdout) if exitcode == 0 else "")
+    return snapshots[package]
+
+
+def invalidate(shell: Runner, package: str | None = None) -> None:
+    """Drops cached snapshots, e.g. when the configuration has been changed by other means or the device rebooted"""
+    snapshots = _snapshots.get(shell)
+    if snapshots is None:
+        return
+    if package is None:
+        snapshots.clear()
+    else:
+        snapshots.pop(package, None)
+
+
+def _written(package: str) -> None:
+    for snapshots in _snapshots.values():
+        if package:
+            snapshots.pop(package, None)
+        else:
+            snapshots.clear()
+
+
+def _package(key: str) -> str:
+    return key.split(".", 1)[0]
+
+
+def set(shell: Runner, key: str, value: str | int | bool) -> None:
     run(shell, f'uci set {key}="{_to_uci_value(value)}"')
+    _written(_package(key))
+
 
+def get(shell: Runner, key: str) -> str:
+    """Returns the value of an option from the cached :func:`snapshot` of its package.
 
-def get(shell: ShellDriver | SSHDriver, key: str) -> str:
-    return run(shell, f"uci get {key}")
+    Raises KeyError if the option is not set. Unlike `uci get` on the device, a missing option does not raise an
+    ExecutionError, so callers which expect one have to catch KeyError instead.
+    """
+    value = snapshot(shell, _package(key)).get(key)
+    if value is None:
+        raise KeyError(key)
+    return value
 
 
-def add_list(shell: ShellDriver | SSHDriver, key: str, value: str | int | bool) -> None:
+def add_list(shell: Runner, key: str, value: str | int | bool) -> None:
     run(shell, f'uci add_list {key}="{_to_uci_value(value)}"')
+    _written(_package(key))
 
 
-def commit(shell: ShellDriver | SSHDriver, section: str | None = None) -> None:
+def commit(shell: Runner, section: str | None = None) -> None:
     if section:
         run(shell, f"uci commit {section}")
+        _written(_package(section))
         return
     run(shell, "uci commit")
+    _written("")
+
+
+@dataclass(frozen=True)
+class Operation:
+    command: str
+    key: str
+    value: str | None = None
+
+    def __str__(self) -> str:
+        argument = self.key if self.value is None else f"{self.key}={self.value}"
+        return f"uci {self.command} {shlex.quote(argument)}" if argument else f"uci {self.command}"
+
+    @property
+    def config(self) -> str:
+        return _package(self.key)
+
+
+class UciError(Exception):
+    def __init__(self, failures: list[tuple[Operation, str]]) -> None:
+        self.failures = failures
+        super().__init__("; ".join(f"{operation}: {message}" for operation, message in failures))
+
+
+ERROR_MARKER = "@uci-error"
+
+
+class Transaction:
+    """Collects UCI changes and applies them with a single command on the runner.
+
+    Changes are committed only if all of them succeeded, otherwise they are reverted and a :class:`UciError`
+    lists the operations which failed along with their error messages. Used as a context manager, the
+    transaction is applied when the block is left without an exception::
+
+        with uci.Transaction(runner) as transaction:
+            transaction.set("dhcp.@dnsmasq[0].domainneeded", False)
+            transaction.commit("dhcp")
+
+    With `diff` enabled, values which are already set are compared against a :func:`snapshot` of their package
+    and not written again. If nothing is left to write, the transaction does not run any command and
+    :attr:`changed` tells callers that e.g. a service restart can be skipped.
+    """
+
+    def __init__(self, runner: Runner, diff: bool = True) -> None:
+        self.runner = runner
+        self.diff = diff
+        self.operations: list[Operation] = []
+        self.commits: list[Operation] = []
+        self.changed = False
+
+    def set(self, key: str, value: str | int | bool) -> "Transaction":
+        self.operations.append(Operation("set", key, _to_uci_value(value)))
+        return self
+
+    def add_list(self, key: str, value: str | int | bool) -> "Transaction":
+        self.operations.append(Operation("add_list", key, _to_uci_value(value)))
+        return self
+
+    def delete(self, key: str, value: str | int | bool | None = None) -> "Transaction":
+        """Deletes an option or section, or only the given value of a list"""
+        if value is None:
+            self.operations.append(Operation("delete", key))
+        else:
+            self.operations.append(Operation("del_list", key, _to_uci_value(value)))
+        return self
+
+    def commit(self, config: str | None = None) -> "Transaction":
+        self.commits.append(Operation("commit", config or ""))
+        return self
+
+    def script(self) -> str:
+        """Returns the shell command applying the transaction, which reports failed operations by their index"""
+        commands = ["f=0"]
+        for index, operation in enumerate(self.operations):
+            commands.append(f'o=$({operation} 2>&1) || {{ f=1; echo "{ERROR_MARKER} {index}" $o; }}')
+        commit_commands = [
+            f'o=$({operation} 2>&1) || echo "{ERROR_MARKER} {len(self.operations) + index}" $o'
+            for index, operation in enumerate(self.commits)
+        ]
+        configs = dict.fromkeys(operation.config for operation in self.operations)
+        revert_commands = [f"uci revert {shlex.quote(config)}" for config in configs] or [":"]
+        commands.append(
+            f'if [ "$f" = 0 ]; then {"; ".join(commit_commands or [":"])}; else {"; ".join(revert_commands)}; fi'
+        )
+        # the subshell keeps the variables out of the login shell
+        return f"({'; '.join(commands)})"
+
+    def _is_noop(self, operation: Operation) -> bool:
+        if operation.command == "set":
+            return snapshot(self.runner, operation.config).get(operation.key) == operation.value
+        if operation.command == "add_list":
+            return operation.value in (snapshot(self.runner, operation.config).get_list(operation.key) or [])
+        return False
+
+    def apply(self) -> bool:
+        """Applies the transaction and returns whether anything has been changed"""
+        if self.diff:
+            self.operations = [operation for operation in self.operations if not self._is_noop(operation)]
+            if not self.operations:
+                # there are no changes which would need to be committed
+                self.commits = []
+        self.changed = bool(self.operations)
+        if not self.operations and not self.commits:
+            return self.changed
+        operations = self.operations + self.commits
+        stdout, _, _ = self.runner.run(self.script())
+        failures: list[tuple[Operation, str]] = []
+        for line in stdout:
+            if line.startswith(f"{ERROR_MARKER} "):
+                _, index, *message = line.split(" ", 2)
+                failures.append((operations[int(index)], message[0] if message else ""))
+        for config in {operation.config for operation in operations}:
+            _written(config)
+        self.operations = []
+        self.commits = []
+        if failures:
+            raise UciError(failures)
+        return self.changed
+
+    def __enter__(self) -> "Transaction":
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, *_: object) -> None:
+        if exc_type is None:
+            self.apply()